@@ -9,6 +9,7 @@ my $bin = "./";
 
 `cp IMGTHLA/wmda/hla_nom_g.txt $db_dir/HLA`;
 `cp IMGTHLA/Allelelist.txt $db_dir/HLA`;
+`python3 ../script/db_bundle.py $db_dir`;
 
 my (%hash,%hashe,$id);
 open IN, "$infile" or die "$!\tplease input IMGTHLA/hla_gen.fasta\n";
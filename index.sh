@@ -13,6 +13,11 @@ for hla in ${HLAs[@]}; do
     echo blat=$dir/db/HLA/HLA_${hla}/ >>$config_file
 done
 
+# the exact-match index of the exon database for the G group annotation, rebuild it for each IMGT release
+python3 $dir/script/whole/exon_index.py $dir/db
+# the annotation tables compiled into one bundle, rebuild it for each IMGT release
+python3 $dir/script/db_bundle.py $dir/db
+
 
 
 
@@ -0,0 +1,58 @@
+"""
+score the alignment records in batches,
+the CIGAR op counts and the NM tag of a chunk of records are
+pulled into NumPy arrays, then the scores are computed in bulk
+
+wangshuai, wshuai294@gmail.com
+"""
+
+import numpy as np
+
+CHUNK_SIZE = 20000
+BAM_CMATCH = 0
+BAM_CSOFT_CLIP = 4
+NM_COLUMN = 10 # get_cigar_stats() appends the NM tag after the 10 CIGAR ops
+
+def iter_chunks(records, chunk_size = CHUNK_SIZE):
+    """
+    split the alignment records into lists of chunk_size records
+    """
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+def cigar_stats(chunk):
+    """
+    return a (n, 11) array for n alignment records,
+    columns 0-9 are the base num of each CIGAR op,
+    column 10 is the NM tag (0 if absent)
+    """
+    stats = np.zeros((len(chunk), NM_COLUMN + 1), dtype = np.int64)
+    for i, alignment in enumerate(chunk):
+        stats[i] = alignment.get_cigar_stats()[0]
+    return stats
+
+def count_alignments(stats):
+    """
+    get mapped length, soft-clipped base num, and the mismatch num
+    of each record, same as count_alignment() for a single record
+    """
+    mis_NM = stats[:, NM_COLUMN]
+    soft_num = stats[:, BAM_CSOFT_CLIP]
+    match_num = stats[:, BAM_CMATCH] - mis_NM # delete mismatch
+    focus_len = stats[:, :NM_COLUMN].sum(axis = 1) - soft_num # mapped length
+    return mis_NM, soft_num, match_num, focus_len
+
+def mismatch_rates(stats):
+    """
+    mismatch num per M-op base of each record, rounded to 6 digits
+    by Python round() to keep the values of the per-record scoring
+    """
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        rates = stats[:, NM_COLUMN] / stats[:, BAM_CMATCH]
+    return [round(rate, 6) for rate in rates.tolist()]
@@ -0,0 +1,63 @@
+"""
+rank the alignments of a hap to the alleles by identity and by match length,
+the ties of identity are broken by tie_index, the ties of match length by identity,
+and the remaining ties keep the input order,
+the alignments are sorted once by identity, the max match length alleles
+and the identity windows are scanned from this order
+
+wangshuai, wshuai294@gmail.com
+"""
+
+import heapq
+from blast_hits import top_group
+
+class Allele_Ranking():
+
+    def __init__(self, align_list, length_index, identity_index, tie_index):
+        self.align_list = align_list
+        self.length_index = length_index
+        self.identity_index = identity_index
+        self.length_key = lambda x: (x[length_index], x[identity_index])
+        self.identity_key = lambda x: (x[identity_index], x[tie_index])
+        # sorted() is stable with reverse = True, so the full ties keep the input order
+        self.by_identity = sorted(align_list, key = self.identity_key, reverse = True)
+
+    def by_length(self, num):
+        # the first num alignments ranked by match length, same as sorted(...)[:num]
+        return heapq.nlargest(num, self.align_list, key = self.length_key)
+
+    def max_identity(self):
+        # the alignments with the max identity, in the ranking order
+        return top_group(self.by_identity, key = lambda x: x[self.identity_index])
+
+    def max_length(self):
+        # the alignments with the max match length, in the ranking order
+        return top_group(self.by_identity, key = lambda x: x[self.length_index])
+
+    def best(self):
+        # the alignments with both the max match length and the max identity
+        if len(self.by_identity) == 0:
+            return []
+        max_identity = self.by_identity[0][self.identity_index]
+        return [x for x in self.max_length() if x[self.identity_index] == max_identity]
+
+    def length_window(self, cutoff):
+        # the alignments within cutoff of the max match length, in the ranking order
+        max_length = max([x[self.length_index] for x in self.align_list])
+        return [x for x in self.by_identity if (max_length - x[self.length_index])/max_length <= cutoff]
+
+    def identity_window(self, cutoff, max_num, ranked_list = None):
+        """
+        the leading alignments within cutoff of the top identity, at most max_num,
+        ranked_list is a part of by_identity, all of it by default
+        """
+        if ranked_list is None:
+            ranked_list = self.by_identity
+        window = []
+        for align in ranked_list:
+            if (ranked_list[0][self.identity_index] - align[self.identity_index])/ranked_list[0][self.identity_index] > cutoff:
+                break
+            window.append(align)
+            if len(window) >= max_num:
+                break
+        return window
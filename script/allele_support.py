@@ -0,0 +1,137 @@
+"""
+find the reads supporting each allele of the hete variants
+in one pass of the bam, the query-to-reference map of each read
+is built once as a NumPy array, then all the variants covered by
+the read are resolved on it
+
+wangshuai, wshuai294@gmail.com
+"""
+
+import numpy as np
+from bisect import bisect_left
+
+REF_QUERY_OPS = (0, 7, 8) # M, =, X consume both the query and the reference
+QUERY_OPS = (1, 4) # I, S consume the query only
+REF_OPS = (2, 3) # D, N consume the reference only
+
+def query_ref_map(read):
+    """
+    return the reference position of each query base, -1 for the
+    inserted and soft-clipped bases, same as
+    read.get_reference_positions(full_length=True) with None as -1,
+    and the reference length spanned by the read
+    """
+    pieces = []
+    ref_pos = read.reference_start
+    if not read.is_unmapped and read.cigartuples:
+        for op, length in read.cigartuples:
+            if op in REF_QUERY_OPS:
+                pieces.append(np.arange(ref_pos, ref_pos + length, dtype = np.int64))
+                ref_pos += length
+            elif op in QUERY_OPS:
+                pieces.append(np.full(length, -1, dtype = np.int64))
+            elif op in REF_OPS:
+                ref_pos += length
+    if len(pieces) == 0:
+        return np.zeros(0, dtype = np.int64), 0
+    return np.concatenate(pieces), ref_pos - read.reference_start
+
+def read_allele(first, ref_map, sequence, aligned_index, aligned_ref):
+    """
+    get the allele of the variant on the read, None if the variant locus
+    has no base on the read, same rules as the per-variant scan of reads_support()
+    """
+    locus = int(first[1]) - 1
+    j = bisect_left(aligned_ref, locus)
+    if j == len(aligned_ref) or aligned_ref[j] != locus:
+        return None
+    if first[2][0] != first[3][0]:
+        #if the first allele is not same for indel alleles, we can just focus on the first locus
+        return sequence[aligned_index[j]]
+    index_list = []
+    for i in range(len(first[4])):
+        j = bisect_left(aligned_ref, locus + i)
+        if j < len(aligned_ref) and aligned_ref[j] == locus + i:
+            index_list.append(aligned_index[j])
+    allele = sequence[index_list[0]:index_list[-1]+1].upper()
+    # for the case that ref is short than alt, add the inserted bases after the ref
+    if len(first[4]) < len(first[2]) and len(first[4]) < len(first[3]):
+        next_index = index_list[-1] + 1
+        while next_index < len(ref_map) and ref_map[next_index] == -1:
+            allele += sequence[next_index]
+            next_index += 1
+    return allele
+
+def sweep_reads(samfile, chrom, snps):
+    """
+    stream the reads overlapping the variants of the chrom in one pass,
+    snps are sorted by position, yield each read, the index range
+    [start, end) of the variants it overlaps, and the allele (0, 1 or None)
+    the read supports at each of them
+    """
+    loci = [int(first[1]) - 1 for first in snps]
+    for read in samfile.fetch(chrom, loci[0], loci[-1] + 1):
+        ref_map, ref_len = query_ref_map(read)
+        # the same overlap rule as fetching a single locus
+        start = bisect_left(loci, read.reference_start)
+        end = bisect_left(loci, read.reference_start + max(ref_len, 1))
+        if start == end:
+            continue
+        if read.mapping_quality <= 1:
+            yield read, start, end, [None] * (end - start)
+            continue
+        aligned_index = np.flatnonzero(ref_map >= 0)
+        aligned_ref = ref_map[aligned_index].tolist()
+        aligned_index = aligned_index.tolist()
+        ref_map = ref_map.tolist()
+        sequence = read.query_sequence
+        alleles = []
+        for first in snps[start:end]:
+            allele = read_allele(first, ref_map, sequence, aligned_index, aligned_ref)
+            if first[2][0] != first[3][0]:
+                support = [first[2][0], first[3][0]]
+            else:
+                support = [first[2], first[3]]
+            if allele is not None and allele == support[0]:
+                alleles.append(0)
+            elif allele is not None and allele == support[1]:
+                alleles.append(1)
+            else:
+                alleles.append(None)
+        yield read, start, end, alleles
+
+class Allele_Support():
+    """
+    the reads of each variant as reads_support() fetched them,
+    reads_list: the read names supporting each allele,
+    fetched_reads: (read name, mapping quality) of all the reads
+    overlapping the variant, in the order of the bam
+    """
+
+    def __init__(self, samfile, snp_list):
+        self.samfile = samfile
+        self.snp_dict = {}
+        for first in snp_list:
+            key = self.snp_key(first)
+            if key not in self.snp_dict:
+                reads_list = [[] for i in range(len(first[3]) + 1)]
+                self.snp_dict[key] = [first, reads_list, []]
+        for chrom in set([key[0] for key in self.snp_dict]):
+            self.sweep(chrom)
+
+    def snp_key(self, first):
+        return (str(first[0]), int(first[1]), first[2], first[3], first[4])
+
+    def get_reads(self, first):
+        first, reads_list, fetched_reads = self.snp_dict[self.snp_key(first)]
+        return reads_list, fetched_reads
+
+    def sweep(self, chrom):
+        snps = sorted([value for key, value in self.snp_dict.items() if key[0] == chrom], key = lambda x: int(x[0][1]))
+        for read, start, end, alleles in sweep_reads(self.samfile, chrom, [value[0] for value in snps]):
+            read_info = (read.query_name, read.mapping_quality)
+            for i in range(start, end):
+                first, reads_list, fetched_reads = snps[i]
+                fetched_reads.append(read_info)
+                if alleles[i - start] is not None:
+                    reads_list[alleles[i - start]].append(read.query_name)
@@ -11,9 +11,14 @@ import numpy as np
 import re
 import time
 import gzip
+from itertools import islice, chain
+from multiprocessing import Pool
+from alignment_score import iter_chunks, cigar_stats, count_alignments
 
 B = ['A', 'C', 'G', 'T']
 BN = ['A', 'C', 'G', 'T', 'N']
+gene_list = ['A', 'B', 'C', 'DPA1', 'DPB1', 'DQA1', 'DQB1', 'DRB1']
+BATCH_SIZE = 100000 # the records per batch of the parallel assignment
 
 def get_names():
     with open(reads_file, 'r') as infile:
@@ -22,29 +27,24 @@ def get_names():
         n.remove('')
     return n
 
-def count_alignment(alignment):
+def score_alignments(bamfile):
     """
-    given alignment record
-    get mapped length, check soft-clipped base num, and the mismatch num
+    score the alignment records chunk by chunk,
+    yield (read name, gene allele, matched base num, mapped length)
+    for each alignment that is paired on the same allele,
+    has no soft-clipped base and has a limited mismatch num
     """
-    match_num = 0 # matched base num
-    soft_num = 0
-    all_num = 0
-    for ci in alignment.cigar:
-        if ci[0] == 0: #M	BAM_CMATCH	0
-            match_num += ci[1]
-        elif ci[0] == 4: #S	BAM_CSOFT_CLIP	4
-            soft_num += ci[1]
-        all_num += ci[1]
-
-    mis_NM = 0
-    for ta in alignment.get_tags():
-        if ta[0] == 'NM':
-            match_num -= ta[1] # delete mismatch
-            mis_NM += ta[1]
-    focus_len = all_num - soft_num # mapped length
-
-    return mis_NM, soft_num, match_num, focus_len
+    for chunk in iter_chunks(bamfile):
+        mis_NM, soft_num, match_num, focus_len = count_alignments(cigar_stats(chunk))
+        same_ref = np.fromiter((not alignment.is_unmapped and alignment.reference_id == alignment.next_reference_id \
+            for alignment in chunk), dtype = bool, count = len(chunk))
+        passed = same_ref & (soft_num == 0) & (mis_NM <= options.max_nm)
+        match_num = match_num.tolist()
+        focus_len = focus_len.tolist()
+        for i in np.flatnonzero(passed).tolist():
+            alignment = chunk[i]
+            read_name = alignment.query_name.split("/")[0]
+            yield read_name, alignment.reference_name, match_num[i], focus_len[i]
 
 def check_score(dict, options, name, pair_dict):
     gene_dict = {}
@@ -85,29 +85,20 @@ class Each_read():
         self.len_dict = {}  # record total mapped length  
         self.read_name = ''   
 
-    def add_one_alignment(self, alignment):
+    def add_one_alignment(self, read_name, t_name, match_num, focus_len):
         """
-        given a alignment record,
+        given the scores of a filtered alignment record,
         save the mapping situations to the read's dicts.
         """
-        flag = True
-        if alignment.is_unmapped or alignment.reference_name != alignment.next_reference_name:
-            flag = False
-        t_name = alignment.reference_name
-
-        mis_NM, soft_num, match_num, focus_len = count_alignment(alignment)
-        if soft_num > 0 or mis_NM > options.max_nm:
-            flag = False
-        if flag:
-            self.read_name = alignment.query_name
-            if t_name not in self.dict.keys():
-                self.dict[t_name] = match_num#round(s,3)
-                self.len_dict[t_name] = focus_len
-                self.pair_dict[t_name] = 1
-            else:
-                self.dict[t_name] += match_num#round(s,3)
-                self.len_dict[t_name] += focus_len
-                self.pair_dict[t_name] += 1
+        self.read_name = read_name
+        if t_name not in self.dict.keys():
+            self.dict[t_name] = match_num#round(s,3)
+            self.len_dict[t_name] = focus_len
+            self.pair_dict[t_name] = 1
+        else:
+            self.dict[t_name] += match_num#round(s,3)
+            self.len_dict[t_name] += focus_len
+            self.pair_dict[t_name] += 1
     
     def assign(self):
         """
@@ -129,6 +120,25 @@ class Each_read():
             first_align = 'REMOVE'
         return first_align
 
+def get_read_name(line):
+    """
+    read name in the fastq header should be
+    @<read name> or @<read name>/1
+    """
+    raw_read_name = line.split()[0]
+    if re.search('/1',raw_read_name) or re.search('/2',raw_read_name):
+        read_name = raw_read_name[1:-2]
+    else:
+        read_name = raw_read_name[1:]
+    return read_name
+
+def open_fastq(file):
+    if file.split(".")[-1] == "gz":
+        f = gzip.open(file,'rt')
+    else:
+        f = open(file)
+    return f
+
 def assign_fastq(file, gene, index, assign_dict):
     """
     extract gene-specific reads from the raw read file,
@@ -141,18 +151,11 @@ def assign_fastq(file, gene, index, assign_dict):
     outfile = options.outdir + '/%s.R%s.fq'%(gene, index)
     out = open(outfile, 'w')
     flag = False
-    if file.split(".")[-1] == "gz":
-        f = gzip.open(file,'rt')
-    else:
-        f = open(file)
+    f = open_fastq(file)
     for line in f:
         line = line.strip()
         if i % 4 == 0:
-            raw_read_name = line.split()[0]
-            if re.search('/1',raw_read_name) or re.search('/2',raw_read_name):
-                read_name = raw_read_name[1:-2]
-            else:
-                read_name = raw_read_name[1:]
+            read_name = get_read_name(line)
             if read_name in assign_dict.keys() and assign_dict[read_name] == gene:
                 flag = True
                 num = 1
@@ -163,51 +166,246 @@ def assign_fastq(file, gene, index, assign_dict):
             if num == 4:
                 flag = False
         i += 1
+    f.close()
     out.close()
     os.system('gzip -f %s'%(outfile))
 
-def main():
-    print ('start assigning reads...')
+def demultiplex_fastq(file, index, assign_dict, name_file = None):
+    """
+    generate the gene-specific fastq files of all the genes
+    in one streaming pass of the raw read file,
+    the gzip writers of all genes stay open during the pass,
+    the read names come from the name index of uniq_read_name.py if given
+    """
+    out_dict = {}
+    for gene in gene_list:
+        outfile = options.outdir + '/%s.R%s.fq.gz'%(gene, index)
+        out_dict[gene] = gzip.open(outfile, 'wt', compresslevel = 6)
+    if name_file is not None:
+        names = open_fastq(name_file)
+    out = None
+    i = 0
+    f = open_fastq(file)
+    for line in f:
+        if i % 4 == 0:
+            if name_file is not None:
+                read_name = next(names)[:-1]
+            else:
+                read_name = get_read_name(line.strip())
+            if read_name in assign_dict:
+                out = out_dict.get(assign_dict[read_name])
+            else:
+                out = None
+        if out is not None:
+            out.write(line.strip() + '\n')
+        i += 1
+    f.close()
+    if name_file is not None:
+        names.close()
+    for gene in gene_list:
+        out_dict[gene].close()
+
+def is_name_grouped(bamfile):
+    """
+    the aligners output all the alignments of a read together,
+    only a coordinate-sorted bam breaks the grouping,
+    the header may be missing or wrong, so assign_streaming() still checks it
+    """
+    header = bamfile.header.to_dict()
+    sort_order = header.get('HD', {}).get('SO', 'unsorted')
+    return sort_order != 'coordinate'
+
+def record_assignment(read_name, assigned_locus, assign_dict, count_read_for_each_gene):
+    if assigned_locus == 'REMOVE':
+        return
+    assign_dict[read_name] = assigned_locus
+    if assigned_locus not in count_read_for_each_gene:
+        count_read_for_each_gene[assigned_locus] = 0
+    count_read_for_each_gene[assigned_locus] += 1
+
+def assign_in_memory(scores, assign_dict, count_read_for_each_gene):
+    """
+    keep the alignment scores of all the reads,
+    assign genes after the whole bam is read,
+    scores are the records of score_alignments() in the bam order
+    """
     read_dict = {} # record the aligment scores for each read
-    assign_dict = {} # record assigned gene for each read
+    # record alignment scores for all the read
+    for read_name, t_name, match_num, focus_len in scores:
+        if read_name not in read_dict:
+            read_dict[read_name] = Each_read()
+        read_dict[read_name].add_one_alignment(read_name, t_name, match_num, focus_len)
+
+    # assign genes for each read
+    for read_name in read_dict:
+        assigned_locus = read_dict[read_name].assign()
+        record_assignment(read_name, assigned_locus, assign_dict, count_read_for_each_gene)
+
+def assign_streaming(scores, assign_dict, count_read_for_each_gene):
+    """
+    for the name-grouped bam (unsorted output of novoalign or bowtie2),
+    assign the read once its last alignment arrives and drop its scores,
+    so the memory depends on the alignment num of a read, not the read num,
+    only the names of the assigned reads are kept,
+    return False once a read name reappears, i.e. the bam is not grouped by read name
+    """
+    finished_names = set()
+    read_name = None
+    each_read = None
+    for name, t_name, match_num, focus_len in scores:
+        if name != read_name:
+            if each_read is not None:
+                record_assignment(read_name, each_read.assign(), assign_dict, count_read_for_each_gene)
+                finished_names.add(read_name)
+            if name in finished_names:
+                print ('read %s reappears, the bam is not grouped by read name.'%(name))
+                return False
+            read_name = name
+            each_read = Each_read()
+        each_read.add_one_alignment(name, t_name, match_num, focus_len)
+    if each_read is not None:
+        record_assignment(read_name, each_read.assign(), assign_dict, count_read_for_each_gene)
+    return True
+
+def assign_bam():
+    """
+    assign the reads of the whole bam in this process,
+    return the assigned gene for each read and the read num of each gene
+    """
+    assign_dict = {}
+    count_read_for_each_gene = {}
     bamfile = pysam.AlignmentFile(options.bam, 'rb')
-    t0 = time.time()
+    if is_name_grouped(bamfile) and assign_streaming(score_alignments(bamfile), assign_dict, count_read_for_each_gene):
+        bamfile.close()
+        return assign_dict, count_read_for_each_gene
+    # not grouped, start over keeping the scores of all the reads
+    print ('assign reads in memory.')
+    bamfile.close()
+    assign_dict = {}
+    count_read_for_each_gene = {}
+    bamfile = pysam.AlignmentFile(options.bam, 'rb')
+    assign_in_memory(score_alignments(bamfile), assign_dict, count_read_for_each_gene)
+    bamfile.close()
+    return assign_dict, count_read_for_each_gene
 
-    # record alignment scores for all the read
+def init_worker(worker_options):
+    global options
+    options = worker_options
+
+def assign_batch(start, record_num, grouped):
+    """
+    score the record_num records from the virtual offset start,
+    a batch of a name-grouped bam holds whole reads, so it is assigned here,
+    otherwise the scores are returned to be assigned with the other batches
+    """
+    bamfile = pysam.AlignmentFile(options.bam, 'rb')
+    bamfile.seek(start)
+    scores = score_alignments(islice(bamfile, record_num))
+    if grouped:
+        result = ({}, {})
+        assign_streaming(scores, result[0], result[1])
+    else:
+        result = list(scores)
+    bamfile.close()
+    return result
+
+def split_bam(pool, grouped):
+    """
+    read the bam once and hand the batches of about BATCH_SIZE records to the workers,
+    a batch starts at the bgzf virtual offset of its first record and ends at
+    a read-name change, return the pending batches in the bam order,
+    or None if a read name reappears in the name-grouped bam
+    """
+    batches = []
+    finished_names = set()
+    read_name = None
+    bamfile = pysam.AlignmentFile(options.bam, 'rb')
+    start = offset = bamfile.tell()
+    record_num = 0
     for alignment in bamfile:
-        t_name = alignment.reference_name
-        alignment.query_name = alignment.query_name.split("/")[0]
-        read_name = alignment.query_name
-        # print (read_name)
-        if read_name not in read_dict.keys():
-            
-            new_read = Each_read()
-            read_dict[read_name] = new_read
-        read_dict[read_name].add_one_alignment(alignment)
+        name = alignment.query_name.split("/")[0]
+        if name != read_name:
+            if grouped and read_name is not None:
+                finished_names.add(read_name)
+                if name in finished_names:
+                    print ('read %s reappears, the bam is not grouped by read name.'%(name))
+                    bamfile.close()
+                    return None
+            if record_num >= BATCH_SIZE:
+                batches.append(pool.apply_async(assign_batch, (start, record_num, grouped)))
+                start = offset
+                record_num = 0
+            read_name = name
+        record_num += 1
+        offset = bamfile.tell()
+    if record_num > 0:
+        batches.append(pool.apply_async(assign_batch, (start, record_num, grouped)))
     bamfile.close()
-    t1 = time.time()
-    print ("read bam cost %s"%(t1 - t0))
+    return batches
 
+def assign_parallel(worker_num):
+    """
+    the workers score disjoint batches of the bam, so each record is scored once,
+    the batches are cut by the main process, which decodes the records once more
+    but does not score them, and the workers start while it reads on,
+    the results are merged in the bam order, same as assign_bam()
+    """
+    assign_dict = {}
     count_read_for_each_gene = {}
-    # assign genes for each read
-    for read_name in read_dict:
-        assigned_locus = read_dict[read_name].assign()
-        if assigned_locus == 'REMOVE':
-            continue
-        assign_dict[read_name] = assigned_locus
-        if assigned_locus not in count_read_for_each_gene:
-            count_read_for_each_gene[assigned_locus] = 0
-        count_read_for_each_gene[assigned_locus] += 1
+    bamfile = pysam.AlignmentFile(options.bam, 'rb')
+    grouped = is_name_grouped(bamfile)
+    bamfile.close()
+    pool = Pool(worker_num, initializer = init_worker, initargs = (options,))
+    batches = split_bam(pool, grouped) if grouped else None
+    if batches is not None:
+        for batch in batches:
+            batch_assign_dict, batch_count = batch.get()
+            assign_dict.update(batch_assign_dict)
+            for gene in batch_count:
+                if gene not in count_read_for_each_gene:
+                    count_read_for_each_gene[gene] = 0
+                count_read_for_each_gene[gene] += batch_count[gene]
+    else:
+        # not grouped, the scores of all the reads are assigned in this process
+        if grouped:
+            pool.terminate()
+            pool = Pool(worker_num, initializer = init_worker, initargs = (options,))
+        print ('assign reads in memory.')
+        batches = split_bam(pool, False)
+        assign_in_memory(chain.from_iterable(batch.get() for batch in batches), assign_dict, count_read_for_each_gene)
+    pool.close()
+    pool.join()
+    return assign_dict, count_read_for_each_gene
+
+def main():
+    print ('start assigning reads...')
+    t0 = time.time()
+    bamfile = pysam.AlignmentFile(options.bam, 'rb')
+    if is_name_grouped(bamfile):
+        print ('alignments are grouped by read name, assign reads in streaming.')
+    bamfile.close()
+
+    if options.threads > 1:
+        print ('assign reads with %s processes.'%(options.threads))
+        assign_dict, count_read_for_each_gene = assign_parallel(options.threads)
+    else:
+        assign_dict, count_read_for_each_gene = assign_bam()
+    t1 = time.time()
+    print ("read bam cost %s"%(t1 - t0))
  
     # generate gene-specific fastq
-    for gene in ['A', 'B', 'C', 'DPA1', 'DPB1', 'DQA1', 'DQB1', 'DRB1']:
+    for gene in gene_list:
         if gene in count_read_for_each_gene:
             read_num = count_read_for_each_gene[gene]
         else:
             read_num = 0
         print (f"read no. for {gene} is {read_num}.")
-        assign_fastq(options.fq1, gene, 1, assign_dict)
-        assign_fastq(options.fq2, gene, 2, assign_dict)
+        if options.single_pass != 1:
+            assign_fastq(options.fq1, gene, 1, assign_dict)
+            assign_fastq(options.fq2, gene, 2, assign_dict)
+    if options.single_pass == 1:
+        demultiplex_fastq(options.fq1, 1, assign_dict, options.names1)
+        demultiplex_fastq(options.fq2, 2, assign_dict, options.names2)
     t2 = time.time()
     print ("read assigment cost %s"%(t2 - t0))
 
@@ -223,6 +421,14 @@ if __name__ == "__main__":
     parser.add_argument('-nm', '--max_nm', help='MAX mismatch num', required=False, default = 2, type=int)
     parser.add_argument('-d', '--diff_score', help='The score for the best-matched gene must be at least this higher\
          than the second gene', required=True, default = 0.1, type=float)
+    parser.add_argument('-s', '--single_pass', help='Write the fastq of all genes in one streaming pass\
+         of each raw fastq [0|1], 0 means re-read the raw fastq for each gene', required=False, default = 1, type=int)
+    parser.add_argument('-j', '--threads', help='Number of worker processes for read assignment,\
+         the workers score disjoint batches of the bam', required=False, default = 1, type=int)
+    parser.add_argument('--names1', help='Read-name index of fq1 generated by uniq_read_name.py,\
+         skip parsing the fastq headers', required=False, default = None)
+    parser.add_argument('--names2', help='Read-name index of fq2 generated by uniq_read_name.py',\
+         required=False, default = None)
     options = parser.parse_args()
 
     main()
\ No newline at end of file
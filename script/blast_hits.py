@@ -0,0 +1,86 @@
+"""
+stream the hits of the tabular blast output (-outfmt 6 or 7) as typed records,
+and keep only the hits that can still reach the top of each query,
+instead of loading and sorting all the hits
+
+wangshuai, wshuai294@gmail.com
+"""
+
+from collections import namedtuple
+from itertools import groupby
+
+BLAST_FIELDS = ['qseqid', 'sseqid', 'pident', 'length', 'mismatch', 'gapopen',\
+    'qstart', 'qend', 'sstart', 'send', 'evalue', 'bitscore']
+FIELD_TYPES = [str, str, float, int, int, int, int, int, int, int, float, float]
+Blast_Hit = namedtuple('Blast_Hit', BLAST_FIELDS)
+
+def stream_records(tab_file):
+    # the fields of each line, the empty and comment lines are skipped
+    for line in open(tab_file):
+        array = line.strip().split()
+        if len(array) == 0 or array[0][0] == "#":
+            continue
+        yield array
+
+def stream_hits(blast_file):
+    # the typed hits of the default tabular columns
+    for array in stream_records(blast_file):
+        yield Blast_Hit(*[field_type(x) for field_type, x in zip(FIELD_TYPES, array)])
+
+def query_groups(records, query = lambda x: x[0]):
+    # the consecutive records of the same query, blast writes the hits query by query
+    for name, group in groupby(records, key = query):
+        yield name, list(group)
+
+def top_group(items, key):
+    """
+    the items with the max key, in their original order,
+    same as the leading run of sorted(items, key = key, reverse = True)
+    """
+    best = None
+    group = []
+    for item in items:
+        value = key(item)
+        if best is None or value > best:
+            best = value
+            group = [item]
+        elif value == best:
+            group.append(item)
+    return group
+
+class Running_Window():
+    """
+    keep the records within a relative cutoff of the max of any score,
+    (best - score(record)) / best <= cutoff, best is the running max of the score,
+    since best only grows, a dropped record would not pass at the end either,
+    the records are kept in their input order
+    """
+
+    def __init__(self, scores, cutoffs):
+        self.scores = scores
+        self.cutoffs = cutoffs
+        self.best = [None] * len(scores)
+        self.kept = []
+        self.compact_size = 1024
+
+    def in_window(self, record):
+        for score, cutoff, best in zip(self.scores, self.cutoffs, self.best):
+            if best is None or best <= 0:
+                return True # cannot prune with a non-positive max
+            if (best - score(record)) / best <= cutoff:
+                return True
+        return False
+
+    def add(self, record):
+        for i in range(len(self.scores)):
+            value = self.scores[i](record)
+            if self.best[i] is None or value > self.best[i]:
+                self.best[i] = value
+        if self.in_window(record):
+            self.kept.append(record)
+            if len(self.kept) >= self.compact_size:
+                self.kept = [x for x in self.kept if self.in_window(x)]
+                self.compact_size = max(1024, 2 * len(self.kept))
+
+    def records(self):
+        return [x for x in self.kept if self.in_window(x)]
@@ -0,0 +1,176 @@
+"""
+search the block-link combinations of exon typing without building them all,
+the two haps of each block are mapped to the exon database once,
+the mismatches of a combination are the sums over its blocks,
+so the best combinations are found by branch-and-bound over the block orientations
+
+the score here is a proxy of select.combination.pl, it leaves out the DRB1 bitscore,
+the population frequency filter and the blocks with the same seq on both haps,
+so it may miss the combination select.combination.pl would pick,
+up to MAX_ENUMERATION combinations, all of them still go to select.combination.pl,
+the search is only used above it, where the pipeline used to stop
+
+wangshuai, wshuai294@gmail.com
+"""
+
+import os
+import heapq
+import numpy as np
+from blast_hits import stream_hits
+
+MAX_ENUMERATION = 512 # up to this num, all the combinations are passed to select.combination.pl
+MAX_CANDIDATES = 16 # above it, the combinations shortlisted by the search
+
+def block_pieces(cons, vcf, mask_bed, gene, exon_intervals, block_intervals):
+    """
+    split the exons by the blocks, return [block index, [hap1 seq, hap2 seq]]
+    of each piece in the order of the haplotype sequence
+    """
+    pieces = []
+    for exon_start, exon_end in exon_intervals:
+        for b in range(len(block_intervals)):
+            start = max(exon_start, block_intervals[b][0])
+            end = min(exon_end, block_intervals[b][1])
+            if start > end:
+                continue
+            region = '%s:%s-%s'%(gene, max(start, 1), end)
+            pieces.append([b, cons.haplotypes(vcf, region, mask_bed)])
+    return pieces
+
+def link_hap(pieces, link, hap):
+    """
+    the sequence of the hap (0 or 1) when block b takes the orientation link[b]
+    """
+    return ''.join([seqs[hap ^ link[b]] for b, seqs in pieces])
+
+def link_index(link):
+    # the index of the combination in poss_link()
+    return sum([o << b for b, o in enumerate(link)])
+
+def block_seqs(pieces, block_num):
+    # the sequence of each hap in each block
+    seqs = [['', ''] for b in range(block_num)]
+    for b, hap_seqs in pieces:
+        for hap in range(2):
+            seqs[b][hap] += hap_seqs[hap]
+    return seqs
+
+def map_blocks(seqs, informative, db, outdir, threads):
+    """
+    map the two haps of the informative blocks to the exon database in one blastn run,
+    return the mismatch num and the aligned length of each block hap to each allele,
+    as (block, hap, allele) arrays, same counts as select.combination.pl
+    """
+    query = '%s/block.haps.fasta'%(outdir)
+    blast_out = '%s/block.haps.blast.out'%(outdir)
+    f = open(query, 'w')
+    for i in range(len(informative)):
+        for hap in range(2):
+            print ('>%s_%s\n%s'%(i, hap, seqs[informative[i]][hap]), file = f)
+    f.close()
+    os.system('blastn -query %s -out %s -db %s -outfmt 6 -num_threads %s -max_target_seqs 10000'%(query, blast_out, db, threads))
+    hits = {}
+    for hit in stream_hits(blast_out):
+        if hit.sseqid == "HLA:HLA10778":
+            continue
+        key = (hit.qseqid, hit.sseqid)
+        if key not in hits:
+            hits[key] = [0, 0]
+        hits[key][0] += hit.mismatch + hit.gapopen
+        hits[key][1] += hit.length - hit.gapopen
+    alleles = sorted(set([key[1] for key in hits]))
+    allele_index = {allele: j for j, allele in enumerate(alleles)}
+    # the unmapped block haps count as fully mismatched
+    mis = np.zeros((len(informative), 2, len(alleles)))
+    length = np.zeros((len(informative), 2, len(alleles)))
+    for i in range(len(informative)):
+        for hap in range(2):
+            mis[i][hap] = len(seqs[informative[i]][hap])
+            length[i][hap] = len(seqs[informative[i]][hap])
+    for (name, allele), (mismatch, aligned) in hits.items():
+        i, hap = [int(x) for x in name.split('_')]
+        mis[i][hap][allele_index[allele]] = mismatch
+        length[i][hap][allele_index[allele]] = aligned
+    return mis, length
+
+def hap_score(mis, length):
+    # the best identity score over the alleles
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        score = np.where(length > 0, 100 * (1 - mis / length), 0)
+    return score.max() if len(score) > 0 else 0
+
+class Block_Link_Search():
+    """
+    find the top_num combinations with the highest mean score of the two haps,
+    the orientation of the last block is fixed as poss_link() does
+    """
+
+    def __init__(self, mis, length, top_num):
+        self.mis = mis
+        self.length = length
+        self.top_num = top_num
+        self.block_num = len(mis)
+        # the bound of the blocks not assigned yet
+        self.rest_mis = np.zeros((self.block_num + 1, mis.shape[2]))
+        self.rest_length = np.zeros((self.block_num + 1, mis.shape[2]))
+        for b in range(self.block_num - 1, -1, -1):
+            self.rest_mis[b] = self.rest_mis[b+1] + mis[b].min(axis = 0)
+            self.rest_length[b] = self.rest_length[b+1] + length[b].max(axis = 0)
+        self.best = [] # min-heap of (score, order, link)
+        self.node_num = 0
+
+    def bound(self, b, hap_mis, hap_length):
+        return (hap_score(hap_mis[0] + self.rest_mis[b], hap_length[0] + self.rest_length[b]) + \
+            hap_score(hap_mis[1] + self.rest_mis[b], hap_length[1] + self.rest_length[b])) / 2
+
+    def extend(self, b, link, hap_mis, hap_length, o):
+        new_mis = [hap_mis[0] + self.mis[b][o], hap_mis[1] + self.mis[b][1-o]]
+        new_length = [hap_length[0] + self.length[b][o], hap_length[1] + self.length[b][1-o]]
+        return link + [o], new_mis, new_length
+
+    def branch(self, b, link, hap_mis, hap_length):
+        self.node_num += 1
+        if b == self.block_num:
+            score = self.bound(b, hap_mis, hap_length)
+            item = (score, -self.node_num, link)
+            if len(self.best) < self.top_num:
+                heapq.heappush(self.best, item)
+            elif score > self.best[0][0]:
+                heapq.heapreplace(self.best, item)
+            return
+        orientations = [0] if b == self.block_num - 1 else [0, 1]
+        children = []
+        for o in orientations:
+            child = self.extend(b, link, hap_mis, hap_length, o)
+            children.append([self.bound(b + 1, child[1], child[2])] + list(child))
+        # the more promising orientation first, so the bound prunes earlier
+        children = sorted(children, key = lambda x: -x[0])
+        for upper, new_link, new_mis, new_length in children:
+            if len(self.best) == self.top_num and upper <= self.best[0][0]:
+                continue
+            self.branch(b + 1, new_link, new_mis, new_length)
+
+    def search(self):
+        zero = np.zeros(self.mis.shape[2])
+        self.branch(0, [], [zero, zero], [zero, zero])
+        return sorted(self.best, key = lambda x: -x[0])
+
+def best_links(pieces, block_num, db, outdir, threads, top_num = MAX_CANDIDATES):
+    """
+    return the top_num block-link combinations in the order of poss_link(),
+    the blocks with the same sequence on both haps keep orientation 0
+    """
+    seqs = block_seqs(pieces, block_num)
+    informative = [b for b in range(block_num) if seqs[b][0] != seqs[b][1]]
+    if len(informative) == 0:
+        return [[0] * block_num]
+    mis, length = map_blocks(seqs, informative, db, outdir, threads)
+    search = Block_Link_Search(mis, length, top_num)
+    links = []
+    for score, order, informative_link in search.search():
+        link = [0] * block_num
+        for i in range(len(informative)):
+            link[informative[i]] = informative_link[i]
+        links.append(link)
+    print ("Searched %s nodes for %s informative blocks."%(search.node_num, len(informative)))
+    return sorted(links, key = link_index)
@@ -33,6 +33,7 @@ rm -f  $outdir/DRB1.bam*
 rm -f  $outdir/DRB1.hla.count
 rm -f  $outdir/extract.read.blast
 rm -rf  $outdir/tmp/
+rm -rf  $outdir/work/
 
 
 
@@ -0,0 +1,129 @@
+"""
+build the haplotype sequences in-process instead of
+samtools faidx | bcftools consensus -H, the reference is loaded once
+with pysam.FastaFile, the low-depth mask and the phased variants are
+applied in memory, and both haplotypes are returned at once
+
+same rules as bcftools consensus: the masked bases are replaced by N first,
+the variants overlapping the mask, overlapping an applied variant, or
+with a REF not matching the reference are skipped
+
+wangshuai, wshuai294@gmail.com
+"""
+
+import os
+import re
+import pysam
+from pysam import VariantFile
+
+LINE_WIDTH = 60 # the line width of samtools faidx, kept by bcftools consensus
+reference_dict = {} # (reference, mtime): the loaded Consensus
+
+def load_reference(ref):
+    """
+    return the Consensus of the reference, loaded once per process,
+    reloaded if the reference is rebuilt
+    """
+    key = (os.path.abspath(ref), os.path.getmtime(ref))
+    if key not in reference_dict:
+        reference_dict[key] = Consensus(ref)
+    return reference_dict[key]
+
+def parse_region(region):
+    """
+    chrom:start-end (1-based, inclusive) or chrom,
+    return the chrom, 0-based start and end (None for the chrom end)
+    """
+    match = re.match(r'^(.+):(\d+)-(\d+)$', region)
+    if match:
+        return match.group(1), int(match.group(2)) - 1, int(match.group(3))
+    return region, 0, None
+
+def write_fasta(f, name, seq):
+    # the same layout as bcftools consensus output
+    print ('>%s'%(name), file = f)
+    for i in range(0, len(seq), LINE_WIDTH):
+        print (seq[i:i+LINE_WIDTH], file = f)
+
+class Consensus():
+
+    def __init__(self, ref):
+        self.fasta = pysam.FastaFile(ref)
+        self.mask_dict = {} # (mask bed, mtime): {chrom: [[start, end]]}
+        self.vcf_dict = {} # vcf: [file stat, {chrom: [[pos, ref, alleles, GT]]}]
+
+    def read_mask(self, mask_bed):
+        key = (mask_bed, os.path.getmtime(mask_bed) if os.path.isfile(mask_bed) else None)
+        if key not in self.mask_dict:
+            mask = {}
+            if os.path.isfile(mask_bed):
+                for line in open(mask_bed):
+                    array = line.strip().split()
+                    if len(array) < 3 or array[0][0] == '#':
+                        continue
+                    if array[0] not in mask:
+                        mask[array[0]] = []
+                    mask[array[0]].append([int(array[1]), int(array[2])])
+            self.mask_dict[key] = mask
+        return self.mask_dict[key]
+
+    def read_vcf(self, vcf):
+        # the phased vcf is rewritten during the phasing, only reuse the records of the same file
+        stat = os.stat(vcf)
+        key = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        if vcf not in self.vcf_dict or self.vcf_dict[vcf][0] != key:
+            records = {}
+            in_vcf = VariantFile(vcf)
+            sample = list(in_vcf.header.samples)[0]
+            for record in in_vcf.fetch():
+                if record.chrom not in records:
+                    records[record.chrom] = []
+                geno = record.samples[sample]['GT']
+                records[record.chrom].append([record.pos - 1, record.ref, record.alleles, geno])
+            in_vcf.close()
+            self.vcf_dict[vcf] = [key, records]
+        return self.vcf_dict[vcf][1]
+
+    def haplotypes(self, vcf, region, mask_bed = None, haps = (1, 2)):
+        """
+        return the sequence of each hap in the region,
+        hap i takes the i-th allele of the GT, regardless of phasing
+        """
+        chrom, start, end = parse_region(region)
+        if end is None:
+            end = self.fasta.get_reference_length(chrom)
+        seq = self.fasta.fetch(chrom, start, end)
+        end = start + len(seq)
+        mask = []
+        if mask_bed is not None:
+            for mask_start, mask_end in self.read_mask(mask_bed).get(chrom, []):
+                mask_start, mask_end = max(mask_start, start), min(mask_end, end)
+                if mask_start < mask_end:
+                    mask.append([mask_start, mask_end])
+                    seq = seq[:mask_start-start] + 'N'*(mask_end-mask_start) + seq[mask_end-start:]
+        hap_seqs = []
+        for hap in haps:
+            pieces = []
+            last = start # the reference is copied up to here
+            for pos, ref, alleles, geno in self.read_vcf(vcf).get(chrom, []):
+                if pos < start or pos + len(ref) > end:
+                    continue
+                if hap > len(geno) or geno[hap-1] is None or geno[hap-1] == 0:
+                    continue
+                allele = alleles[geno[hap-1]]
+                if allele == '*' or allele[0] == '<':
+                    continue
+                if any([pos < mask_end and pos + len(ref) > mask_start for mask_start, mask_end in mask]):
+                    continue
+                if pos < last:
+                    print ('The site %s:%s overlaps with another variant, skipping.'%(chrom, pos+1))
+                    continue
+                if seq[pos-start:pos-start+len(ref)].upper() != ref.upper():
+                    print ('The fasta sequence does not match the REF allele at %s:%s, skipping.'%(chrom, pos+1))
+                    continue
+                pieces.append(seq[last-start:pos-start])
+                pieces.append(allele)
+                last = pos + len(ref)
+            pieces.append(seq[last-start:])
+            hap_seqs.append(''.join(pieces))
+        return hap_seqs
@@ -0,0 +1,125 @@
+"""
+compile the annotation tables of the database (hla_nom_g.txt,
+HLA_FREQ_HLA_I_II.txt and Allelelist.txt) into one pickle bundle
+tagged with the IMGT/HLA version, build it once per IMGT release:
+
+python3 db_bundle.py <db folder>
+
+the bundle is used only if it was built from the current text files,
+otherwise the tables are parsed from the text files as before
+
+wangshuai, wshuai294@gmail.com
+"""
+
+import os
+import re
+import sys
+import pickle
+
+BUNDLE_FORMAT = 1 # bump it if the layout of the tables changes
+SOURCE_FILES = {'g_group': 'hla_nom_g.txt', 'freq': 'HLA_FREQ_HLA_I_II.txt', 'allele_list': 'Allelelist.txt'}
+bundle_dict = {} # db: the tables loaded in this process
+
+def parse_version(db):
+    # the version line in the header of the G group file, None if not found
+    for line in open(f"{db}/HLA/{SOURCE_FILES['g_group']}"):
+        if line[0] != "#":
+            break
+        if re.search("# version:", line):
+            return line
+    return None
+
+def parse_G_annotation(db):
+    # allele: G group, with ":" replaced by "_"
+    G_annotation_dict = {}
+    for line in open(f"{db}/HLA/{SOURCE_FILES['g_group']}"):
+        if line[0] == "#":
+            continue
+        line = re.sub(":","_",line)
+        array = line.strip().split(";")
+        gene = array[0][:-1]
+        if len(array[-1]) == 0:
+            g_name = gene + "_" + array[-2]
+            G_annotation_dict[g_name] = g_name
+        else:
+            g_name = gene + "_" + array[-1]
+            alleles = array[-2].split("/")
+            for each in alleles:
+                each = gene + "_" + each
+                G_annotation_dict[each] = g_name
+    return G_annotation_dict
+
+def parse_freq(db):
+    # [two-field allele, Caucasian, Black, Asian] of each line, the frequencies are kept as strings
+    rows = []
+    with open(f"{db}/HLA/{SOURCE_FILES['freq']}", "r") as fin:
+        next(fin)
+        for line in fin:
+            rows.append(line.strip().split())
+    return rows
+
+def parse_allele_list(db):
+    # AlleleID: Allele
+    allele_list = {}
+    for line in open(f"{db}/HLA/{SOURCE_FILES['allele_list']}"):
+        if line[0] == "#" or line.startswith("AlleleID"):
+            continue
+        array = line.strip().split(",")
+        if len(array) >= 2:
+            allele_list[array[0]] = array[1]
+    return allele_list
+
+TABLE_PARSERS = {'version': parse_version, 'G_annotation': parse_G_annotation, 'freq': parse_freq,\
+    'allele_list': parse_allele_list}
+
+def bundle_file(db):
+    return f"{db}/HLA/annotation_tables.pkl"
+
+def source_stamp(db):
+    # the size and mtime of the text files, to tell whether the bundle is up to date
+    stamp = {}
+    for name, file in SOURCE_FILES.items():
+        path = f"{db}/HLA/{file}"
+        stamp[name] = (os.path.getsize(path), os.path.getmtime(path)) if os.path.isfile(path) else None
+    return stamp
+
+def build_bundle(db):
+    tables = {name: parser(db) for name, parser in TABLE_PARSERS.items()}
+    bundle = {'format': BUNDLE_FORMAT, 'stamp': source_stamp(db), 'tables': tables}
+    tmp_file = bundle_file(db) + ".%s.tmp"%(os.getpid())
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(bundle, f, protocol = pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, bundle_file(db))
+    version = re.sub("# version:", "", str(tables['version'])).strip()
+    print ("The annotation tables of %s are saved in %s."%(version, bundle_file(db)))
+
+def load_tables(db):
+    # the tables of the bundle if it is up to date, else an empty dict to be filled by the parsers
+    db = os.path.abspath(db)
+    if db not in bundle_dict:
+        tables = {}
+        if os.path.isfile(bundle_file(db)):
+            try:
+                with open(bundle_file(db), 'rb') as f:
+                    bundle = pickle.load(f)
+                if bundle['format'] == BUNDLE_FORMAT and bundle['stamp'] == source_stamp(db):
+                    tables = bundle['tables']
+                else:
+                    print ("The annotation bundle is outdated, rebuild it by python3 db_bundle.py %s."%(db))
+            except Exception as error:
+                print ("Fail to load the annotation bundle: %s"%(error))
+        bundle_dict[db] = tables
+    return bundle_dict[db]
+
+def load_table(db, name):
+    """
+    the table (version, G_annotation, freq or allele_list) of the db,
+    parsed once per process, do not modify it
+    """
+    tables = load_tables(db)
+    if name not in tables:
+        tables[name] = TABLE_PARSERS[name](db)
+    return tables[name]
+
+if __name__ == "__main__":
+    build_bundle(sys.argv[1])
@@ -0,0 +1,106 @@
+"""
+the read-to-genotype matrix of the fragments,
+each read name gets an integer ID, the (variant index, allele) entries
+of all the reads are kept in CSR arrays with one mapping quality per read,
+so no per-read dict is needed at WES/WGS depth
+
+wangshuai, wshuai294@gmail.com
+"""
+
+import numpy as np
+from array import array
+
+class Fragment_Matrix():
+
+    def __init__(self):
+        self.read_names = []
+        self.read_id = {} # read name: read ID
+        self.quality = array('i')
+        self.first_locus = array('i') # the first variant overlapped by the alignments of the read
+        self.rows = array('i')
+        self.loci = array('i')
+        self.alleles = array('b')
+        self.indptr = None
+
+    def add_alignment(self, read_name, mapping_quality, first_locus):
+        """
+        return the ID of the read, the mapping quality is taken from the
+        first alignment seen at the first overlapped variant
+        """
+        if read_name not in self.read_id:
+            self.read_id[read_name] = len(self.read_names)
+            self.read_names.append(read_name)
+            self.quality.append(mapping_quality)
+            self.first_locus.append(first_locus)
+        read_id = self.read_id[read_name]
+        if first_locus < self.first_locus[read_id]:
+            self.first_locus[read_id] = first_locus
+            self.quality[read_id] = mapping_quality
+        return read_id
+
+    def add_allele(self, read_id, locus, allele):
+        self.rows.append(read_id)
+        self.loci.append(locus)
+        self.alleles.append(allele)
+
+    def build(self):
+        """
+        sort the entries by read and variant into CSR arrays,
+        if the alignments of a read disagree at a variant, the alt allele is kept
+        """
+        rows = np.frombuffer(self.rows, dtype = np.intc) if len(self.rows) > 0 else np.zeros(0, dtype = np.intc)
+        loci = np.frombuffer(self.loci, dtype = np.intc) if len(self.loci) > 0 else np.zeros(0, dtype = np.intc)
+        alleles = np.frombuffer(self.alleles, dtype = np.int8) if len(self.alleles) > 0 else np.zeros(0, dtype = np.int8)
+        order = np.lexsort((loci, rows))
+        rows, loci, alleles = rows[order], loci[order], alleles[order]
+        if len(rows) > 0:
+            first = np.ones(len(rows), dtype = bool)
+            first[1:] = (rows[1:] != rows[:-1]) | (loci[1:] != loci[:-1])
+            starts = np.flatnonzero(first)
+            alleles = np.maximum.reduceat(alleles, starts)
+            rows, loci = rows[starts], loci[starts]
+        self.indptr = np.zeros(len(self.read_names) + 1, dtype = np.int64)
+        np.cumsum(np.bincount(rows, minlength = len(self.read_names)), out = self.indptr[1:])
+        self.loci = loci
+        self.alleles = alleles
+        self.rows = None
+
+    def write_hairs(self, f, new_formate, min_loci = 2):
+        """
+        print the reads covering at least min_loci variants in the HAIRs format of SpecHap,
+        consecutive variants are merged into one block
+        """
+        if self.indptr is None:
+            self.build()
+        support_num = np.diff(self.indptr)
+        new_block = np.ones(len(self.loci), dtype = bool)
+        new_block[1:] = np.diff(self.loci) != 1
+        new_block[self.indptr[:-1][support_num > 0]] = True
+        for read_id in np.flatnonzero(support_num >= min_loci).tolist():
+            start, end = int(self.indptr[read_id]), int(self.indptr[read_id + 1])
+            loci = self.loci[start:end].tolist()
+            alleles = self.alleles[start:end].tolist()
+            blocks = []
+            for locus, allele, block_start in zip(loci, alleles, new_block[start:end].tolist()):
+                if block_start:
+                    blocks.append([str(locus), []])
+                blocks[-1][1].append(str(allele))
+            genotype = ''.join([' %s %s'%(locus, ''.join(block)) for locus, block in blocks])
+            signal = "?" * (end - start)
+            read_name = self.read_names[read_id]
+            if new_formate:
+                record = f"{len(blocks)} {read_name} 1 -1 -1 {genotype} {signal} {self.quality[read_id]}"
+            else:
+                record = f"{len(blocks)} {read_name}{genotype} {signal} {self.quality[read_id]}"
+            print (record, file = f)
+
+def imbalance_edges(beta_set):
+    """
+    the linkage weights of the neighboring variants from the allele frequencies,
+    log ratio of the same-phase and the reverse-phase support
+    """
+    beta = np.array(beta_set, dtype = float).reshape(-1, 2)
+    same = np.maximum(beta[:-1, 0] * beta[1:, 0], beta[:-1, 1] * beta[1:, 1])
+    reverse = np.maximum(beta[:-1, 0] * beta[1:, 1], beta[:-1, 1] * beta[1:, 0])
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return np.log(same / reverse), np.log(reverse / same)
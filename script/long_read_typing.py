@@ -9,6 +9,7 @@ import pysam
 import gzip
 import argparse
 from downsample_bam import main
+from alignment_score import iter_chunks, cigar_stats, mismatch_rates, BAM_CMATCH
 
 interval_dict = {"A":"HLA_A:1000-4503", "B":"HLA_B:1000-5081","C": "HLA_C:1000-5304","DPA1":"HLA_DPA1:1000-10775",\
     "DPB1":"HLA_DPB1:1000-12468","DQA1":"HLA_DQA1:1000-7492","DQB1":"HLA_DQB1:1000-8480","DRB1":"HLA_DRB1:1000-12229" }
@@ -18,26 +19,15 @@ gene_list = ['A', 'B', 'C', 'DPA1', 'DPB1', 'DQA1', 'DQB1', 'DRB1']
 
 class Read_Obj():
     # for each alignment record, extract information (identity, gene name)
-    def __init__(self, read):
-        mis_NM = 0
-        for ta in read.get_tags():
-            if ta[0] == 'NM':
-                mis_NM = ta[1]  
-
-        self.match_num = 0        
-        for ci in read.cigar:
-            if ci[0] == 0:
-                self.match_num += ci[1]
-            # if ci[0] == 0 or ci[0] == 1 or ci[0] == 2:
-            #     self.match_num += ci[1]
-            # if ci[0] == 1 or ci[0] == 2:
-            #     mis_NM += ci[1]
+    def __init__(self, read, match_num, mismatch_rate):
+        # match_num and mismatch_rate are scored in bulk by alignment_score
+        self.match_num = match_num
         # print (read.query_name, read.reference_name, self.read_length, mis_NM)   
         # self.read_length = len(read.query_sequence) 
 
         self.read_name = read.query_name
         self.allele_name = read.reference_name
-        self.mismatch_rate = round(float(mis_NM)/self.match_num, 6)
+        self.mismatch_rate = mismatch_rate
         self.match_rate = 1 - self.mismatch_rate
 
         # if self.match_num < 500:
@@ -147,13 +137,15 @@ class Pacbio_Binning():
     def read_bam(self):
         # observe each read, assign it to gene based on alignment records
         scor = Score_Obj()
-        for read in self.bamfile:
-            if read.is_unmapped:
-                continue
-            # print (read)
-            read_obj = Read_Obj(read)
-            scor.add_read(read_obj)
-            # print (read_obj.read_name, read_obj.mismatch_rate, read_obj.allele_name )
+        mapped_reads = (read for read in self.bamfile if not read.is_unmapped)
+        for chunk in iter_chunks(mapped_reads):
+            stats = cigar_stats(chunk)
+            match_nums = stats[:, BAM_CMATCH].tolist()
+            rates = mismatch_rates(stats)
+            for read, match_num, mismatch_rate in zip(chunk, match_nums, rates):
+                read_obj = Read_Obj(read, match_num, mismatch_rate)
+                scor.add_read(read_obj)
+                # print (read_obj.read_name, read_obj.mismatch_rate, read_obj.allele_name )
         read_loci = scor.assign(self.assign_file)
         for gene in gene_list:
             self.filter_fq(gene, read_loci)
@@ -3,20 +3,84 @@ Link the unlinked blocks by mapping them to the database
 regard each sub-haplotype in the phase block as a node
 construct the linkage graph to link blocks
 
+the graph is kept as a scipy.sparse matrix, each connected component
+is phased by its own Fiedler vector, solved by dense eigh for the small
+graphs, or LOBPCG, and shift-invert eigsh if LOBPCG does not converge
+
 wangshuai, wshuai294@gmail.com
 """
 
 import numpy as np
-from scipy.sparse.linalg import eigsh 
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from scipy.sparse.linalg import eigsh, lobpcg, ArpackNoConvergence
 import sys
 import os
+import time
+import warnings
+
+DENSE_NODE_NUM = 200 # the graphs with no more nodes are solved by dense eigh
+
+def laplacian(mat):
+    mat = sparse.csr_matrix(mat)
+    degree = np.asarray(mat.sum(axis = 0)).ravel()
+    return sparse.diags(degree) - mat, degree
 
 def get_fiedler_vec(mat):
-    D = np.diag(np.sum(mat, axis= 0))
-    L = np.matrix(D - mat)
-    vals, vecs = eigsh(L, k=2, which='SM')
-    fiedler_vec = vecs[:,[1]]
-    return fiedler_vec
+    """
+    the eigenvector of the second smallest eigenvalue of the Laplacian,
+    the graph should be connected, or the vector is not unique
+    """
+    L, degree = laplacian(mat)
+    node_num = L.shape[0]
+    if node_num <= DENSE_NODE_NUM:
+        vals, vecs = np.linalg.eigh(L.toarray())
+        return vecs[:,1]
+    # search the vectors orthogonal to the constant one, with the Jacobi preconditioner
+    X = np.random.RandomState(0).rand(node_num, 2)
+    constant = np.ones((node_num, 1))
+    M = sparse.diags(1 / degree)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        vals, vecs = lobpcg(L, X, Y = constant, M = M, largest = False, tol = 1e-8, maxiter = 1000)
+    fiedler_vec = vecs[:,np.argmin(vals)]
+    residual = np.linalg.norm(L @ fiedler_vec - vals.min() * fiedler_vec)
+    if residual <= 1e-4 * max(degree.max(), 1):
+        return fiedler_vec
+    # L is singular, shift below 0 so that it can be factorized
+    sigma = -1e-3 * max(degree.max(), 1)
+    vals, vecs = eigsh(L.tocsc(), k = 2, sigma = sigma, which = 'LM')
+    return vecs[:,np.argsort(vals)[1]]
+
+def phase_components(mat, locus_num):
+    """
+    phase the blocks in each connected component of the block graph,
+    the first block of each component keeps hap 0, since the components
+    are not linked, their relative phase is unknown
+    """
+    mat = sparse.csr_matrix(mat)
+    hapotype = [0] * locus_num
+    # the blocks are linked if any of their sub-haplotypes are linked
+    pair = sparse.kron(sparse.identity(locus_num), np.ones((1, 2)), format = 'csr')
+    block_mat = pair @ mat @ pair.T
+    comp_num, block_labels = connected_components(block_mat, directed = False)
+    for comp in range(comp_num):
+        blocks = np.flatnonzero(block_labels == comp)
+        if len(blocks) == 1:
+            continue
+        nodes = np.ravel(np.column_stack((2*blocks, 2*blocks+1)))
+        sub_mat = mat[nodes][:,nodes]
+        node_num, node_labels = connected_components(sub_mat, directed = False)
+        if node_num == 2:
+            # only 00/11 or 01/10 links are supported, the two haps are two separate components
+            hap = node_labels[0::2] != node_labels[0]
+        else:
+            fiedler_vec = get_fiedler_vec(sub_mat)
+            hap = get_hap(fiedler_vec)
+            hap = np.array(hap) != hap[0]
+        for i in range(len(blocks)):
+            hapotype[blocks[i]] = int(hap[i])
+    return hapotype
 
 def constr_graph_freq(freqs): # construct the linkage graph with the allele frequencies at each locus.
     locus_num = len(freqs)
@@ -50,7 +114,7 @@ def get_hap(fiedler_vec):
 def constr_graph(score_file, block_phase_file):
     frag_index = {}
     frag_list = []
-    index = 0
+    edges = {} # (frag1 index, frag2 index): [score1, score2]
     f = open(score_file)
     for line in f:
         line = line.strip()
@@ -59,33 +123,10 @@ def constr_graph(score_file, block_phase_file):
         if line[0] == '#':
             continue
         array = line.split()
-        frag1 = array[0]
-        frag2 = array[1]
-        if frag1 not in frag_index:
-            frag_index[frag1] = index
-            frag_list.append(frag1)
-            index += 1
-        if frag2 not in frag_index:
-            frag_index[frag2] = index
-            frag_list.append(frag2)
-            index += 1
-    f.close()
-    locus_num = len(frag_index)
-    if locus_num == 0:
-        os.system(":> %s"%(block_phase_file))
-        return 0
-    mat = np.zeros((2*locus_num, 2*locus_num))
-
-    f = open(score_file)
-    for line in f:
-        line = line.strip()
-        if line == '':
-            continue
-        if line[0] == '#':
-            continue
-        array = line.split()
-        frag1 = array[0]
-        frag2 = array[1]
+        for frag in array[:2]:
+            if frag not in frag_index:
+                frag_index[frag] = len(frag_list)
+                frag_list.append(frag)
         if len(array) < 3:
             score1 = 0
             score2 = 0
@@ -93,27 +134,81 @@ def constr_graph(score_file, block_phase_file):
             new_array = array[2].split(";")
             score1 = float(new_array[0]) # 00 and 11
             score2 = float(new_array[1]) # 01 and 10
-        frag1_index = frag_index[frag1]
-        frag2_index = frag_index[frag2]
-
-        mat[2*frag1_index][2*frag2_index] = score1
-        mat[2*frag1_index+1][2*frag2_index+1] = score1
-        mat[2*frag1_index+1][2*frag2_index] = score2
-        mat[2*frag1_index][2*frag2_index+1] = score2
-
-        mat[2*frag2_index][2*frag1_index] = score1
-        mat[2*frag2_index+1][2*frag1_index+1] = score1
-        mat[2*frag2_index+1][2*frag1_index] = score2
-        mat[2*frag2_index][2*frag1_index+1] = score2
-    # print ("block linkage graph:\n", mat)
+        edges[(frag_index[array[0]], frag_index[array[1]])] = [score1, score2]
     f.close()
-    
-    fiedler_vec = get_fiedler_vec(mat)
-    hapotype = get_hap(fiedler_vec)
-    # print ("fiedler_vec:\n", fiedler_vec, hapotype)
+    locus_num = len(frag_index)
+    if locus_num == 0:
+        os.system(":> %s"%(block_phase_file))
+        return 0
+    mat = edge_matrix(edges, locus_num)
+    # print ("block linkage graph:\n", mat)
+    hapotype = phase_components(mat, locus_num)
     output(frag_list, hapotype, block_phase_file)
     # print (frag_list)
 
+def edge_matrix(edges, locus_num):
+    """
+    the symmetric weight matrix of the sub-haplotypes,
+    node 2*i and 2*i+1 are the two haps of block i
+    """
+    rows, cols, data = [], [], []
+    for (i, j), (score1, score2) in edges.items():
+        if i == j:
+            continue
+        for x in range(2):
+            for y in range(2):
+                score = score1 if x == y else score2
+                rows += [2*i+x, 2*j+y]
+                cols += [2*j+y, 2*i+x]
+                data += [score, score]
+    mat = sparse.coo_matrix((data, (rows, cols)), shape = (2*locus_num, 2*locus_num)).tocsr()
+    mat.eliminate_zeros()
+    return mat
+
+def synthetic_edges(locus_num, link_num, noise, rand):
+    """
+    a random block graph, each block links link_num random others,
+    the score of the true phase is higher on average
+    """
+    truth = rand.randint(0, 2, locus_num)
+    edges = {}
+    for i in range(locus_num):
+        for j in rand.choice(locus_num, min(link_num, locus_num), replace = False):
+            if i == j:
+                continue
+            true_score, false_score = 100 * rand.rand() + 100, 100 * rand.rand() * noise
+            if truth[i] == truth[j]:
+                edges[(min(i, j), max(i, j))] = [true_score, false_score]
+            else:
+                edges[(min(i, j), max(i, j))] = [false_score, true_score]
+    return truth, edges
+
+def benchmark():
+    """
+    time the solver on synthetic block graphs,
+    with the dense eigsh(which='SM') of the former version for the small ones
+    """
+    rand = np.random.RandomState(1)
+    print ("blocks\tedges\tsolver_s\tdense_SM_s\tphase_accuracy")
+    for locus_num in [10, 50, 100, 500, 2000]:
+        truth, edges = synthetic_edges(locus_num, 5, 0.5, rand)
+        mat = edge_matrix(edges, locus_num)
+        t0 = time.time()
+        hapotype = phase_components(mat, locus_num)
+        cost = time.time() - t0
+        dense_cost = 'NA'
+        if locus_num <= 500:
+            t0 = time.time()
+            dense = mat.toarray()
+            L = np.matrix(np.diag(np.sum(dense, axis = 0)) - dense)
+            try:
+                eigsh(L, k = 2, which = 'SM')
+                dense_cost = '%.3f'%(time.time() - t0)
+            except ArpackNoConvergence:
+                dense_cost = 'no_convergence'
+        same = np.mean(np.array(hapotype) == truth)
+        print (locus_num, len(edges), '%.3f'%(cost), dense_cost, '%.3f'%(max(same, 1 - same)), sep = "\t")
+
 def output(frag_list, hapotype, block_phase_file):
     f = open(block_phase_file, 'w')
     print ("#gene\t start\t end\t hap1\t hap2\t", file = f)
@@ -130,6 +225,9 @@ def output(frag_list, hapotype, block_phase_file):
 if __name__ == "__main__":
     # score_file = "/mnt/d/HLAPro_backup/HLAPro/example/whole/output/HG00118/HLA_DQB1_break_points_score.txt"
     # block_phase_file = "/mnt/d/HLAPro_backup/HLAPro/example/whole/output/HG00118/HLA_DQB1_break_points_phased.txt"
+    if sys.argv[1] == "--benchmark":
+        benchmark()
+        sys.exit(0)
     score_file = sys.argv[1]
     block_phase_file = sys.argv[2]
     constr_graph(score_file, block_phase_file)
@@ -15,6 +15,13 @@ import pysam
 import sys
 from pysam import VariantFile
 import pickle
+import hashlib
+import shutil
+from collections import Counter
+from allele_support import Allele_Support, sweep_reads, query_ref_map
+from fragment_matrix import Fragment_Matrix, imbalance_edges
+from consensus import load_reference, write_fasta
+from block_link import MAX_ENUMERATION, block_pieces, link_hap, best_links
 
 def str2bool(v):
     if v.lower() in ('yes', 'true', 't', 'y', '1'):
@@ -71,6 +78,10 @@ optional.add_argument("--use_database",help="Whether use database to link blocks
 optional.add_argument("--trio",help="The trio infromation; give sample names in the order of child:mother:father.\
  Example: NA12878:NA12891:NA12892. The order of mother and father can be ambiguous.",dest='trio',metavar='', default="None",type=str)
 optional.add_argument("--db", type=str, help="db dir.", metavar="\b", default=sys.path[0] + "/../db/")
+optional.add_argument("--index_cache",help="The dir to cache the bwa index of the insertion-augmented reference,\
+ the 16 most recently used indexes are kept, default is <outdir>/index_cache.",dest='index_cache',metavar='',default=None, type=str)
+optional.add_argument("--workdir",help="The dir for the intermediate files of this gene, give each gene its own\
+ dir to phase genes in parallel, default is the output directory.",dest='workdir',metavar='',default=None, type=str)
 parser._action_groups.append(optional)
 args = parser.parse_args()
 
@@ -125,7 +136,9 @@ def read_vcf(vcffile,outdir,snp_dp,bamfile,indel_len,gene,freq_bias,\
     snp_index = 1
     snp_index_dict = {}
     record_read_quality ={}
-    pysam.index(bamfile)
+    # the bam is shared by all genes, only index it if the index is missing or outdated
+    if not os.path.isfile(bamfile + '.bai') or os.path.getmtime(bamfile + '.bai') < os.path.getmtime(bamfile):
+        pysam.index(bamfile)
     samfile = pysam.AlignmentFile(bamfile, "rb")
     if not os.path.exists(outdir):
         os.system('mkdir '+outdir)
@@ -133,6 +146,7 @@ def read_vcf(vcffile,outdir,snp_dp,bamfile,indel_len,gene,freq_bias,\
     md_vcf = VariantFile(gene_vcf,'w',header=in_vcf.header)
     sample = list(in_vcf.header.samples)[0]
     snp_list, beta_set, allele_set = [], [], []
+    records = [] # the kept records with the genotype and the variant for the reads
     for record in in_vcf.fetch():
         if 'DP' not in record.info.keys() or record.info['DP'] <1:
             continue
@@ -202,15 +216,20 @@ def read_vcf(vcffile,outdir,snp_dp,bamfile,indel_len,gene,freq_bias,\
 
         snp_index_dict[record.pos] = snp_index
         snp_index += 1
-
-        # if the variant is in deletion region, get consensus haplotype
-        if if_in_deletion(record.pos, deletion_region) and geno != (1,1,1):
+        snp = None
+        if geno != (1,1,1):
             if geno == (1,1,2) or geno == (1,2,2):                
                 snp = [record.chrom,record.pos,record.alts[0],record.alts[1],record.ref]
             else:
                 snp=[record.chrom,record.pos,record.ref,record.alts[0],record.ref]
+        records.append([record, geno, snp])
 
-            reads_list = reads_support(samfile, snp,record_read_quality)
+    # find the supporting reads of all the variants in one pass of the bam
+    support = Allele_Support(samfile, [snp for record, geno, snp in records if snp is not None])
+    for record, geno, snp in records:
+        # if the variant is in deletion region, get consensus haplotype
+        if if_in_deletion(record.pos, deletion_region) and geno != (1,1,1):
+            reads_list = reads_support(support, snp,record_read_quality)
             allele_dp = [len(reads_list[0]), len(reads_list[1])]
             new_dp=sum(allele_dp)
             if new_dp == 0:
@@ -238,12 +257,7 @@ def read_vcf(vcffile,outdir,snp_dp,bamfile,indel_len,gene,freq_bias,\
             record.samples[sample].phased=True
     
         else:
-            if geno == (1,1,2) or geno == (1,2,2):                
-                snp = [record.chrom,record.pos,record.alts[0],record.alts[1],record.ref]
-            else:
-                snp=[record.chrom,record.pos,record.ref,record.alts[0],record.ref]
-
-            reads_list,record_read_quality = reads_support(samfile, snp, record_read_quality)
+            reads_list,record_read_quality = reads_support(support, snp, record_read_quality)
             allele_dp = [len(reads_list[0]), len(reads_list[1])]
             new_dp = sum(allele_dp)
             # print (record, allele_dp)
@@ -294,66 +308,23 @@ def freq_output(outdir, gene, fresh_alpha, hete_var_num):
     # print ("# Frequency inference is more reliable with more heterozygotes variants.",file=ra_file)
     ra_file.close()
         
-def reads_support(samfile,first,record_read_quality):  
+def reads_support(support,first,record_read_quality):  
     """
-    Input: Bam file, hete variant
+    Input: the allele support of the hete variants, hete variant
     Output: the reads support each allele of the variant 
     """ 
-    reads_list=[]
-    allele_num=len(first[3])+1
-    for i in range(allele_num):
-        reads_list.append([])
-    num=0
-    for read in samfile.fetch(str(first[0]),int(first[1])-1,int(first[1])):
-        record_read_quality[read.query_name] = read.mapping_quality
-        if int(first[1])-1 in read.get_reference_positions(full_length=True) and read.mapping_quality >1:   
-            
-            reads_index=read.get_reference_positions(full_length=True).index(int(first[1])-1)
-            if first[2][0] != first[3][0]:
-                #if the first allele is not same for indel alleles, we can just focus on the first locus 
-                if read.query_sequence[reads_index] == first[2][0]:
-                    reads_list[0].append(read.query_name)
-                elif read.query_sequence[reads_index] == first[3][0]:
-                    reads_list[1].append(read.query_name)
-            else:  
-                index_list=[]
-                true_ref=first[4]
-                for i in range(len(true_ref)):
-                #for i in range(len(first[3])):
-                    position=first[1]+i
-                    point_flag=isin(position-1,read.get_reference_positions(full_length=True))
-                    if point_flag:
-                        position_index=read.get_reference_positions(full_length=True).index(position-1)
-                        index_list.append(position_index)
-                allele_list=read.query_sequence[index_list[0]:index_list[-1]+1].upper()
-                ##########for the case that ref is short than alt.#########
-                if index_list[-1]+1 < len(read.get_reference_positions(full_length=True)) and len(true_ref) < len(first[2])\
-                     and len(true_ref) < len(first[3]) and read.get_reference_positions(full_length=True)[index_list[-1]+1] == None:
-                    j = 0
-                    # print ('#####', first, allele_list)
-                    while index_list[-1]+1+j <  len(read.get_reference_positions(full_length=True)):
-                        tag = read.get_reference_positions(full_length=True)[index_list[-1]+1+j]
-                        # print (first, tag, type(tag))
-                        if read.get_reference_positions(full_length=True)[index_list[-1]+1+j] == None:
-                            allele_list+=read.query_sequence[index_list[-1]+1+j]
-                        else:
-                            break
-                        j += 1   
-                    # print (first, allele_list)
-                ##########for the case that ref is short than alt.#########             
-                if allele_list == first[2]:
-                    reads_list[0].append(read.query_name)
-                elif allele_list == first[3]:
-                    reads_list[1].append(read.query_name)
+    reads_list, fetched_reads = support.get_reads(first)
+    for read_name, mapping_quality in fetched_reads:
+        record_read_quality[read_name] = mapping_quality
     return reads_list, record_read_quality
 
-def link_reads(samfile,left,right,new_left,snp_index_dict,f,record_read_quality):
+def link_reads(support,left,right,new_left,snp_index_dict,f,record_read_quality):
     """
     check the reads that support 1/2 indels
     print the reads in a formate same as ExtractHAIRs, which can be recognized by SpecHap
     """
     left_reads=new_left
-    right_reads,record_read_quality=reads_support(samfile,right,record_read_quality)
+    right_reads,record_read_quality=reads_support(support,right,record_read_quality)
     for i in range(2):
         for j in range(2):
             left_set=left_reads[i]
@@ -388,14 +359,15 @@ def extract_linkage_for_indel(bamfile,snp_list,snp_index_dict,outdir):
     """
     f = open(outdir + '/fragment.add.file', 'w')
     samfile = pysam.AlignmentFile(bamfile, "rb")
+    support = Allele_Support(samfile, snp_list)
     new_left=''
     record_read_quality = {}
     for i in range(len(snp_list)-1):  
         left=snp_list[i]
         right=snp_list[i+1]  
         if new_left=='':   
-            new_left, record_read_quality=reads_support(samfile,left, record_read_quality)
-        right_reads=link_reads(samfile,left,right,new_left,snp_index_dict,f,record_read_quality)
+            new_left, record_read_quality=reads_support(support,left, record_read_quality)
+        right_reads=link_reads(support,left,right,new_left,snp_index_dict,f,record_read_quality)
         new_left=right_reads
     f.close()
 
@@ -407,76 +379,26 @@ class MNP_linkage():
         self.outdir = outdir
         self.snp_list = snp_list
         self.snp_index_dict = snp_index_dict
-        self.read_quality_dict = {}
-        self.locus_read_dict = {}
-        self.read_cover_geno = {}
+        self.fragments = Fragment_Matrix()
         self.discard_reads = {} # discard the reads mapped to the repeat region
         self.get_discard_reads()
     
-    def get_sup_reads(self, first, snp_index):
+    def sweep_fragments(self):
         """
-        Input: Bam file, hete variant
-        Output: the reads support each allele of the variant 
-        """ 
-        reads_list=[]
-        allele_num=len(first[3])+1
-        for i in range(allele_num):
-            reads_list.append([])
-        num=0
-        for read in self.samfile.fetch(str(first[0]),int(first[1])-1,int(first[1])):
-            if read.query_name in self.discard_reads:
-                continue
-            if read.query_name not in self.read_quality_dict:
-                self.read_quality_dict[read.query_name] = int(read.mapping_quality)
-            if int(first[1])-1 in read.get_reference_positions(full_length=True) and read.mapping_quality > 1:   
-                
-                reads_index=read.get_reference_positions(full_length=True).index(int(first[1])-1)
-                if first[2][0] != first[3][0]:
-                    #if the first allele is not same for indel alleles, we can just focus on the first locus 
-                    if read.query_sequence[reads_index] == first[2][0]:
-                        reads_list[0].append(read.query_name)
-                    elif read.query_sequence[reads_index] == first[3][0]:
-                        reads_list[1].append(read.query_name)
-                else:  
-                    index_list=[]
-                    true_ref=first[4]
-                    for i in range(len(true_ref)):
-                    #for i in range(len(first[3])):
-                        position=first[1]+i
-                        point_flag=isin(position-1,read.get_reference_positions(full_length=True))
-                        if point_flag:
-                            position_index=read.get_reference_positions(full_length=True).index(position-1)
-                            index_list.append(position_index)
-                    allele_list=read.query_sequence[index_list[0]:index_list[-1]+1].upper()
-                    ##########for the case that ref is short than alt.#########
-                    if index_list[-1]+1 < len(read.get_reference_positions(full_length=True)) and len(true_ref) < len(first[2])\
-                        and len(true_ref) < len(first[3]) and read.get_reference_positions(full_length=True)[index_list[-1]+1] == None:
-                        j = 0
-                        # print ('#####', first, allele_list)
-                        while index_list[-1]+1+j <  len(read.get_reference_positions(full_length=True)):
-                            tag = read.get_reference_positions(full_length=True)[index_list[-1]+1+j]
-                            # print (first, tag, type(tag))
-                            if read.get_reference_positions(full_length=True)[index_list[-1]+1+j] == None:
-                                allele_list+=read.query_sequence[index_list[-1]+1+j]
-                            else:
-                                break
-                            j += 1   
-                        # print (first, allele_list)
-                    ##########for the case that ref is short than alt.#########             
-                    if allele_list == first[2]:
-                        reads_list[0].append(read.query_name)
-                    elif allele_list == first[3]:
-                        reads_list[1].append(read.query_name)
-        for i in range(2):
-            geno = i
-            # if first[2] !=  first[4]:
-            #     geno += 1
-            for read_name in reads_list[i]:
-                if read_name not in self.read_cover_geno:
-                    self.read_cover_geno[read_name] = {}
-                self.read_cover_geno[read_name][snp_index] = geno
-                # if snp_index == 6 or snp_index == 7:
-                #     print (snp_index, self.snp_list[snp_index-1], read_name, geno)
+        stream the gene region once, record the allele of each read at all the
+        variants it covers, the alignments with the same name form one fragment
+        """
+        snps = sorted(self.snp_list, key = lambda x: int(x[1]))
+        for chrom in sorted(set([str(snp[0]) for snp in snps])):
+            chrom_snps = [snp for snp in snps if str(snp[0]) == chrom]
+            for read, start, end, alleles in sweep_reads(self.samfile, chrom, chrom_snps):
+                if read.query_name in self.discard_reads:
+                    continue
+                read_id = self.fragments.add_alignment(read.query_name, int(read.mapping_quality), start)
+                for i in range(end - start):
+                    if alleles[i] is not None:
+                        self.fragments.add_allele(read_id, self.snp_index_dict[chrom_snps[start + i][1]], alleles[i])
+        self.fragments.build()
     
     def get_discard_reads(self):
         if gene == "HLA_DRB1":
@@ -484,48 +406,12 @@ class MNP_linkage():
                 self.discard_reads[read.query_name] = 1
 
     def for_each_locus(self):
-        f = open(outdir + '/fragment.read.file', 'w')
-        for snp in self.snp_list:
-            pos = snp[1]
-            snp_index = self.snp_index_dict[pos]
-            self.get_sup_reads(snp, snp_index)
-        for read_name in self.read_cover_geno:
-            # print (self.read_cover_geno[read_name])
-            record, support_loci_num = self.for_each_read(read_name)
-            if support_loci_num > 1 and args.weight_imb != 1:
-                print (record, file = f)
+        f = open(workdir + '/fragment.read.file', 'w')
+        if len(self.snp_list) > 0 and args.weight_imb != 1:
+            self.sweep_fragments()
+            self.fragments.write_hairs(f, new_formate)
         f.close()
 
-    def for_each_read(self, read_name):
-        genotype = ''
-        previous_locus = -100
-        seg_num = 0
-        for locus in self.read_cover_geno[read_name]:
-            geno = self.read_cover_geno[read_name][locus]
-            if locus - previous_locus != 1:
-                genotype += ' ' + str(locus) + ' '
-                genotype += str(geno) 
-                seg_num += 1
-            else:
-                genotype += str(geno)     
-            previous_locus = locus 
-        support_loci_num = len(self.read_cover_geno[read_name])
-        signal = "?"*support_loci_num
-        if new_formate:
-            record = f"{str(seg_num)} {read_name} 1 -1 -1 {genotype} {signal} {self.read_quality_dict[read_name]}"
-        else:
-            record = f"{str(seg_num)} {read_name}{genotype} {signal} {self.read_quality_dict[read_name]}"
-        # print (genotype, seg_num)       
-        # print (record)   
-        return record, support_loci_num
-
-def isin(x,seq):
-    try:
-        seq.index(x)
-        return True
-    except :
-        return False
-
 def read_block_hap():
     """
     read the phased block haplotypes
@@ -646,16 +532,20 @@ class Share_reads():
     def __init__(self, deletion_region, outdir, strainsNum, gene, gene_profile, ins_seq):
         self.deletion_region = deletion_region
         # print ('initial', self.deletion_region)
-        self.bamfile = outdir + '/newref_insertion.bam'
-        self.vcf = outdir + '/%s.insertion.phased.vcf.gz'%(gene)
+        self.workdir = workdir
+        self.bamfile = self.workdir + '/newref_insertion.bam'
+        self.vcf = self.workdir + '/%s.insertion.phased.vcf.gz'%(gene)
         self.strainsNum = strainsNum
         self.gene = gene
         self.normal_sequence=gene_profile[self.gene]
-        self.before_dup_reads = [[], []] # record reads before the 3988 for DRB1, for finding dup type, not using
-        self.reads_support = self.normal_reads()
+        self.before_dup_reads = [set(), set()] # record reads before the 3988 for DRB1, for finding dup type, not using
+        self.reads_support = self.normal_reads() # the read names of each hap
+        self.deletion_assign = {} # deletion index: the haps ordered by the shared reads
+        self.insertion_assign = {}
+        self.diploid_insertion = {} # insertion segment: the linked hap sequences
         self.outdir = outdir
         self.ins_seq = ins_seq
-        self.dup_file = outdir +'/select.DRB1.seq.txt'
+        self.dup_file = self.workdir +'/select.DRB1.seq.txt'
         
     def generate_normal_region(self):
         gene_area = focus_region()[self.gene]
@@ -682,52 +572,57 @@ class Share_reads():
             segs.append([start, gene_area[1], 'normal', '.'])
         return normal_region, segs
 
+    def hap_snv_alleles(self):
+        """
+        the 0-based loci of the phased SNVs, and the base of each hap at them
+        as a (strainsNum, SNV num) uint8 array
+        """
+        snv_loci, hap_bases = [], []
+        for i in range(len(self.normal_sequence[0])):
+            snv=self.normal_sequence[0][i]
+            if len(snv[2]) != 1 or len(snv[3]) != 1:
+                continue
+            snv_loci.append(int(snv[1])-1)
+            hap_bases.append([ord(snv[self.normal_sequence[1][j][i]+2]) for j in range(self.strainsNum)])
+        hap_bases = np.array(hap_bases, dtype = np.uint8).reshape(-1, self.strainsNum).T
+        return np.array(snv_loci, dtype = np.int64), hap_bases
+
     def normal_reads(self):
         normal_region, segs = self.generate_normal_region()
         # print ("normal region", normal_region)
-        reads_support = [[], []]
+        reads_support = [set(), set()]
+        self.snv_loci, self.hap_bases = self.hap_snv_alleles()
+        if len(self.snv_loci) == 0:
+            return reads_support
         samfile = pysam.AlignmentFile(self.bamfile, "rb")
         for region in normal_region:
             if abs(region[0] - region[1]) < 10:
                 continue
             for read in samfile.fetch(self.gene, region[0] - 1, region[1]):
-                rivet_points=False
-                support_alleles=[]
-                support_loci=[]
-                for i in range(len(self.normal_sequence[0])):
-                    snv=self.normal_sequence[0][i]
-                    if len(snv[2]) != 1 or len(snv[3]) != 1:
-                        continue
-                    if int(snv[1])-1 in read.get_reference_positions(full_length=True):
-                        reads_index=read.get_reference_positions(full_length=True).index(int(snv[1])-1)
-                        support_alleles.append(read.query_sequence[reads_index])
-                        # print (read.query_name,snv,support_alleles)
-                        rivet_points=True
-                        support_loci.append(i)
-                if rivet_points==True:
+                # the bases of the read at the SNV loci it covers
+                ref_map, ref_len = query_ref_map(read)
+                aligned_index = np.flatnonzero(ref_map >= 0)
+                aligned_ref = ref_map[aligned_index]
+                snv_index = np.searchsorted(aligned_ref, self.snv_loci)
+                covered = snv_index < len(aligned_ref)
+                covered[covered] = aligned_ref[snv_index[covered]] == self.snv_loci[covered]
+                if covered.any():
                     #if the reads has information, check which hap it belongs to.
-                    hap_belong=self.check_hap(support_alleles,support_loci)[0]
+                    sequence = np.frombuffer(read.query_sequence.encode(), dtype = np.uint8)
+                    support_alleles = sequence[aligned_index[snv_index[covered]]]
+                    hap_belong=self.check_hap(support_alleles,np.flatnonzero(covered))[0]
                     if hap_belong != 'NA':
-                        reads_support[hap_belong].append(read.query_name)
+                        reads_support[hap_belong].add(read.query_name)
                         if self.gene == "HLA_DRB1" and read.reference_start < 3988: 
-                            self.before_dup_reads[hap_belong].append(read.query_name)
+                            self.before_dup_reads[hap_belong].add(read.query_name)
 
         # print (len(reads_support[0]), len(self.before_dup_reads[0]))
         return reads_support
 
     def check_hap(self,support_alleles,support_loci):
-        support_num=[]  #check the allele num that support the each hap respectively.
-        for i in range(self.strainsNum):
-            support_num.append(0)
-        for i in range(len(support_loci)):
-            locus_index=support_loci[i]
-            allele=support_alleles[i]
-            snv=self.normal_sequence[0][locus_index]
-            for j in range(self.strainsNum):
-                hap_allele=snv[self.normal_sequence[1][j][locus_index]+2]
-                if hap_allele == allele:
-                    support_num[j] += 1
-        #check which hap has most same alleles support_num.index(max(support_num))
+        #check the allele num that support the each hap respectively.
+        support_num = (self.hap_bases[:, support_loci] == support_alleles).sum(axis = 1)
+        #check which hap has most same alleles
         return self.most_support(support_num)
 
     def most_support(self,support_num):
@@ -735,6 +630,9 @@ class Share_reads():
         return hap_order
 
     def deletion_reads(self,deletion_index):
+        # the assignment is the same for each hap, only count the reads once
+        if deletion_index in self.deletion_assign:
+            return self.deletion_assign[deletion_index]
         link_reads=[]  #the reads number that shared with different haps, the copy number may be 0
         for i in range(self.strainsNum):
             link_reads.append(0)
@@ -745,9 +643,12 @@ class Share_reads():
                 if read.query_name in self.reads_support[i]:
                     link_reads[i] += 1
         print ("deletion index is", deletion_index, link_reads, self.most_support(link_reads))   
-        return self.most_support(link_reads)
+        self.deletion_assign[deletion_index] = self.most_support(link_reads)
+        return self.deletion_assign[deletion_index]
 
     def insertion_reads(self,deletion_index):
+        if deletion_index in self.insertion_assign:
+            return self.insertion_assign[deletion_index]
         link_reads=[]  #the reads number that shared with different haps, the copy number may be 0
         for i in range(self.strainsNum):
             link_reads.append(0)
@@ -760,7 +661,8 @@ class Share_reads():
                     link_reads[i] += 1
             map_ins_read_num += 1
         print ("insertion index is", deletion_index, link_reads, self.most_support(link_reads), "read num is", map_ins_read_num, "ins name", ins_segment_name)  
-        return self.most_support(link_reads)
+        self.insertion_assign[deletion_index] = self.most_support(link_reads)
+        return self.insertion_assign[deletion_index]
 
     def deletion_phase(self):
         for deletion_index in range(len(self.deletion_region)):
@@ -776,11 +678,8 @@ class Share_reads():
             max_num = 0
             max_seq = ''
             for j in range(len(drb1_complex_seq)):
-                num = 0
-                for re in uniq_drb1_complex_reads[j]:
-                    # if re in self.reads_support[i]:
-                    if re in self.before_dup_reads[i]:
-                        num+=1
+                # num = len([re for re in uniq_drb1_complex_reads[j] if re in self.reads_support[i]])
+                num = len([re for re in uniq_drb1_complex_reads[j] if re in self.before_dup_reads[i]])
                 if num >= max_num:
                     max_num = num
                     max_seq = drb1_complex_seq[j]
@@ -815,17 +714,15 @@ class Share_reads():
                 seg_region = ' %s:%s-%s '%(self.gene,seg[0],seg[1])
                 id_name[seg_region.strip()] = str(seg[0]) + '_' + str(seg[1]) 
             gap += seg_region
+        # the segment sequences of both haps
+        cons = load_reference('%s/ref/hla.ref.extend.fa'%(args.db))
+        seg_haps = {}
+        for segseq in gap.split():
+            seg_haps[segseq] = cons.haplotypes('%s/%s.rephase.vcf.gz'%(self.outdir,self.gene), segseq, mask_bed)
         for i in range(self.strainsNum):
-            order='samtools faidx %s/ref/hla.ref.extend.fa\
-                %s |%s/../bin/bcftools consensus --mask %s -H %s %s/%s.rephase.vcf.gz\
-                      >%s/%s_%s_seg.fa'%(args.db,gap,sys.path[0],mask_bed,i+1,self.outdir,\
-                self.gene,self.outdir,self.gene,i)
-            os.system(order)
-            fa_file = '%s/%s_%s_seg.fa'%(self.outdir,self.gene,i)
-            seg_sequence = chrom_seq(fa_file)
             new_seg_sequence = {}
-            for segseq in seg_sequence.keys():
-                new_seg_sequence[id_name[segseq]] = seg_sequence[segseq]
+            for segseq in seg_haps.keys():
+                new_seg_sequence[id_name[segseq]] = seg_haps[segseq][i]
             hap_seq = ''
             for seg in segs:
                 if seg[2] == 'normal':
@@ -865,6 +762,9 @@ class Share_reads():
 
     def link_diploid_insertion(self, insertion_seg):
         # insertion_seg = 'HLA_DRB1_6355'
+        # the two hap sequences are linked once, then reused for each hap
+        if insertion_seg in self.diploid_insertion:
+            return self.diploid_insertion[insertion_seg]
         insert_reads_support = []
         for i in range(self.strainsNum):
             insert_reads_support.append([])
@@ -891,14 +791,15 @@ class Share_reads():
 
         samfile = pysam.AlignmentFile(self.bamfile, "rb")
         for read in samfile.fetch(insertion_seg):
+            positions = read.get_reference_positions(full_length=True)
             rivet_points=False
             support_alleles=[]
             support_loci=[]
             for i in range(len(insert_phase_result[0])):
                 snv1 =insert_phase_result[0][i]
                 snv2 =insert_phase_result[1][i]
-                if int(snv1[0])-1 in read.get_reference_positions(full_length=True):
-                    reads_index=read.get_reference_positions(full_length=True).index(int(snv1[0])-1)
+                if int(snv1[0])-1 in positions:
+                    reads_index=positions.index(int(snv1[0])-1)
                     if read.query_sequence[reads_index] == snv1[1]:
                         insert_reads_support[0].append(read.query_name)
                     elif read.query_sequence[reads_index] == snv2[1]:
@@ -913,25 +814,16 @@ class Share_reads():
             for j in range(len(insert_reads_support[i])):
                 if insert_reads_support[i][j] in self.reads_support[1-i]:
                     r01 += 1
-        fastq_seq = []
-        for i in range(2):
-            order = """
-            samtools faidx %s/newref_insertion.fa %s|%s/../bin/bcftools consensus -H %s %s  >%s/seq_%s_%s.fa
-            """%(self.outdir, insertion_seg, sys.path[0], i+1, self.vcf, self.outdir, i, insertion_seg)
-            os.system(order)
-            fastq_seq.append(read_fasta('%s/seq_%s_%s.fa'%(self.outdir, i, insertion_seg)))
+        fastq_seq = load_reference('%s/newref_insertion.fa'%(self.workdir)).haplotypes(self.vcf, insertion_seg)
         print ('link long indel supporting reads', r00, r01)
         if  r01 > r00:
-            return [fastq_seq[1], fastq_seq[0]]
+            self.diploid_insertion[insertion_seg] = [fastq_seq[1], fastq_seq[0]]
         else:
-            return fastq_seq  
+            self.diploid_insertion[insertion_seg] = fastq_seq
+        return self.diploid_insertion[insertion_seg]
 
     def consensus_insertion(self, insertion_seg):
-        order = """
-        samtools faidx %s/newref_insertion.fa %s|%s/../bin/bcftools consensus -H %s %s  >%s/seq
-        """%(self.outdir, insertion_seg, sys.path[0], 1, self.vcf, self.outdir)
-        os.system(order)
-        cons_seq = read_fasta('%s/seq'%(self.outdir))
+        cons_seq = load_reference('%s/newref_insertion.fa'%(self.workdir)).haplotypes(self.vcf, insertion_seg, haps = [1])[0]
         return cons_seq
 
 def chrom_seq(file):
@@ -961,7 +853,78 @@ def read_fasta(file):
         seq+=line
     return seq
         
-def segment_mapping_pre(fq1, fq2, ins_seq, outdir, gene, gene_ref):
+bwa_index_suffix = ['.fai', '.amb', '.ann', '.bwt', '.pac', '.sa']
+INDEX_CACHE_SIZE = 16 # the most recently used indexes kept in the cache
+INDEX_CACHE_GRACE = 3600 # seconds, an index used more recently may be in use by another gene or run
+
+def get_ref_hash(ref):
+    with open(ref, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def index_insertion_ref(newref, ref_hash):
+    """
+    the index of the insertion-augmented reference is cached by the hash of its content,
+    so identical references are indexed only once,
+    the index is built in a temporary dir and renamed to the cache in one step,
+    return the cached reference
+    """
+    cache_dir = args.index_cache
+    if cache_dir is None:
+        cache_dir = outdir + '/index_cache'
+    ref_dir = '%s/%s'%(cache_dir, ref_hash)
+    cached_ref = ref_dir + '/newref_insertion.fa'
+    if all(os.path.isfile(cached_ref + suffix) for suffix in bwa_index_suffix):
+        print ('Detect cached index for the insertion-augmented reference: %s'%(cached_ref))
+        os.utime(ref_dir) # mark it as recently used
+        prune_index_cache(cache_dir)
+        return cached_ref
+    if os.path.exists(ref_dir): # incomplete index
+        shutil.rmtree(ref_dir)
+    tmp_dir = '%s.tmp%s'%(ref_dir, os.getpid())
+    os.makedirs(tmp_dir, exist_ok = True)
+    shutil.copy(newref, tmp_dir + '/newref_insertion.fa')
+    for command in ['samtools faidx', 'bwa index']:
+        status = os.system('%s %s/newref_insertion.fa'%(command, tmp_dir))
+        if status != 0: # never publish a partial index to the cache
+            shutil.rmtree(tmp_dir)
+            raise RuntimeError('%s failed with exit status %s for %s/newref_insertion.fa'%(command,\
+                os.waitstatus_to_exitcode(status), tmp_dir))
+    try:
+        os.rename(tmp_dir, ref_dir)
+    except OSError: # the same reference is indexed by another run
+        shutil.rmtree(tmp_dir)
+    prune_index_cache(cache_dir)
+    return cached_ref
+
+def prune_index_cache(cache_dir):
+    """
+    keep the INDEX_CACHE_SIZE most recently used indexes in the cache,
+    and remove the temporary dirs left by killed runs,
+    anything used within INDEX_CACHE_GRACE seconds is kept
+    """
+    now = time.time()
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = '%s/%s'%(cache_dir, name)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError: # removed by another run
+            continue
+        if now - mtime < INDEX_CACHE_GRACE:
+            continue
+        if '.tmp' in name:
+            shutil.rmtree(path, ignore_errors = True)
+        else:
+            entries.append((mtime, path))
+    recent_num = len(os.listdir(cache_dir)) - len(entries)
+    entries.sort(reverse = True)
+    for mtime, path in entries[max(INDEX_CACHE_SIZE - recent_num, 0):]:
+        shutil.rmtree(path, ignore_errors = True)
+
+def build_insertion_ref(ins_seq, outdir, gene, gene_ref):
+    """
+    combine the gene reference and the long insertion sequences
+    """
     newref=outdir+'/newref_insertion.fa'
     os.system('cp %s %s'%(gene_ref, newref))
     for seg in ins_seq.keys():
@@ -969,14 +932,19 @@ def segment_mapping_pre(fq1, fq2, ins_seq, outdir, gene, gene_ref):
         f = open(newref, 'a')
         print ('>%s_%s\n%s'%(gene, int(seg), ins_seq[seg]), file = f)
         f.close()
-        # index the ref
+    return newref
+
+def segment_mapping_pre(fq1, fq2, ins_seq, outdir, gene, gene_ref):
+    newref = build_insertion_ref(ins_seq, outdir, gene, gene_ref)
+    ref_hash = get_ref_hash(newref)
+    # index the ref
+    cached_ref = index_insertion_ref(newref, ref_hash)
     print ('New mapping starts to link long InDels.')
     map_call = """\
         bindir=%s/../bin/
         outdir=%s/ 
         sample='newref_insertion' 
         samtools faidx %s 
-        bwa index %s
         group='@RG\\tID:sample\\tSM:sample'  #only -B 1
         bwa mem -t %s -B 1 -O 1,1 -L 1,1 -U 1 -R $group -Y %s %s %s | samtools view -q 1 -F 4 -Sb | samtools sort > $outdir/$sample.sort.bam
         mv $outdir/$sample.sort.bam $outdir/$sample.bam
@@ -985,40 +953,39 @@ def segment_mapping_pre(fq1, fq2, ins_seq, outdir, gene, gene_ref):
         cat $outdir/$sample.freebayes.1.vcf| sed -e 's/\//\|/g'>$outdir/$sample.freebayes.vcf 
         bgzip -f $outdir/$sample.freebayes.vcf 
         tabix -f $outdir/$sample.freebayes.vcf.gz
-        """%(sys.path[0], outdir, newref, newref, args.thread_num, newref, fq1, fq2, newref)
+        """%(sys.path[0], outdir, newref, args.thread_num, cached_ref, fq1, fq2, newref)
     os.system(map_call)
     # print (ins_seq)
+    cons = load_reference('%s/newref_insertion.fa'%(outdir))
     for ins in ins_seq.keys():
-        ins_call = """samtools faidx %s/newref_insertion.fa %s_%s |%s/../bin/bcftools consensus -H 1 %s/newref_insertion.freebayes.vcf.gz  >%s/fresh_ins.fa
-        """%(outdir,gene,int(ins),sys.path[0],outdir,outdir)
-        # print ('#####################', ins, ins_call)
-        os.system(ins_call)
-        ins_seq[ins] = read_fasta('%s/fresh_ins.fa'%(outdir))
+        ins_seq[ins] = cons.haplotypes('%s/newref_insertion.freebayes.vcf.gz'%(outdir), '%s_%s'%(gene,int(ins)), haps = [1])[0]
     # print (ins_seq)
-    return ins_seq
+    return ins_seq, ref_hash
     
-def segment_mapping(fq1, fq2, ins_seq, outdir, gene, gene_ref):
-    newref=outdir+'/newref_insertion.fa'
-    os.system('cp %s %s'%(gene_ref, newref))
-    for seg in ins_seq.keys():
-
-        f = open(newref, 'a')
-        print ('>%s_%s\n%s'%(gene, int(seg), ins_seq[seg]), file = f)
-        f.close()
-        # index the ref
+def segment_mapping(fq1, fq2, ins_seq, outdir, gene, gene_ref, pre_ref_hash):
+    newref = build_insertion_ref(ins_seq, outdir, gene, gene_ref)
+    ref_hash = get_ref_hash(newref)
+    if ref_hash == pre_ref_hash:
+        # the refined insertions do not change the reference,
+        # the alignment and the variants of the first mapping are kept
+        print ('The insertion-augmented reference is unchanged, skip the new mapping.')
+        os.system('samtools faidx %s'%(newref))
+        os.system('cp %s/newref_insertion.freebayes.1.vcf %s/newref_insertion.freebayes.vcf'%(outdir, outdir))
+        return
+    # index the ref
+    cached_ref = index_insertion_ref(newref, ref_hash)
     print ('New mapping starts to link long InDels.')
     map_call = """\
         bindir=%s/../bin/
         outdir=%s/ 
         sample='newref_insertion' 
         samtools faidx %s 
-        bwa index %s
         group='@RG\\tID:sample\\tSM:sample'  #only -B 1
         bwa mem -t %s -B 1 -O 1,1 -L 1,1 -U 1 -R $group -Y %s %s %s | samtools view -q 1 -F 4 -Sb | samtools sort > $outdir/$sample.sort.bam
         mv $outdir/$sample.sort.bam $outdir/$sample.bam 
         samtools index $outdir/$sample.bam 
         freebayes -f %s -p 2 $outdir/$sample.bam > $outdir/$sample.freebayes.vcf 
-        """%(sys.path[0], outdir, newref, newref, args.thread_num, newref, fq1, fq2, newref)
+        """%(sys.path[0], outdir, newref, args.thread_num, cached_ref, fq1, fq2, newref)
     os.system(map_call)
 
 def get_insertion_linkage(ins_seq):
@@ -1028,13 +995,13 @@ def get_insertion_linkage(ins_seq):
     Map the reads to the modified reference
     """
     if len(ins_seq) > 0:
-        ins_seq = segment_mapping_pre(fq1, fq2, ins_seq, outdir, gene, hla_ref)
-        segment_mapping(fq1, fq2, ins_seq, outdir, gene, hla_ref)
+        ins_seq, pre_ref_hash = segment_mapping_pre(fq1, fq2, ins_seq, workdir, gene, hla_ref)
+        segment_mapping(fq1, fq2, ins_seq, workdir, gene, hla_ref, pre_ref_hash)
     else:
         # os.system('cp %s/%s.bam %s/newref_insertion.bam'%(outdir, gene.split('_')[-1], outdir))
-        os.system('cp %s %s/newref_insertion.bam'%(bamfile, outdir))
-        os.system('samtools index %s/newref_insertion.bam'%(outdir))
-        os.system('zcat %s > %s/newref_insertion.freebayes.vcf'%(gene_vcf, outdir))
+        os.system('cp %s %s/newref_insertion.bam'%(bamfile, workdir))
+        os.system('samtools index %s/newref_insertion.bam'%(workdir))
+        os.system('zcat %s > %s/newref_insertion.freebayes.vcf'%(gene_vcf, workdir))
     return ins_seq
 
 def get_copy_number(outdir, deletion_region, gene, ins_seq):
@@ -1110,20 +1077,13 @@ def zero_per(list):
     return zero_num/len(list)
 
 def uniq_reads(raw_reads_set):
-    dup_type_Num = len(raw_reads_set)
+    # keep the reads found in only one dup type
+    type_num = Counter()
+    for reads in raw_reads_set:
+        type_num.update(set(reads))
     uniq_reads_set = []
-    for i in range(dup_type_Num):
-        uniq_set = []
-        for ele in raw_reads_set[i]:
-            uniq_flag = True
-            for j in range(dup_type_Num):
-                if i == j:
-                    continue
-                if ele in raw_reads_set[j]:
-                    uniq_flag = False
-            if uniq_flag == True:
-                uniq_set.append(ele)
-        uniq_reads_set.append(uniq_set)
+    for reads in raw_reads_set:
+        uniq_reads_set.append([ele for ele in reads if type_num[ele] == 1])
     # print ('uniq reads', len(uniq_reads_set[0]), len(uniq_reads_set[1]))
     return uniq_reads_set
 
@@ -1367,7 +1327,7 @@ def phase_insertion(gene, outdir, hla_ref, shdir):
     cat $outdir/newref_insertion.freebayes.vcf|grep '#'>$outdir/filter_newref_insertion.freebayes.vcf
     awk -F'\t' '{if($6>5) print $0}' $outdir/newref_insertion.freebayes.vcf|grep -v '#' >>$outdir/filter_newref_insertion.freebayes.vcf
     %s/../bin/extractHairs/build/ExtractHAIRs --triallelic 1 --mbq 4 --mmq 0 --indels 1 \
-    --ref $ref --bam $outdir/newref_insertion.bam --VCF $outdir/filter_newref_insertion.freebayes.vcf --out $outdir/$sample.fragment.file > spec.log 2>&1
+    --ref $ref --bam $outdir/newref_insertion.bam --VCF $outdir/filter_newref_insertion.freebayes.vcf --out $outdir/$sample.fragment.file > $outdir/spec.log 2>&1
     sort -n -k3 $outdir/$sample.fragment.file >$outdir/$sample.fragment.sorted.file
     bgzip -f $outdir/filter_newref_insertion.freebayes.vcf
     tabix -f $outdir/filter_newref_insertion.freebayes.vcf.gz
@@ -1406,7 +1366,7 @@ def allele_imba_old(beta_set):
     return the linkage info with a SpecHap acceptable format
     """
     
-    f = open(outdir + '/fragment.imbalance.file', 'w')
+    f = open(workdir + '/fragment.imbalance.file', 'w')
     base_q = round(60 * float(args.weight_imb))
     if base_q >= 1:
         locus_num = len(beta_set)
@@ -1436,30 +1396,27 @@ def allele_imba(beta_set):
     get the linkage info from allele frequencies at each variant locus
     return the linkage matrix with a SpecHap acceptable format
     """
-    f = open(outdir + '/fragment.imbalance.file', 'w')
-    locus_num = len(beta_set)
-    for i in range(locus_num - 1):
-        j = i + 1
-        same = max([ beta_set[i][0] *  beta_set[j][0], beta_set[i][1] *  beta_set[j][1] ])
-        reverse = max([ beta_set[i][0] *  beta_set[j][1], beta_set[i][1] *  beta_set[j][0] ])
-
-        edge_same = max(np.log(same/reverse), 0)
-        edge_reverse = max(np.log(reverse/same), 0)
-        first_locus = snp_index_dict[snp_list[i][1]] - 1 # 0 index
-        second_locus = snp_index_dict[snp_list[j][1]] - 1
-        print (second_locus, first_locus, edge_same, edge_reverse, edge_reverse, edge_same, file = f)
+    f = open(workdir + '/fragment.imbalance.file', 'w')
+    if len(beta_set) > 1:
+        log_same, log_reverse = imbalance_edges(beta_set)
+        for i in range(len(beta_set) - 1):
+            edge_same = max(log_same[i], 0)
+            edge_reverse = max(log_reverse[i], 0)
+            first_locus = snp_index_dict[snp_list[i][1]] - 1 # 0 index
+            second_locus = snp_index_dict[snp_list[i+1][1]] - 1
+            print (second_locus, first_locus, edge_same, edge_reverse, edge_reverse, edge_same, file = f)
     f.close()
 
 def run_SpecHap():
-    mmp = MNP_linkage(bamfile,snp_list,snp_index_dict,outdir)
+    mmp = MNP_linkage(bamfile,snp_list,snp_index_dict,workdir)
     mmp.for_each_locus() 
 
     allele_imba(beta_set) # linkage from allele imbalance
-    os.system('cat %s/fragment.read.file >%s/fragment.all.file'%(outdir, outdir))   
+    os.system('cat %s/fragment.read.file >%s/fragment.all.file'%(workdir, workdir))   
 
     # the order to phase with only ngs data.
     order='%s/../bin/SpecHap/build/SpecHap --ncs --protocols ngs,matrix --weights %s,%s --window_size 15000 --vcf %s --frag %s/fragment.sorted.file,%s/fragment.imbalance.file --out \
-    %s/%s.specHap.phased.vcf'%(sys.path[0], 1-args.weight_imb, args.weight_imb, gene_vcf, outdir,outdir, outdir,gene)
+    %s/%s.specHap.phased.vcf'%(sys.path[0], 1-args.weight_imb, args.weight_imb, gene_vcf, workdir,workdir, outdir,gene)
     # print (order)
 
     # integrate phase info from pacbio data if provided.
@@ -1468,16 +1425,17 @@ def run_SpecHap():
         command = """
         fq=%s
         outdir=%s
+        workdir=%s
         bin=%s/../bin
         gene=%s
         ref=%s
         sample=pacbio
 
-        pbmm2 align -j %s $ref $outdir/%s/$gene.pacbio.fq.gz $outdir/$sample.tgs.sort.bam --sort --sample $sample --rg '@RG\tID:movie1'
-        samtools index $outdir/$sample.tgs.sort.bam
-        $bin/extractHairs/build/ExtractHAIRs --triallelic 1 --pacbio 1 --indels 1 --ref $ref --bam $outdir/$sample.tgs.sort.bam --VCF %s --out $outdir/fragment.$sample.file
-        cat $outdir/fragment.$sample.file >> $outdir/fragment.all.file
-        """%(args.tgs, outdir, sys.path[0], gene.split("_")[1], hla_ref, args.thread_num, args.sample_id, gene_vcf)
+        pbmm2 align -j %s $ref $outdir/%s/$gene.pacbio.fq.gz $workdir/$sample.tgs.sort.bam --sort --sample $sample --rg '@RG\tID:movie1'
+        samtools index $workdir/$sample.tgs.sort.bam
+        $bin/extractHairs/build/ExtractHAIRs --triallelic 1 --pacbio 1 --indels 1 --ref $ref --bam $workdir/$sample.tgs.sort.bam --VCF %s --out $workdir/fragment.$sample.file
+        cat $workdir/fragment.$sample.file >> $workdir/fragment.all.file
+        """%(args.tgs, outdir, workdir, sys.path[0], gene.split("_")[1], hla_ref, args.thread_num, args.sample_id, gene_vcf)
 
         print ('extract linkage info from pacbio data.')
         os.system(command)
@@ -1489,16 +1447,17 @@ def run_SpecHap():
         fq=%s
         ref=%s
         outdir=%s
+        workdir=%s
         bin=%s/../bin
         gene=%s
         sample=nanopore
-        minimap2 -t %s -a $ref $outdir/%s/$gene.nanopore.fq.gz > $outdir/$sample.tgs.sam
-        samtools view -F 2308 -b -T $ref $outdir/$sample.tgs.sam > $outdir/$sample.tgs.bam
-        samtools sort $outdir/$sample.tgs.bam -o $outdir/$sample.tgs.sort.bam
-        samtools index $outdir/$sample.tgs.sort.bam
-        $bin/extractHairs/build/ExtractHAIRs --triallelic 1 --ONT 1 --indels 1 --ref $ref --bam $outdir/$sample.tgs.sort.bam --VCF %s --out $outdir/fragment.$sample.file
-        cat $outdir/fragment.$sample.file >> $outdir/fragment.all.file
-        """%(args.nanopore, hla_ref, outdir, sys.path[0], gene.split("_")[1], args.thread_num, args.sample_id, gene_vcf)
+        minimap2 -t %s -a $ref $outdir/%s/$gene.nanopore.fq.gz > $workdir/$sample.tgs.sam
+        samtools view -F 2308 -b -T $ref $workdir/$sample.tgs.sam > $workdir/$sample.tgs.bam
+        samtools sort $workdir/$sample.tgs.bam -o $workdir/$sample.tgs.sort.bam
+        samtools index $workdir/$sample.tgs.sort.bam
+        $bin/extractHairs/build/ExtractHAIRs --triallelic 1 --ONT 1 --indels 1 --ref $ref --bam $workdir/$sample.tgs.sort.bam --VCF %s --out $workdir/fragment.$sample.file
+        cat $workdir/fragment.$sample.file >> $workdir/fragment.all.file
+        """%(args.nanopore, hla_ref, outdir, workdir, sys.path[0], gene.split("_")[1], args.thread_num, args.sample_id, gene_vcf)
         print ('extract linkage info from nanopore TGS data.')
         os.system(command)
         # order = '%s/../bin/SpecHap/build/SpecHap --ncs -N --window_size 15000 --vcf %s --frag %s/fragment.sorted.file \
@@ -1521,10 +1480,10 @@ def run_SpecHap():
         samtools sort $outdir/$sample.tgs.bam -o $outdir/$sample.tgs.sort.bam
         samtools index $outdir/$sample.tgs.sort.bam
         $bin/extractHairs/build/ExtractHAIRs --new_format 1 --triallelic 1 --hic 1 --indels 1 --ref $ref --bam $outdir/$sample.tgs.sort.bam --VCF %s --out $outdir/fragment.hic.file
-        """%(args.hic_fwd, args.hic_rev, hla_ref, outdir, sys.path[0], args.thread_num, gene_vcf)
+        """%(args.hic_fwd, args.hic_rev, hla_ref, workdir, sys.path[0], args.thread_num, gene_vcf)
         print ('extract linkage info from HiC data.')
         os.system(command)
-        os.system('cat %s/fragment.hic.file >> %s/fragment.all.file'%(outdir, outdir))
+        os.system('cat %s/fragment.hic.file >> %s/fragment.all.file'%(workdir, workdir))
         # order = '%s/../bin/SpecHap/build/SpecHap --ncs -H --new_format --window_size 15000 --vcf %s --frag %s/fragment.sorted.file \
         # --out %s/%s.specHap.phased.vcf'%(sys.path[0],gene_vcf, outdir, outdir,gene)
         order += " -H --new_format"
@@ -1557,7 +1516,7 @@ def run_SpecHap():
             awk '$0=$0" 1"' $outdir/fragment.raw3.tenx.file >$outdir/fragment.tenx.file
             cat $outdir/fragment.tenx.file >> $outdir/fragment.all.file
         
-        """%(args.tenx, hla_ref, outdir, sys.path[0], args.sample_id, gene, gene_vcf,args.db, args.thread_num, sys.path[0], gene_vcf[:-3])
+        """%(args.tenx, hla_ref, workdir, sys.path[0], args.sample_id, gene, gene_vcf,args.db, args.thread_num, sys.path[0], gene_vcf[:-3])
         print ('align linked-reads with longranger and extract linkage info')
         os.system(command)
         
@@ -1567,9 +1526,9 @@ def run_SpecHap():
         order += " -T --new_format"
 
     if new_formate:
-        os.system('sort -n -k6 %s/fragment.all.file >%s/fragment.sorted.file'%(outdir, outdir))
+        os.system('sort -n -k6 %s/fragment.all.file >%s/fragment.sorted.file'%(workdir, workdir))
     else:
-        os.system('sort -n -k3 %s/fragment.all.file >%s/fragment.sorted.file'%(outdir, outdir))
+        os.system('sort -n -k3 %s/fragment.all.file >%s/fragment.sorted.file'%(workdir, workdir))
 
     os.system(order)
     
@@ -1579,7 +1538,8 @@ def all_poss_block_link():
     of block linkage, and generate different fasta files.
     we then map the fasta to the allele database.
     we choose the linkage with highest mapping score.
-    This function generates all possible fasta files.
+    With more than MAX_ENUMERATION combinations, only the best ones by
+    the per-block database scores are written, see block_link.py.
     """
     block_intervals = []
     start = 0
@@ -1587,32 +1547,29 @@ def all_poss_block_link():
         block_intervals.append([start, pos])
         start = pos + 1
     block_intervals.append([start, 100000])
-    all_poss = poss_link(len(block_intervals))
-    print ("Num of all possible haps is %s."%(len(all_poss)))
-    if len(all_poss) > 512:
-        print ("ERROR: Too many blocks, the phasing process must be wrong.")
-        print ("-----------------------------------------------------------")
-        sys.exit(1)
+    block_num = len(block_intervals)
+    print ("Num of all possible haps is %s."%(2 ** (block_num - 1)))
+    # the haps of each block as phased by SpecHap, a combination only swaps them
+    block_phase(outdir,seq_list,snp_list,gene,gene_vcf,rephase_vcf,[interval + [0] for interval in block_intervals])
+    pieces = block_pieces(load_reference(hla_ref), rephase_vcf, mask_bed, gene, read_exon_intervals(gene), block_intervals)
+    if 2 ** (block_num - 1) <= MAX_ENUMERATION:
+        all_poss = poss_link(block_num)
+    else:
+        # too many to write, score the two orientations of each block once, only keep the best combinations
+        all_poss = best_links(pieces, block_num, '%s/HLA/exon/%s.fasta'%(args.db, gene), workdir, args.thread_num)
+    print ("Num of candidate haps is %s."%(len(all_poss)))
     record_all_block_haps = []
     os.system("rm -f %s/%s.*.*.fasta"%(outdir, gene))
     for i in range(len(all_poss)):
-        # print (all_poss[i], rephase_vcf)
         record_block_haps = []
         for j in range(len(block_intervals)):
             record_block_haps.append(block_intervals[j] + [all_poss[i][j]] )
         record_all_block_haps.append(record_block_haps)
-        # generate rephased vcf and fasta for each possibility
-        update_seqlist = block_phase(outdir,seq_list,snp_list,gene,gene_vcf,rephase_vcf,record_block_haps) 
-        vcf2fasta(rephase_vcf)
         for z in range(1, 3):
-            fasta = "%s/hla.allele.%s.%s.fasta"%(outdir, z, gene)
-            # poss_fasta = "%s/hla.allele.raw.%s.%s.%s.fasta"%(outdir, i, z, gene)
             poss_fasta = "%s/%s.%s.%s.fasta"%(outdir, gene, i, z)
-            # os.system("cp %s/hla.allele.%s.%s.fasta %s/hla.allele.raw.%s.%s.%s.fasta"%(outdir, z, gene, outdir, i, z, gene))
-            sequence = read_fasta(fasta)
             out_f = open(poss_fasta, "w") # save all possible fastas
             print (">%s"%(gene), file = out_f)
-            print (sequence, file = out_f)
+            print (link_hap(pieces, all_poss[i], z - 1), file = out_f)
             out_f.close()
     selected_poss_index = select_poss()
     print ("Selected combination is ", selected_poss_index)
@@ -1666,7 +1623,7 @@ def link_blocks():
         update_seqlist = all_poss_block_link()
     else:
         if args.use_database == True:
-            reph='%s/../spechla_env/bin/python3 %s/whole/map_block2_database.py %s %s %s'%(sys.path[0],sys.path[0],gene,outdir,args.db)     
+            reph='%s/../spechla_env/bin/python3 %s/whole/map_block2_database.py %s %s %s %s'%(sys.path[0],sys.path[0],gene,outdir,args.db,args.thread_num)     
             os.system(str(reph))
             # phase block with spectral graph theory
             print ("phase block with spectral graph theory")
@@ -1724,7 +1681,7 @@ def skip_mask_region(mask_dict, gene, start, end):
             end = mask[0]  
     return start, end    
 
-def vcf2fasta(rephase_vcf):
+def read_exon_intervals(gene):
     exon_bed = "%s/whole/exon_extent.bed"%(sys.path[0])
     exon_intervals = []
     f = open(exon_bed, 'r')
@@ -1735,20 +1692,23 @@ def vcf2fasta(rephase_vcf):
             end = int(array[2])
             exon_intervals.append([start, end]) 
     f.close()
+    return exon_intervals
 
+def vcf2fasta(rephase_vcf):
+    exon_intervals = read_exon_intervals(gene)
+    cons = load_reference(hla_ref)
     j = 0
     for interval in exon_intervals:
         start, end = interval[0], interval[1]
+        region = '%s:%s-%s'%(gene, start, end)
+        hap_seqs = cons.haplotypes(rephase_vcf, region, mask_bed)
         for i in range(1, 3):
             if j == 0:
-                fastq2 = 'samtools faidx %s %s:%s-%s | %s/../bin/bcftools consensus -H %s --mask %s %s\
-                    >%s/hla.allele.%s.%s.fasta'%(hla_ref, gene, start, end, sys.path[0], i, mask_bed,\
-                    rephase_vcf, outdir, i, gene)
+                out = open('%s/hla.allele.%s.%s.fasta'%(outdir, i, gene), 'w')
             else:
-                fastq2 = 'samtools faidx %s %s:%s-%s | %s/../bin/bcftools consensus -H %s --mask %s %s\
-                    >>%s/hla.allele.%s.%s.fasta'%(hla_ref, gene, start, end, sys.path[0], i, mask_bed, \
-                    rephase_vcf, outdir, i, gene)              
-            os.system(fastq2)
+                out = open('%s/hla.allele.%s.%s.fasta'%(outdir, i, gene), 'a')
+            write_fasta(out, region, hap_seqs[i-1])
+            out.close()
         j += 1
 
 class Pedigree():
@@ -1855,6 +1815,10 @@ if __name__ == "__main__":
         rephase_vcf = '%s/%s.rephase.vcf.gz'%(outdir,gene)
         if not os.path.exists(outdir):
             os.system('mkdir '+ outdir) 
+        workdir = outdir
+        if args.workdir is not None:
+            workdir = args.workdir
+            os.makedirs(workdir, exist_ok = True)
         new_formate = False  # different para for ExtractHAIRs
         # if we have 10x or hic data, use new formate for linkage info
         # required by SpecHap
@@ -1906,20 +1870,20 @@ if __name__ == "__main__":
             # insertion sequence and the original reference
             ins_seq = get_insertion_linkage(ins_seq)
             # get copy number of long Indels
-            deletion_region = get_copy_number(outdir, deletion_region, gene, ins_seq) 
+            deletion_region = get_copy_number(workdir, deletion_region, gene, ins_seq) 
 
             if gene == 'HLA_DRB1':
                 # DRB1 contains long duplicates in the region 3900-4400 bp
                 # Infer the sequence in this region
-                dup_region_type(outdir, strainsNum, bamfile)
-                dup_file = outdir +'/select.DRB1.seq.txt'
+                dup_region_type(workdir, strainsNum, bamfile)
+                dup_file = workdir +'/select.DRB1.seq.txt'
 
             if len(ins_seq) > 0:
                 # after map reads to the long insertion sequence
                 # there can be hete variants
                 # get consensus sequence if copy number is 1 
                 # phase the variants to get two haps if copy number is 2
-                phase_insertion(gene, outdir, args.ref, sys.path[0])
+                phase_insertion(gene, workdir, args.ref, sys.path[0])
 
             # phase long indels
             sh = Share_reads(deletion_region, outdir, strainsNum, gene, gene_profile, ins_seq)
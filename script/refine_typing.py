@@ -13,6 +13,12 @@ import re
 import sys
 import pysam
 import argparse
+from db_bundle import load_table
+from blast_hits import stream_records, Running_Window
+from allele_ranking import Allele_Ranking
+
+LEN_DIFF_CUTOFF = 0.01 # the match length within this ratio of the max is good
+MIN_IDE_DIFF_CUTOFF = 0.0002 # the identity within this ratio of the max is reported for DPB1
 
 
 def get_1_element(lst):
@@ -35,32 +41,6 @@ def change_allele_name(raw, new):
             else:
                 outfile.write(line)
 
-def resort_list_with_same_alleles(sorted_list, first_index, second_index):
-    flag = True
-    while flag:
-        flag = False
-        new_sorted_list = sorted_list.copy()
-        for i in range(len(sorted_list) - 1):
-            if sorted_list[i][first_index] == sorted_list[i+1][first_index] and sorted_list[i+1][second_index] > sorted_list[i][second_index]:
-                new_sorted_list[i] = sorted_list[i+1]
-                new_sorted_list[i+1] = sorted_list[i]
-                flag = True
-        sorted_list = new_sorted_list.copy()
-    # print (sorted_list[:5])
-    return sorted_list
-    
-def get_max_alleles(sorted_list, index):
-    max_value = sorted_list[0][index]
-    max_allele_list = []
-    for list in sorted_list:
-        if list[index] == max_value:
-            # max_allele_list.append(list[0])
-            list = [str(x) for x in list]
-            max_allele_list.append(">".join(list))
-        else:
-            break
-    return max_allele_list
-
 def extract_four_digits(full_name):
     a = full_name.split("*")[1]
     array = a.split(":")
@@ -114,38 +94,30 @@ def compare_match_len_and_identity(match_sorted_list, identity_sorted_list, trut
     return select_allele_list
     
 def get_IMGT_version():
-    g_file = "%s/HLA/hla_nom_g.txt"%(args["db"])
-    G_annotation_dict = {}
-    i = 0
-    version_info = "N/A"
-    for line in open(g_file):
-        if re.search("# version:", line):
-            version_info = line.strip()
-    return version_info
+    # from the annotation bundle if it is built, see db_bundle.py
+    version_info = load_table(args["db"], 'version')
+    if version_info is None:
+        return "N/A"
+    return version_info.strip()
 
 def select_by_alignment(align_list, gene):
     if len(align_list) == 0:
         return []
     full_result_list = []
-    # match_sorted_list = sorted(align_list, key=get_1_element, reverse = True)
-    match_sorted_list = sorted(align_list, key=get_2_element, reverse = True)  # match length - mismatch
-    match_sorted_list = resort_list_with_same_alleles(match_sorted_list, 1, 3)
-    identity_sorted_list = sorted(align_list, key=get_3_element, reverse = True)
-    identity_sorted_list = resort_list_with_same_alleles(identity_sorted_list, 3, 1)
-    max_match_len_alleles = get_max_alleles(match_sorted_list, 2)
-    max_identity_alleles = get_max_alleles(identity_sorted_list, 3)
+    # match length - mismatch, identity, and match length for the ties of identity
+    ranking = Allele_Ranking(align_list, 2, 3, 1)
 
     # f = open(all_align_result_file, 'w')
-    # for mat in match_sorted_list:
+    # for mat in ranking.by_length(len(align_list)):
     #     print (mat, file = f)
     # f.close()
 
-    # print (identity_sorted_list)
-    intersection_alleles = list(set(max_match_len_alleles) & set(max_identity_alleles))   
-    # print (">>>>>>>>>", match_sorted_list[:10])
-    min_ide_diff_cutoff = 0.0002
+    # the alleles with both the max match length and the max identity
+    intersection_alleles = ranking.best()
+    # print (">>>>>>>>>", ranking.by_length(10))
+    min_ide_diff_cutoff = MIN_IDE_DIFF_CUTOFF
     if len(intersection_alleles) > 0:
-        select_allele_list = intersection_alleles[0].split(">")
+        select_allele_list = [str(x) for x in intersection_alleles[0]]
         select_allele = select_allele_list[0]
         
         if gene != "DPB1":  
@@ -153,53 +125,25 @@ def select_by_alignment(align_list, gene):
             # print (">>>>>>>>>>max_match_len allele and max_identity allele match, typed allele:", select_allele)  
         else:  # although max_match_len allele and max_identity allele match, still report ambiguity alleles for DPB1
             # print (">>>>>>>>>>report possible alleles for DPB1")  
-            for i in range(len(identity_sorted_list)):
-                if (identity_sorted_list[0][3] - identity_sorted_list[i][3])/identity_sorted_list[0][3] <= min_ide_diff_cutoff:
-                    full_result_list.append(identity_sorted_list[i])
-                    if len(full_result_list) >= 10:
-                        break
+            full_result_list = ranking.identity_window(min_ide_diff_cutoff, 10)
     else:
         # 
         # print (">>>>>>>>>>max_match_len allele and max_identity allele don't match, report possible alleles")  
-        len_diff_cutoff = 0.01 
+        len_diff_cutoff = LEN_DIFF_CUTOFF
         ide_diff_cutoff = 0.001
-        max_match_len = match_sorted_list[0][2]
-        match_len_with_max_identity = identity_sorted_list[0][1]
 
-        max_identity = identity_sorted_list[0][3]
-        identiy_with_max_match_len = match_sorted_list[0][3]
-
-        # for allele_info in match_sorted_list[:10]:
+        # for allele_info in ranking.by_length(10):
         #     print(allele_info, "length")
         # # print ("match bases**************************")
 
         
-        # for allele_info in identity_sorted_list[:10]:
+        # for allele_info in ranking.by_identity[:10]:
         #     print(allele_info, "identity")
 
-        # match_len_diff_ratio = (max_match_len - match_len_with_max_identity) / match_len_with_max_identity
-        # identity_diff_ratio = (max_identity - identiy_with_max_match_len) / identiy_with_max_match_len
-
-        # if match_len_diff_ratio > 0.3:
-        #     full_result_list = match_sorted_list[:5]
-        # else:
-        #     full_result_list = identity_sorted_list[:5] + match_sorted_list[:5]
-
-        good_length_list = []
-        for i in range(len(match_sorted_list)):
-            if (max_match_len - match_sorted_list[i][2])/max_match_len <= len_diff_cutoff:
-                good_length_list.append(match_sorted_list[i])
+        # the good match length ones, already ranked by identity
+        good_length_list = ranking.length_window(len_diff_cutoff)
         # print (len(good_length_list), "len(good_length_list)")
-        identity_sorted_list = sorted(good_length_list, key=get_3_element, reverse = True)
-        identity_sorted_list = resort_list_with_same_alleles(identity_sorted_list, 3, 1)
-        match_len_with_max_identity = identity_sorted_list[0][3]
-        # full_result_list = identity_sorted_list[:20]
-        for i in range(len(identity_sorted_list)):
-            if (match_len_with_max_identity - identity_sorted_list[i][3])/match_len_with_max_identity <= ide_diff_cutoff:
-                full_result_list.append(identity_sorted_list[i])
-                # print (match_len_with_max_identity, identity_sorted_list[i][3], (match_len_with_max_identity - identity_sorted_list[i][3])/match_len_with_max_identity)
-                if len(full_result_list) >= 30:
-                    break
+        full_result_list = ranking.identity_window(ide_diff_cutoff, 30, good_length_list)
         
         # for allele_info in identity_sorted_list[:20]:
         #     print(allele_info, "length and identity")
@@ -231,16 +175,22 @@ def output(record_best_match, gene_list, result_file, version_info):
 
     f.close()
 
-def get_blast_info(blastfile, tag):
-    align_list = []
-    for line in open(blastfile):
-        field = line.strip().split()
-        if field[0] != tag:
-            continue
+def get_blast_info(blastfile):
+    """
+    the alignments of each tag in one pass of the blast summary,
+    only the ones select_by_alignment() can report are kept,
+    i.e. close enough to the max match length or the max identity
+    """
+    windows = {}
+    for field in stream_records(blastfile):
+        if field[0] not in windows:
+            windows[field[0]] = Running_Window([get_2_element, get_3_element], [LEN_DIFF_CUTOFF, MIN_IDE_DIFF_CUTOFF])
         align_info = [field[1], int(field[3]), int(field[3])-float(field[2]), 1-float(field[2])/int(field[3]), 'x', 0, 0]
-        align_list.append(align_info)
-    identity_sorted_list = sorted(align_list, key=get_3_element, reverse = True)
-    return identity_sorted_list
+        windows[field[0]].add(align_info)
+    align_dict = {}
+    for tag in windows:
+        align_dict[tag] = sorted(windows[tag].records(), key=get_3_element, reverse = True)
+    return align_dict
 
 
 
@@ -286,6 +236,7 @@ if __name__ == "__main__":
     blastfile = f"{result_path}/hla.blast.summary.txt"
 
     print (f"optimize typing results by balancing alignment length and identity ")
+    align_dict = get_blast_info(blastfile)
 
     for hap_index in range(2):
 
@@ -293,7 +244,7 @@ if __name__ == "__main__":
             if gene not in record_best_match:
                 record_best_match[gene] = {}
             tag = f"HLA_{gene}_{hap_index+1}"
-            align_list = get_blast_info(blastfile, tag)
+            align_list = align_dict.get(tag, [])
 
             full_result_list = select_by_alignment(align_list, gene)
             record_best_match[gene][hap_index+1] = full_result_list
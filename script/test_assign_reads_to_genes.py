@@ -0,0 +1,84 @@
+"""
+check that the parallel read assignment equals the serial one,
+on a synthetic map_database.bam built with pysam
+
+python -m pytest script/test_assign_reads_to_genes.py
+or
+python script/test_assign_reads_to_genes.py
+
+wangshuai, wshuai294@gmail.com
+"""
+
+import random
+import argparse
+import tempfile
+import pysam
+import assign_reads_to_genes
+
+READ_NUM = 3000
+ALLELES = ['%s*0%s:01'%(gene, i) for gene in ['A', 'B', 'C', 'DRB1'] for i in range(1, 4)]
+
+def make_bam(bam, grouped = True, sort_order = 'unsorted', seed = 0):
+    """
+    pair-end reads mapped to a few alleles each, with clipped, mismatched
+    and discordant alignments, all the alignments of a read are adjacent if grouped
+    """
+    random.seed(seed)
+    header = {'HD': {'VN': '1.6', 'SO': sort_order}, 'SQ': [{'SN': allele, 'LN': 5000} for allele in ALLELES]}
+    alignments = []
+    for r in range(READ_NUM):
+        for ref in random.sample(range(len(ALLELES)), random.randint(1, 4)):
+            for flag in [1 | 2 | 64, 1 | 2 | 128]:
+                alignment = pysam.AlignedSegment()
+                alignment.query_name = 'read%s'%(r)
+                alignment.flag = flag
+                alignment.reference_id = ref
+                alignment.next_reference_id = ref if random.random() > 0.05 else (ref + 1) % len(ALLELES)
+                alignment.reference_start = random.randint(0, 4000)
+                alignment.next_reference_start = alignment.reference_start + 200
+                alignment.cigarstring = random.choice(['150M', '150M', '100M2I48M', '70M3D80M', '5S145M'])
+                alignment.query_sequence = 'A' * 150
+                alignment.query_qualities = [30] * 150
+                alignment.set_tag('NM', random.choice([0, 0, 0, 1, 2, 3]))
+                alignments.append(alignment)
+    if not grouped:
+        random.shuffle(alignments)
+    with pysam.AlignmentFile(bam, 'wb', header = header) as out:
+        for alignment in alignments:
+            out.write(alignment)
+
+def check_bam(bam):
+    assign_reads_to_genes.options = argparse.Namespace(bam = bam, max_nm = 2, diff_score = 0.1)
+    assign_reads_to_genes.BATCH_SIZE = 1000 # cut the small bam into many batches
+    serial_assign_dict, serial_count = assign_reads_to_genes.assign_bam()
+    assign_dict, count_read_for_each_gene = assign_reads_to_genes.assign_parallel(4)
+    assert len(serial_assign_dict) > 0
+    assert assign_dict == serial_assign_dict
+    assert count_read_for_each_gene == serial_count
+    # the streaming assignment equals keeping all the reads in memory
+    memory_assign_dict, memory_count = {}, {}
+    bamfile = pysam.AlignmentFile(bam, 'rb')
+    assign_reads_to_genes.assign_in_memory(assign_reads_to_genes.score_alignments(bamfile), memory_assign_dict, memory_count)
+    bamfile.close()
+    assert serial_assign_dict == memory_assign_dict
+    assert serial_count == memory_count
+
+def test_name_grouped(tmp_path):
+    make_bam(str(tmp_path / 'grouped.bam'))
+    check_bam(str(tmp_path / 'grouped.bam'))
+
+def test_not_grouped_without_header(tmp_path):
+    # the header claims no sort order, but the reads are scattered
+    make_bam(str(tmp_path / 'scattered.bam'), grouped = False)
+    check_bam(str(tmp_path / 'scattered.bam'))
+
+def test_coordinate_sorted(tmp_path):
+    make_bam(str(tmp_path / 'coordinate.bam'), grouped = False, sort_order = 'coordinate')
+    check_bam(str(tmp_path / 'coordinate.bam'))
+
+if __name__ == "__main__":
+    from pathlib import Path
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for test in [test_name_grouped, test_not_grouped_without_header, test_coordinate_sorted]:
+            test(Path(tmp_dir))
+            print (test.__name__, 'passed.')
@@ -13,6 +13,8 @@ import re
 import sys
 import pysam
 import argparse
+from db_bundle import load_table
+from allele_ranking import Allele_Ranking
 
 
 def get_1_element(lst):
@@ -104,33 +106,6 @@ def ana_sam(input_sam, gene, sample):
     identity_sorted_list = sorted(align_list, key=get_3_element, reverse = True)
     return identity_sorted_list
 
-def resort_list_with_same_alleles(sorted_list, first_index, second_index):
-    flag = True
-    while flag:
-        flag = False
-        new_sorted_list = sorted_list.copy()
-        for i in range(len(sorted_list) - 1):
-            if sorted_list[i][first_index] == sorted_list[i+1][first_index] and sorted_list[i+1][second_index] > sorted_list[i][second_index]:
-                new_sorted_list[i] = sorted_list[i+1]
-                new_sorted_list[i+1] = sorted_list[i]
-                flag = True
-        sorted_list = new_sorted_list.copy()
-    # print (sorted_list[:5])
-    return sorted_list
-    
-def get_max_alleles(sorted_list, index):
-    # print (sorted_list)
-    max_value = sorted_list[0][index]
-    max_allele_list = []
-    for list in sorted_list:
-        if list[index] == max_value:
-            # max_allele_list.append(list[0])
-            list = [str(x) for x in list]
-            max_allele_list.append(">".join(list))
-        else:
-            break
-    return max_allele_list
-
 def extract_four_digits(full_name):
     a = full_name.split("*")[1]
     array = a.split(":")
@@ -311,19 +286,17 @@ class Assign_allele():
 
     def select_by_alignment(self, align_list, truth_alleles):
 
-        match_sorted_list = sorted(align_list, key=get_1_element, reverse = True)
-        match_sorted_list = resort_list_with_same_alleles(match_sorted_list, 1, 3)
-        identity_sorted_list = sorted(align_list, key=get_3_element, reverse = True)
-        identity_sorted_list = resort_list_with_same_alleles(identity_sorted_list, 3, 1)
-        max_match_len_alleles = get_max_alleles(match_sorted_list, 1)
-        max_identity_alleles = get_max_alleles(identity_sorted_list, 3)
+        # matching bases, identity, and matching bases for the ties of identity
+        ranking = Allele_Ranking(align_list, 1, 3, 1)
+        match_sorted_list = ranking.by_length(10)
+        identity_sorted_list = ranking.by_identity
 
-        # print (identity_sorted_list)
-        intersection_alleles = list(set(max_match_len_alleles) & set(max_identity_alleles))   
+        # the alleles with both the max matching bases and the max identity
+        intersection_alleles = ranking.best()
         print (">>>>>>>>>", match_sorted_list[:10])
 
         if len(intersection_alleles) > 0:
-            select_allele_list = intersection_alleles[0].split(">")
+            select_allele_list = [str(x) for x in intersection_alleles[0]]
             select_allele = select_allele_list[0]
             print (">>>>>>>>>>perfect:", select_allele)      
             return select_allele_list
@@ -387,14 +360,11 @@ class Assign_allele():
         return new_align_list
 
 def get_IMGT_version():
-    g_file = "%s/../db/HLA/hla_nom_g.txt"%(sys.path[0])
-    G_annotation_dict = {}
-    i = 0
-    version_info = "N/A"
-    for line in open(g_file):
-        if re.search("# version:", line):
-            version_info = line.strip()
-    return version_info
+    # from the annotation bundle if it is built, see db_bundle.py
+    version_info = load_table("%s/../db"%(sys.path[0]), 'version')
+    if version_info is None:
+        return "N/A"
+    return version_info.strip()
 
 if __name__ == "__main__":
 
@@ -1,68 +1,140 @@
 """
 In some real samples, the read name is not unique.
 This script removes the repeat reads
+
+usage: python uniq_read_name.py <fq1> <out1.gz> [<fq2> <out2.gz>]
+with both read files, R1 and R2 are processed in parallel.
+For each output, the read names are also saved in <out>.names.gz,
+one name per fastq record, so the read binning can take the names
+without parsing the fastq headers again.
+With -m 1, the repeat names are found by 8-byte fingerprints in a first pass,
+only the names with repeated fingerprints are counted exactly in the second pass.
+By default, -m 1 is used for the read file estimated to have more than 1M reads.
 """
 
 import sys
 import gzip
 import os
+import io
+import hashlib
+import argparse
+import numpy as np
+from multiprocessing import Pool
+from assign_reads_to_genes import get_read_name, open_fastq
 
-def read_fq(file, outfile):
-    saved_name = {}
-    out = gzip.open(outfile, 'wt')
+compresslevel = 1 # the outputs are intermediate files, favor speed
+LOW_MEMORY_READ_NUM = 1000000 # use the low-memory mode above this read num by default
+
+def get_name_file(outfile):
+    return outfile[:-3] + '.names.gz'
+
+def fingerprint(name):
+    return int.from_bytes(hashlib.blake2b(name.encode(), digest_size = 8).digest(), 'little')
+
+def get_repeat_fingerprints(file):
+    """
+    first pass of the low-memory mode,
+    keep only 8 bytes for each read name,
+    return the fingerprints seen more than once,
+    which cover all the repeat names and the rare fingerprint collisions
+    """
+    fingerprints = bytearray()
     line_num = 0
-    for line in gzip.open(file, 'rt'):
-        line = line.strip()
-        #if line[0] == '@':
+    f = open_fastq(file)
+    for line in f:
         if line_num % 4 == 0:
-            name = line[1:-2]
-            if name in saved_name.keys():
-                saved_name[name] += 1
-                name = name + '_' + str(saved_name[name])
-                line = line[0] + name + line[-2:]
-            else:
-                saved_name[name] = 1
-            print (line, file= out)
-            #print (line, name)
-        #break
-        else:
-            print (line, file= out)
+            name = line.strip()[1:-2]
+            fingerprints += fingerprint(name).to_bytes(8, 'little')
         line_num += 1
-    out.close()
-    return line_num
+    f.close()
+    # view the bytearray without a copy and sort it in place, 8 bytes per read at the peak
+    fingerprints = np.frombuffer(fingerprints, dtype = '<u8')
+    fingerprints.sort()
+    repeat = fingerprints[1:][fingerprints[1:] == fingerprints[:-1]]
+    return set(np.unique(repeat).tolist())
+
+def estimate_read_num(file, sample_read_num = 10000):
+    """
+    scale the read num of the first reads by the file size,
+    the bytes of them on disk are counted, so it works for gzipped files too
+    """
+    raw = open(file, 'rb')
+    if file.split(".")[-1] == "gz":
+        f = gzip.open(raw, 'rt')
+    else:
+        f = io.TextIOWrapper(raw)
+    line_num = 0
+    for line in f:
+        line_num += 1
+        if line_num == 4 * sample_read_num:
+            break
+    read_num = int(line_num/4)
+    used_bytes = raw.tell()
+    f.close()
+    if read_num < sample_read_num or used_bytes == 0: # the whole file is read
+        return read_num
+    return int(read_num * os.path.getsize(file) / used_bytes)
 
-def read_fq_unzip(file, outfile):
+def uniq_fq(file, outfile, low_memory = None):
+    """
+    rename the repeat reads to <read name>_<occurrence>,
+    write the renamed fastq and the read-name index in one pass,
+    in the low-memory mode, only the names with repeated fingerprints
+    are saved, so the same reads are renamed
+    """
+    if low_memory is None:
+        low_memory = 1 if estimate_read_num(file) > LOW_MEMORY_READ_NUM else 0
+        if low_memory == 1:
+            print ("More than %s reads are estimated in %s, use the low-memory mode."%(LOW_MEMORY_READ_NUM, file))
+    if low_memory == 1:
+        repeat_fingerprints = get_repeat_fingerprints(file)
     saved_name = {}
-    out = open(outfile, 'w')
+    out = gzip.open(outfile, 'wt', compresslevel = compresslevel)
+    name_out = gzip.open(get_name_file(outfile), 'wt', compresslevel = compresslevel)
     line_num = 0
-    for line in open(file, 'r'):
+    f = open_fastq(file)
+    for line in f:
         line = line.strip()
         #if line[0] == '@':
         if line_num % 4 == 0:
             name = line[1:-2]
-            if name in saved_name.keys():
+            if low_memory == 1 and fingerprint(name) not in repeat_fingerprints:
+                pass # the name occurs only once
+            elif name in saved_name:
                 saved_name[name] += 1
                 name = name + '_' + str(saved_name[name])
                 line = line[0] + name + line[-2:]
             else:
                 saved_name[name] = 1
-            print (line, file= out)
-            #print (line, name)
-        #break
-        else:
-            print (line, file= out)
+            name_out.write(get_read_name(line) + '\n')
+        out.write(line + '\n')
         line_num += 1
+    f.close()
     out.close()
+    name_out.close()
     return line_num
 
 if __name__ == "__main__":
 
-    if sys.argv[1][-3:] == ".gz":
-        line_num = read_fq(sys.argv[1], sys.argv[2])
-    else:
-        line_num = read_fq_unzip(sys.argv[1], sys.argv[2][:-3])
-        os.system("gzip -f %s"%(sys.argv[2][:-3]))
-    reads_num = int(line_num/4)
-    if reads_num > 1000000:
-        print ("WARNING: %s reads are detected, please check if they are HLA-related reads.\
-            If not, please extract HLA-related reads first. Otherwise, the process will be slow."%(reads_num))
+    parser = argparse.ArgumentParser(description='Rename the repeat reads')
+    parser.add_argument('files', nargs='+', help='<fq1> <out1.gz> [<fq2> <out2.gz>]')
+    parser.add_argument('-m', '--low_memory', help='Find the repeat names with read-name fingerprints,\
+         use it for more than 1M reads [0|1], by default 1 if more than 1M reads are estimated\
+         in the read file', required=False, default = None, type=int)
+    args = parser.parse_args()
+    if len(args.files) not in [2, 4]:
+        parser.error('expect 2 files <fq1> <out1.gz> or 4 files <fq1> <out1.gz> <fq2> <out2.gz>, got %s'%(len(args.files)))
+
+    jobs = [(args.files[0], args.files[1], args.low_memory)]
+    if len(args.files) == 4:
+        jobs.append((args.files[2], args.files[3], args.low_memory))
+    pool = Pool(len(jobs))
+    line_nums = pool.starmap(uniq_fq, jobs)
+    pool.close()
+    pool.join()
+    for line_num in line_nums:
+        reads_num = int(line_num/4)
+        if reads_num > 1000000:
+            print ("WARNING: %s reads are detected, please check if they are HLA-related reads.\
+                If not, please extract HLA-related reads first. Otherwise, the process will be slow."%(reads_num))
+            break
@@ -51,6 +51,8 @@
 ###   -b        Whether use database for unlinked block phasing [0|1], default is 1 (i.e., use).
 ###   -i        Location of the IMGT/HLA database folder, default is db.
 ###   -l        Whether remove all tmp files [0|1], default is 1.
+###   -P        Whether align and phase the eight genes in parallel within the -j threads [0|1],
+###             default is 0. Not used with 10x data.
 ###   -h        Show this message.
 
 #   -g        Whether use G group resolution annotation [0|1], default is 0 (i.e., not use).
@@ -64,7 +66,7 @@ if [[ $# == 0 ]] || [[ "$1" == "-h" ]]; then
     exit 1
 fi
 
-while getopts ":n:1:2:p:f:m:v:q:t:a:e:x:c:d:r:y:o:j:w:u:s:g:k:z:y:f:b:l:i:" opt; do
+while getopts ":n:1:2:p:f:m:v:q:t:a:e:x:c:d:r:y:o:j:w:u:s:g:k:z:y:f:b:l:i:P:" opt; do
   case $opt in
     n) sample="$OPTARG"
     ;;
@@ -120,6 +122,8 @@ while getopts ":n:1:2:p:f:m:v:q:t:a:e:x:c:d:r:y:o:j:w:u:s:g:k:z:y:f:b:l:i:" opt;
     ;;
     l) rm_tmp="$OPTARG"
     ;;
+    P) parallel_loci="$OPTARG"
+    ;;
     \?) echo "Invalid option -$OPTARG" >&2
     ;;
   esac
@@ -147,6 +151,39 @@ mkdir -p $outdir
 group='@RG\tID:'$sample'\tSM:'$sample
 echo use ${num_threads:-5} threads.
 
+# run the eight genes concurrently, the threads are split among the running genes
+# the linked reads of 10x data are aligned once within HLA_A, so 10x data run the genes one by one
+if [ ${parallel_loci:-0} == 1 ] && [ ${tenx_data:-NA} == NA ];then
+    gene_jobs=$(( ${num_threads:-5} < 8 ? ${num_threads:-5} : 8 ))
+    gene_threads=$(( ${num_threads:-5} / gene_jobs ))
+    echo run $gene_jobs genes in parallel, each with $gene_threads threads.
+else
+    parallel_loci=0
+    gene_jobs=1
+    gene_threads=${num_threads:-5}
+fi
+wait_gene_job() { # wait until a job slot is free
+    while [ $(jobs -rp | wc -l) -ge $gene_jobs ]; do
+        wait -n
+    done
+}
+gene_pids=()
+gene_names=()
+wait_gene_pids() { # wait for each recorded gene job, stop if any of them failed
+    failed_genes=""
+    for i in ${!gene_pids[@]}; do
+        if ! wait ${gene_pids[$i]}; then
+            failed_genes="$failed_genes ${gene_names[$i]}"
+        fi
+    done
+    gene_pids=()
+    gene_names=()
+    if [ "$failed_genes" != "" ]; then
+        echo "Error: $1 failed for HLA gene(s):$failed_genes, stop."
+        exit 1
+    fi
+}
+
 
 # ##############check if the input fastq is empty################
 if [[ ! -s $fq1 ]]; then
@@ -165,8 +202,8 @@ fi
 
 # :<<!
 # ################ remove the repeat read name #################
-$python_bin $dir/../uniq_read_name.py $fq1 $outdir/$sample.uniq.name.R1.gz
-$python_bin $dir/../uniq_read_name.py $fq2 $outdir/$sample.uniq.name.R2.gz
+# R1 and R2 are processed in parallel, the read names are indexed for the read binning
+$python_bin $dir/../uniq_read_name.py $fq1 $outdir/$sample.uniq.name.R1.gz $fq2 $outdir/$sample.uniq.name.R2.gz
 fq1=$outdir/$sample.uniq.name.R1.gz
 fq2=$outdir/$sample.uniq.name.R2.gz
 # ###############################################################
@@ -189,15 +226,16 @@ if [ -f "$license" ];then
     fi
     $bin/novoalign -d $db/ref/$database_prefix.ndx -f $fq1 $fq2 -F STDFQ -o SAM \
     -o FullNW -r All 100000 --mCPU ${num_threads:-5} -c 10  -g 20 -x 3  | samtools view \
-    -Sb - | samtools sort -  > $outdir/$sample.map_database.bam
+    -Sb - > $outdir/$sample.map_database.bam
 else
     echo "Can't detect novoalign license, use bowtie2." 
     bowtie2 --very-sensitive -p ${num_threads:-5} -k 30 -x $db/ref/$database_prefix.fasta -1 $fq1 -2 $fq2|\
-    samtools view -bS -| samtools sort - >$outdir/$sample.map_database.bam
+    samtools view -bS - >$outdir/$sample.map_database.bam
 fi
-samtools index $outdir/$sample.map_database.bam
+# keep the aligner output grouped by read name, reads are assigned in streaming
 $python_bin $dir/../assign_reads_to_genes.py -1 $fq1 -2 $fq2 -n $bin -o $outdir -d ${mini_score:-0.1} \
--b ${outdir}/${sample}.map_database.bam -nm ${nm:-2}
+-b ${outdir}/${sample}.map_database.bam -nm ${nm:-2} -j ${num_threads:-5} \
+--names1 $outdir/$sample.uniq.name.R1.names.gz --names2 $outdir/$sample.uniq.name.R2.names.gz
 # #############################################################################################################
 
 
@@ -208,10 +246,15 @@ bwa mem -U 10000 -L 10000,10000 -R $group $hlaref $fq1 $fq2 | samtools view -H
 hlas=(A B C DPA1 DPB1 DQA1 DQB1 DRB1)
 for hla in ${hlas[@]}; do
         hla_ref=$db/HLA/HLA_$hla/HLA_$hla.fa
-        bwa mem -t ${num_threads:-5} -U 10000 -L 10000,10000 -R $group $hla_ref $outdir/$hla.R1.fq.gz $outdir/$hla.R2.fq.gz\
-         | samtools view -bS -F 0x800 -| samtools sort - >$outdir/$hla.bam
-        samtools index $outdir/$hla.bam
+        wait_gene_job
+        (set -o pipefail
+        bwa mem -t $gene_threads -U 10000 -L 10000,10000 -R $group $hla_ref $outdir/$hla.R1.fq.gz $outdir/$hla.R2.fq.gz\
+         | samtools view -bS -F 0x800 -| samtools sort -T $outdir/$hla.sort.tmp - >$outdir/$hla.bam &&
+        samtools index $outdir/$hla.bam) &
+        gene_pids+=($!)
+        gene_names+=($hla)
 done
+wait_gene_pids "the alignment of the gene-specific reads"
 samtools merge -f -h $outdir/header.sam $outdir/$sample.merge.bam $outdir/A.bam $outdir/B.bam $outdir/C.bam\
  $outdir/DPA1.bam $outdir/DPB1.bam $outdir/DQA1.bam $outdir/DQB1.bam $outdir/DRB1.bam
 samtools index $outdir/$sample.merge.bam
@@ -314,8 +357,12 @@ else
 fi
 
 echo Minimum Minor Allele Frequency is $my_maf.
-hlas=(A B C DPA1 DPB1 DQA1 DQB1 DRB1)
-for hla in ${hlas[@]}; do
+if [ $parallel_loci == 1 ];then
+    samtools index $bam # index the shared bam once before the genes run
+fi
+phase_gene() { # phase the variants of one gene
+hla=$1
+workdir=$2
 hla_ref=$db/ref/HLA_$hla.fa
 $python_bin $dir/../phase_variants.py \
   -o $outdir \
@@ -337,11 +384,31 @@ $python_bin $dir/../phase_variants.py \
   --sa $sample \
   --weight_imb ${weight_imb:-0} \
   --exon $focus_exon_flag \
-  --thread_num ${num_threads:-5} \
+  --thread_num $gene_threads \
   --use_database ${use_database:-1} \
   --trio ${trio:-None} \
+  --workdir $workdir \
   --db ${db}
+}
+hlas=(A B C DPA1 DPB1 DQA1 DQB1 DRB1)
+for hla in ${hlas[@]}; do
+if [ $parallel_loci == 1 ];then
+    # each gene keeps its intermediate files in its own dir
+    mkdir -p $outdir/work/HLA_$hla
+    wait_gene_job
+    phase_gene $hla $outdir/work/HLA_$hla >$outdir/work/HLA_$hla.log 2>&1 &
+    gene_pids+=($!)
+    gene_names+=($hla)
+else
+    phase_gene $hla $outdir || { echo "Error: the phasing failed for HLA gene(s): $hla, stop."; exit 1; }
+fi
 done
+if [ $parallel_loci == 1 ];then
+    # print the logs before stopping on a failed gene
+    for i in ${!gene_pids[@]}; do wait ${gene_pids[$i]}; done
+    for hla in ${hlas[@]}; do cat $outdir/work/HLA_$hla.log; done
+    wait_gene_pids "the phasing"
+fi
 # ##################################################################################################
 
 
@@ -0,0 +1,173 @@
+"""
+the exact-match index of the exon database for the G group annotation,
+the identical exon sequences are merged, and keyed by the 2-bit code of
+their first 32 bases, the arrays are saved as .npy files and loaded memory-mapped,
+build it once per IMGT release:
+
+python3 exon_index.py <db folder>
+
+the G group annotation sums the identity of each exon hit by an allele,
+so an allele with all its exons in a hap verbatim can still lose in blastn
+to an allele with more exons and a few mismatches,
+the hap is annotated without blastn only if the best exact allele has
+as many exons as the most in its gene, then no other allele can score higher,
+the other haps still go to blastn
+
+wangshuai, wshuai294@gmail.com
+"""
+
+import os
+import sys
+import numpy as np
+from Bio import SeqIO
+
+K = 32 # the prefix length of the key, 2 bits per base in uint64
+INDEX_FILES = ['keys', 'seq', 'offset', 'member_ptr', 'member', 'exon_allele', 'allele_names', 'allele_exon_num',\
+    'gene_exon_num']
+
+base_code = np.full(256, -1, dtype = np.int64)
+for i, base in enumerate('ACGT'):
+    base_code[ord(base)] = i
+    base_code[ord(base.lower())] = i
+
+def encode(seq):
+    # the 2-bit code of each base, -1 for the other bases
+    return base_code[np.frombuffer(seq.encode(), dtype = np.uint8)]
+
+def kmer_keys(seq):
+    """
+    the key of the k-mer starting at each position of the seq,
+    and whether the k-mer has only ACGT
+    """
+    code = encode(seq)
+    window_num = max(len(code) - K + 1, 0)
+    keys = np.zeros(window_num, dtype = np.uint64)
+    valid = np.ones(window_num, dtype = bool)
+    for j in range(K):
+        window = code[j:j+window_num]
+        valid &= window >= 0
+        keys = (keys << np.uint64(2)) | np.maximum(window, 0).astype(np.uint64)
+    return keys, valid
+
+def read_exons(db):
+    # the exon records of hla_exons.fasta, dumped from the blast database if the fasta is not kept
+    fasta = f"{db}/HLA/hla_exons.fasta"
+    if os.path.isfile(fasta):
+        return [(record.id, str(record.seq).upper()) for record in SeqIO.parse(fasta, 'fasta')]
+    dump = f"{db}/HLA/hla_exons.dump.fasta"
+    os.system(f"blastdbcmd -db {fasta} -entry all -out {dump}")
+    exons = [(record.id, str(record.seq).upper()) for record in SeqIO.parse(dump, 'fasta')]
+    os.remove(dump)
+    return exons
+
+def build_index(db):
+    outdir = f"{db}/HLA/hla_exons.index"
+    os.makedirs(outdir, exist_ok = True)
+    exons = read_exons(db)
+    allele_index = {}
+    exon_allele = []
+    unique_seq = {} # seq: [key, exon indexes]
+    for i, (exon, seq) in enumerate(exons):
+        allele = exon.split("|")[0]
+        if allele not in allele_index:
+            allele_index[allele] = len(allele_index)
+        exon_allele.append(allele_index[allele])
+        keys, valid = kmer_keys(seq[:K])
+        if len(keys) == 0 or not valid[0]:
+            continue # no key, so its allele is left to blastn
+        if seq not in unique_seq:
+            unique_seq[seq] = [int(keys[0])]
+        unique_seq[seq].append(i)
+    seqs = sorted(unique_seq, key = lambda seq: unique_seq[seq][0])
+    keys = np.array([unique_seq[seq][0] for seq in seqs], dtype = np.uint64)
+    offset = np.zeros(len(seqs) + 1, dtype = np.int64)
+    np.cumsum([len(seq) for seq in seqs], out = offset[1:])
+    allele_exon_num = np.bincount(exon_allele, minlength = len(allele_index)).astype(np.int32)
+    # the max exon num of the gene of each allele
+    gene_max = {}
+    for allele, i in allele_index.items():
+        gene = allele.split("*")[0]
+        gene_max[gene] = max(gene_max.get(gene, 0), allele_exon_num[i])
+    gene_exon_num = np.array([gene_max[allele.split("*")[0]] for allele in allele_index], dtype = np.int32)
+    member_ptr = np.zeros(len(seqs) + 1, dtype = np.int64)
+    np.cumsum([len(unique_seq[seq]) - 1 for seq in seqs], out = member_ptr[1:])
+    index = {
+        'keys': keys,
+        'seq': np.frombuffer(''.join(seqs).encode(), dtype = np.uint8),
+        'offset': offset,
+        'member_ptr': member_ptr,
+        'member': np.array([i for seq in seqs for i in unique_seq[seq][1:]], dtype = np.int32),
+        'exon_allele': np.array(exon_allele, dtype = np.int32),
+        'allele_names': np.array(list(allele_index), dtype = bytes),
+        'allele_exon_num': allele_exon_num,
+        'gene_exon_num': gene_exon_num,
+    }
+    for name in INDEX_FILES:
+        np.save(f"{outdir}/{name}.npy", index[name])
+    print (f"{len(exons)} exons, {len(seqs)} unique sequences, {len(allele_index)} alleles are indexed in {outdir}.")
+
+def load_exon_index(db):
+    # None if the index is not built
+    outdir = f"{db}/HLA/hla_exons.index"
+    if not all([os.path.isfile(f"{outdir}/{name}.npy") for name in INDEX_FILES]):
+        if os.path.isdir(outdir):
+            print (f"The exon index in {outdir} is outdated, rebuild it by python3 exon_index.py {db}.")
+        return None
+    return Exon_Index(outdir)
+
+class Exon_Index():
+
+    def __init__(self, outdir):
+        for name in INDEX_FILES:
+            setattr(self, name, np.load(f"{outdir}/{name}.npy", mmap_mode = 'r'))
+
+    def contained_exons(self, hap_seqs):
+        # the exons found verbatim in any of the hap sequences, exon: length
+        exons = {}
+        for hap_seq in hap_seqs:
+            hap_seq = hap_seq.upper()
+            hap_bytes = hap_seq.encode()
+            keys, valid = kmer_keys(hap_seq)
+            left = np.searchsorted(self.keys, keys, 'left')
+            right = np.searchsorted(self.keys, keys, 'right')
+            for pos in np.flatnonzero((right > left) & valid).tolist():
+                for u in range(int(left[pos]), int(right[pos])):
+                    start, end = int(self.offset[u]), int(self.offset[u+1])
+                    if hap_bytes[pos:pos+end-start] == self.seq[start:end].tobytes():
+                        for exon in self.member[self.member_ptr[u]:self.member_ptr[u+1]].tolist():
+                            exons[exon] = end - start
+        return exons
+
+    def exact_alleles(self, hap_seqs, keep):
+        """
+        the alleles with the highest blastn score among the alleles whose exons
+        are all in the hap verbatim, keep(allele) filters the alleles,
+        return [] if none, or if they have fewer exons than the most in the gene,
+        in that case an allele with more exons may score higher in blastn,
+        in the order of the database
+        """
+        exons = self.contained_exons(hap_seqs)
+        allele_exons = {}
+        for exon in exons:
+            allele = int(self.exon_allele[exon])
+            if allele not in allele_exons:
+                allele_exons[allele] = []
+            allele_exons[allele].append(exon)
+        scores = {}
+        for allele, exon_list in allele_exons.items():
+            if len(exon_list) != self.allele_exon_num[allele]:
+                continue
+            name = self.allele_names[allele].decode()
+            if not keep(name):
+                continue
+            scores[allele] = (100 * len(exon_list), sum([exons[exon] for exon in exon_list]))
+        if len(scores) == 0:
+            return []
+        best = max(scores.values())
+        winner = [allele for allele in scores if scores[allele] == best][0]
+        if self.allele_exon_num[winner] < self.gene_exon_num[winner]:
+            return []
+        return [self.allele_names[allele].decode() for allele in sorted(scores) if scores[allele] == best]
+
+if __name__ == "__main__":
+    build_index(sys.argv[1])
@@ -12,7 +12,13 @@ import re
 import pandas as pd
 import numpy as np
 from collections import Counter
+from multiprocessing import Process, Queue
+import queue
 import argparse
+from exon_index import load_exon_index
+sys.path.append(os.path.dirname(os.path.abspath(sys.path[0]))) # the db_bundle and blast_hits modules are in script/
+from db_bundle import load_table
+from blast_hits import stream_hits, query_groups, top_group
 
 gene_list = ['A', 'B', 'C', 'DPA1', 'DPB1', 'DQA1', 'DQB1', 'DRB1']
 
@@ -30,39 +36,10 @@ def count_n_ratio(fasta_file):
     return ratio
 
 def read_G_annotation(db):
-    g_file = f"{db}/HLA/hla_nom_g.txt"
-    G_annotation_dict = {}
-    i = 0
-    for line in open(g_file):
-        if re.search("# version:", line):
-            version_info = line
-        if line[0] == "#":
-            continue
-        # line.replace(":","_", 10000)
-        line = re.sub(":","_",line)
-        array = line.strip().split(";")
-        gene = array[0][:-1]
-        
-        if len(array[-1]) == 0:
-            
-            g_name = gene + "_" + array[-2]
-            # print (g_name)
-            G_annotation_dict[g_name] = g_name
-        else:
-            g_name = gene + "_" + array[-1]
-            alleles = array[-2].split("/")
-            for each in alleles:
-                each = gene + "_" + each
-                G_annotation_dict[each] = g_name
-        # print (array, g_name)
-        # print (G_annotation_dict)
-        # print (len(array))
-        # if i > 2:
-        #     break
-        i += 1
-    return G_annotation_dict, version_info
-
-def convert_G(allele):
+    # from the annotation bundle if it is built, see db_bundle.py
+    return load_table(db, 'G_annotation'), load_table(db, 'version')
+
+def convert_G(allele, G_annotation_dict):
     allele = re.sub(":","_",allele)
     allele = re.sub("HLA-","",allele)
     allele = re.sub("\*","_",allele)
@@ -76,34 +53,99 @@ def convert_G(allele):
     G_type = allele
     return G_type
 
+class Annotation_DB():
+    """
+    the G group table and the population frequencies,
+    load them once and reuse them for all the samples in a process
+    """
+    def __init__(self, db, pop, threads):
+        self.exon_database = f"{db}/HLA/hla_exons.fasta"
+        self.freq = f"{db}/HLA/HLA_FREQ_HLA_I_II.txt"
+        self.G_annotation_dict, self.version_info = read_G_annotation(db)
+        self.hashp = population(pop, "whole", load_table(db, 'freq'))
+        self.pop = pop
+        self.threads = threads
+        self.exon_index = load_exon_index(db) # None if not built, then all the haps go to blastn
+
+def blast_haps(query_file, blast_result_file, ann_db):
+    """
+    map all the haps in the multi-FASTA query to the exon database in one blastn run,
+    the records are named <hap>.<record index>, return the hits of each hap
+    """
+    if os.path.getsize(query_file) == 0:
+        return {}
+    command = f"""
+    blastn -query {query_file} -out {blast_result_file} -db {ann_db.exon_database} -outfmt 7 -max_target_seqs 60000 -num_threads {ann_db.threads}
+    """
+    os.system(command)
+    hits = {}
+    for query, query_hits in query_groups(stream_hits(blast_result_file)):
+        hap = query.rsplit(".", 1)[0]
+        if hap not in hits:
+            hits[hap] = []
+        hits[hap] += query_hits
+    return hits
+
+def annotate_batch(g_ann_list, workdir):
+    """
+    annotate the samples with one blastn run,
+    the exon database and the threads of the first sample are used
+    """
+    query_file = f"{workdir}/batch.{os.getpid()}.exon.query.fasta"
+    f = open(query_file, 'w')
+    for i in range(len(g_ann_list)):
+        g_ann_list[i].exact_annotate()
+        g_ann_list[i].write_query(f, f"{i}_")
+    f.close()
+    hits = blast_haps(query_file, f"{workdir}/batch.{os.getpid()}.exon.blast", g_ann_list[0].ann_db)
+    for i in range(len(g_ann_list)):
+        g_ann_list[i].annotate(hits, f"{i}_")
+
 class G_annotation():
-    def __init__(self, sample, spechla_dir):
+    def __init__(self, sample, spechla_dir, ann_db):
         self.sample = sample
         self.spechla_dir = spechla_dir
-    
-    def blast(self, infer_hap_file, blast_result_file):
-        # command = f"""
-        # blastn -query {infer_hap_file} -out {blast_result_file} -subject {exon_database} -outfmt 7 -max_target_seqs 60000
-        # """
-        command = f"""
-        blastn -query {infer_hap_file} -out {blast_result_file} -db {exon_database} -outfmt 7 -max_target_seqs 60000 -num_threads {args["j"]}
-        """
-        os.system(command)  
+        self.ann_db = ann_db
+        self.exact_results = {} # (gene, hap index): G group of the haps resolved by exact exon match
+
+    def exact_annotate(self):
+        # the haps containing all the exons of an allele verbatim need no blastn
+        self.exact_results = {}
+        if self.ann_db.exon_index is None:
+            return
+        keep = lambda allele: self.ann_db.pop == "nonuse" or self.check_pop(allele)
+        for gene in gene_list:
+            for hap_index in range(1,3):
+                infer_hap_file = f"{self.spechla_dir}/hla.allele.{hap_index}.HLA_{gene}.fasta"
+                hap_seqs = [str(record.seq) for record in SeqIO.parse(infer_hap_file, 'fasta')]
+                alleles = self.ann_db.exon_index.exact_alleles(hap_seqs, keep)
+                if len(alleles) > 0:
+                    top_alleles = [convert_G(allele, self.ann_db.G_annotation_dict) for allele in alleles]
+                    self.exact_results[(gene, hap_index)] = most_common(top_alleles)
+        print ("%s of the %s haps are annotated by exact exon match."%(len(self.exact_results), 2*len(gene_list)))
+
+    def write_query(self, f, prefix = ""):
+        # add the haps of the sample not resolved by exact exon match to the multi-FASTA query
+        for gene in gene_list:
+            for hap_index in range(1,3):
+                infer_hap_file = f"{self.spechla_dir}/hla.allele.{hap_index}.HLA_{gene}.fasta"
+                n_ratio = count_n_ratio(infer_hap_file) # cal the ratio of N in the fasta
+                print ("The ratio of N (masked) is %s for the allele %s"%(n_ratio, infer_hap_file))
+                if (gene, hap_index) in self.exact_results:
+                    continue
+                for k, record in enumerate(SeqIO.parse(infer_hap_file, 'fasta')):
+                    print (f">{prefix}{gene}_{hap_index}.{k}\n{record.seq}", file = f)
            
-    def read_blast(self, blast_result_file):
-        # blast_result_file = "/mnt/d/HLAPro_backup/haplotype_v2/spechla/HG00096/test.out"
-        f = open(blast_result_file, 'r')
+    def read_blast(self, hits):
+        # hits: the Blast_Hit of one hap
         identity_record = {}
         record_hit_exon_times = {}
-        for line in f:
-            if line[0] == "#":
-                continue
-            array = line.strip().split()
-            exon = array[1]
-            identity = float(array[2])
-            match_len = int(array[3])
+        for hit in hits:
+            exon = hit.sseqid
+            identity = hit.pident
+            match_len = hit.length
             allele = exon.split("|")[0]
-            if not self.check_pop(allele) and args["p"] != "nonuse": # check allele freq in population
+            if not self.check_pop(allele) and self.ann_db.pop != "nonuse": # check allele freq in population
                 # print ("<<<")
                 continue
             # print (allele, identity, match_len)
@@ -113,46 +155,33 @@ class G_annotation():
                 identity_record[allele][0] += identity
                 identity_record[allele][1] += match_len
             record_hit_exon_times[exon] = 1
-        f.close()
 
         if len(identity_record) == 0:
             return "no_match"
 
-        # sort the dictionary by its values in ascending order
-        # sorted_identity_record = sorted(identity_record.items(), key=lambda x: x[1], reverse = True)
-        sorted_identity_record = sorted(identity_record.items(), key=lambda x: (x[1][0], x[1][1]), reverse = True)
-        # print (sorted_identity_record[0])
-        # print the sorted dictionary
+        # the alleles with the max identity and length, no need to sort all of them
         top_alleles = []
-        max_identity = sorted_identity_record[0][1][0]
-        max_length = sorted_identity_record[0][1][1]
-        for allele, info in sorted_identity_record:
-            if info[0] == max_identity and info[1] == max_length:
-                top_alleles.append(convert_G(allele))
-                # print(allele, info, convert_G(allele))
-            else:
-                break
+        for allele, info in top_group(identity_record.items(), key=lambda x: (x[1][0], x[1][1])):
+            top_alleles.append(convert_G(allele, self.ann_db.G_annotation_dict))
+            # print(allele, info, convert_G(allele))
         # print (top_alleles)
         most_common_allele = most_common(top_alleles)
         return (most_common_allele)
 
-    def main(self):
+    def annotate(self, hits, prefix = ""):
         sample_results = {}
-        print ("The region with low read depth is masked by N. The cutoff is specified by -k.")
         for gene in gene_list:
             sample_results[gene] = []
             for hap_index in range(1,3):
-                infer_hap_file = f"{self.spechla_dir}/hla.allele.{hap_index}.HLA_{gene}.fasta"
-                n_ratio = count_n_ratio(infer_hap_file) # cal the ratio of N in the fasta
-                print ("The ratio of N (masked) is %s for the allele %s"%(n_ratio, infer_hap_file))
-                blast_result_file = infer_hap_file + ".exon.blast"
-                self.blast(infer_hap_file, blast_result_file)
-                g_group_type = self.read_blast(blast_result_file)
+                if (gene, hap_index) in self.exact_results:
+                    g_group_type = self.exact_results[(gene, hap_index)]
+                else:
+                    g_group_type = self.read_blast(hits.get(f"{prefix}{gene}_{hap_index}", []))
                 sample_results[gene].append(g_group_type)
         # print (self.sample, sample_results)
         # return sample_results
         COUT =  open(f"{self.spechla_dir}/hla.result.g.group.txt", "w")
-        COUT.write(version_info)
+        COUT.write(self.ann_db.version_info)
         COUT.write("Sample\tHLA_A_1\tHLA_A_2\tHLA_B_1\tHLA_B_2\tHLA_C_1\tHLA_C_2\tHLA_DPA1_1\tHLA_DPA1_2\tHLA_DPB1_1\tHLA_DPB1_2\tHLA_DQA1_1\tHLA_DQA1_2\tHLA_DQB1_1\tHLA_DQB1_2\tHLA_DRB1_1\tHLA_DRB1_2\n")
         print (self.sample, end = "\t", file = COUT)
         for gene in gene_list:
@@ -160,43 +189,131 @@ class G_annotation():
         print ('', file = COUT)
         COUT.close()
 
+    def main(self):
+        print ("The region with low read depth is masked by N. The cutoff is specified by -k.")
+        query_file = f"{self.spechla_dir}/hla.allele.exon.query.fasta"
+        self.exact_annotate()
+        f = open(query_file, 'w')
+        self.write_query(f)
+        f.close()
+        hits = blast_haps(query_file, f"{self.spechla_dir}/hla.allele.exon.blast", self.ann_db)
+        self.annotate(hits)
+
     def check_pop(self, allele):
         allele = re.sub("HLA-","",allele)
         array = allele.split(":")
         two_field = array[0] + ":" + array[1]
         flag = False
-        if two_field in  hashp:
-            if hashp[two_field] > 0:
+        if two_field in  self.ann_db.hashp:
+            if self.ann_db.hashp[two_field] > 0:
                 flag = True
         return flag
 
-def population(pop, wxs):
+class Annotation_Worker(Process):
+    """
+    a long-lived annotation process shared by the samples of a cohort,
+    the submitted samples are annotated in batches with one blastn run per batch,
+    the annotation tables are loaded once per population
+    """
+    def __init__(self, db, threads, workdir, batch_size = 16):
+        Process.__init__(self)
+        self.db = db
+        self.threads = threads
+        self.workdir = workdir
+        self.batch_size = batch_size
+        self.jobs = Queue()
+        self.results = Queue() # (sample, flag) of the annotated samples
+        self.submitted = [] # the samples submitted by the main process
+
+    def submit(self, sample, spechla_dir, pop):
+        self.submitted.append(sample)
+        self.jobs.put((sample, spechla_dir, pop))
+
+    def collect(self, poll_seconds = 10):
+        """
+        yield (sample, flag) of each submitted sample, in the main process after close(),
+        if the worker process is gone, the samples without a result are failed
+        """
+        waiting = list(self.submitted)
+        while len(waiting) > 0:
+            try:
+                sample, flag = self.results.get(timeout = poll_seconds)
+            except queue.Empty:
+                if self.is_alive():
+                    continue
+                # take the results sent just before the worker exited
+                try:
+                    sample, flag = self.results.get(timeout = 1)
+                except queue.Empty:
+                    print ('The G group annotation process exited with code %s.'%(self.exitcode))
+                    for sample in waiting:
+                        yield sample, False
+                    return
+            waiting.remove(sample)
+            yield sample, flag
+
+    def close(self):
+        self.jobs.put(None)
+
+    def next_batch(self):
+        # wait for one sample, then take the other queued ones
+        batch = [self.jobs.get()]
+        while len(batch) < self.batch_size and batch[-1] is not None:
+            try:
+                batch.append(self.jobs.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        ann_db_dict = {}
+        finished = False
+        while not finished:
+            batch = self.next_batch()
+            if batch[-1] is None:
+                finished = True
+                batch = batch[:-1]
+            if len(batch) == 0:
+                continue
+            g_ann_list = []
+            for sample, spechla_dir, pop in batch:
+                if pop not in ann_db_dict:
+                    ann_db_dict[pop] = Annotation_DB(self.db, pop, self.threads)
+                g_ann_list.append(G_annotation(sample, spechla_dir, ann_db_dict[pop]))
+            try:
+                annotate_batch(g_ann_list, self.workdir)
+                flag = True
+            except Exception as error:
+                print ('G group annotation failed: %s'%(error))
+                flag = False
+            for sample, spechla_dir, pop in batch:
+                self.results.put((sample, flag))
+
+def population(pop, wxs, freq_rows):
     hashp = {}
-    with open(f"{freq}", "r") as fin:
-        next(fin)
-        for line in fin:
-            gene, c, b, a = line.strip().split()
-            if wxs == "exon":
-                a = "%.3f" % float(a)
-                b = "%.3f" % float(b)
-                c = "%.3f" % float(c)
-            elif wxs == "whole":
-                a = "%.8f" % float(a)
-                b = "%.8f" % float(b)
-                c = "%.8f" % float(c)
-            if pop == "Unknown":
-                hashp[gene] = (float(a) + float(b) + float(c)) / 3
-            elif pop == "Asian":
-                hashp[gene] = float(a)
-            elif pop == "Black":
-                hashp[gene] = float(b)
-            elif pop == "Caucasian":
-                hashp[gene] = float(c)
-            elif pop == "nonuse":
-                hashp[gene] = 1
-            else:
-                print ("Wrong value for the parameter -p.")
-                sys.exit(0)
+    for row in freq_rows:
+        gene, c, b, a = row
+        if wxs == "exon":
+            a = "%.3f" % float(a)
+            b = "%.3f" % float(b)
+            c = "%.3f" % float(c)
+        elif wxs == "whole":
+            a = "%.8f" % float(a)
+            b = "%.8f" % float(b)
+            c = "%.8f" % float(c)
+        if pop == "Unknown":
+            hashp[gene] = (float(a) + float(b) + float(c)) / 3
+        elif pop == "Asian":
+            hashp[gene] = float(a)
+        elif pop == "Black":
+            hashp[gene] = float(b)
+        elif pop == "Caucasian":
+            hashp[gene] = float(c)
+        elif pop == "nonuse":
+            hashp[gene] = 1
+        else:
+            print ("Wrong value for the parameter -p.")
+            sys.exit(0)
     return hashp
 
 def most_common(lst):
@@ -234,11 +351,7 @@ if __name__ == "__main__":
         parser.print_help()
         sys.exit(0)
 
-    exon_database = f"{args['db']}/HLA/hla_exons.fasta"
-    freq = f"{args['db']}/HLA/HLA_FREQ_HLA_I_II.txt"
-
     print ("Start G group resolution annotation...")
-    G_annotation_dict, version_info = read_G_annotation(args['db'])
-    hashp = population(args["p"], "whole")
-    g_ann = G_annotation(args["s"], args["i"])
+    ann_db = Annotation_DB(args['db'], args["p"], args["j"])
+    g_ann = G_annotation(args["s"], args["i"], ann_db)
     g_ann.main()
@@ -8,21 +8,33 @@ wangshuai July 8, 2022
 """
 import sys
 import os
+import numpy as np
+sys.path.append(os.path.dirname(os.path.abspath(sys.path[0]))) # the consensus module is in script/
+from consensus import load_reference, write_fasta
+from blast_hits import stream_hits
 
 
 
 
-def blast_map(fragment1):
+def blast_map(fragments):
+    """
+    map the two haps of all the fragments to the prebuilt blast database of the gene
+    in one blastn run, the query of hap k of the i-th fragment is named i_k
+    """
+    query_file = f"{outdir}/{gene}.fragment.haps.fasta"
+    blast_file = f"{outdir}/{gene}.fragment.haps.fasta.out"
+    out = open(query_file, 'w')
+    cons = load_reference(hla_ref)
+    for i in range(len(fragments)):
+        hap_seqs = cons.haplotypes(vcf, fragments[i])
+        for k in range(2):
+            write_fasta(out, f"{i}_{k+1}", hap_seqs[k])
+    out.close()
     command = f"""
-    bin={sys.path[0]}/../../bin/
-    samtools faidx {hla_ref} {fragment1}  | $bin/bcftools consensus -H 1 {vcf} >{outdir}/{fragment1}_hap1.fasta
-    samtools faidx {hla_ref} {fragment1}  | $bin/bcftools consensus -H 2 {vcf} >{outdir}/{fragment1}_hap2.fasta
-
-    blastn -query {outdir}/{fragment1}_hap1.fasta -out {outdir}/{fragment1}_hap1.fasta.out -subject {gene_db} -outfmt 6 -max_target_seqs 10000 -strand plus
-    blastn -query {outdir}/{fragment1}_hap2.fasta -out {outdir}/{fragment1}_hap2.fasta.out -subject {gene_db} -outfmt 6 -max_target_seqs 10000 -strand plus
-
+    blastn -query {query_file} -out {blast_file} -db {gene_db} -outfmt 6 -max_target_seqs 10000 -strand plus -num_threads {threads}
     """
     os.system(command)
+    return blast_file
 
 class Construct_Graph():
     # get the linkage of blocks from database
@@ -74,8 +86,7 @@ class Construct_Graph():
         if len(self.fragments) <= 1:
             print ("No need to phase block.")
             return 0
-        for i in range(len(self.fragments)):
-            blast_map(self.fragments[i])
+        score_matrix = Score_Matrix(blast_map(self.fragments))
 
         for i in range(len(self.fragments)):
             for j in range(i+1, len(self.fragments)):
@@ -105,10 +116,9 @@ class Construct_Graph():
                 for x in range(2):
                     for y in range(2):
                         # print (self.link_type[x][y])
-                        blast_file_1 = f"{outdir}/{fragment1}_hap{self.link_type[x][y][0]}.fasta.out"
-                        blast_file_2 = f"{outdir}/{fragment2}_hap{self.link_type[x][y][1]}.fasta.out"
-                        analyze = Analyze_map()
-                        link = analyze.main(blast_file_1, blast_file_2)
+                        query_1 = f"{i}_{self.link_type[x][y][0]}"
+                        query_2 = f"{j}_{self.link_type[x][y][1]}"
+                        link = score_matrix.linkage(query_1, query_2)
                         if x == y:
                             egde_info[0] += link.high_score
                             egde_info[1] += link.support_allele
@@ -127,61 +137,70 @@ class Construct_Graph():
                 print (fragment1, fragment2, "%s;%s"%(egde_info[0], egde_info[2]), support_1, support_2, file = score_out)
         score_out.close()
    
-class Analyze_map():
-    # def __init__(self, gene):
-    #     self.gene = gene
-    def read_blast(self, blast_file): # in outfmt 6
-        score_dict = {}
-        f = open(blast_file)
-        for line in f:
-            array = line.strip().split()
-            allele = array[1]
-            score = round(float(array[2]),2)
-            map_len = int(array[3])
-            score_dict[allele] = [score, map_len]
-        return score_dict
-    
-    def merge_score(self, score_dict_1, score_dict_2):
-        merged_score_dict = {}
-        for allele in score_dict_1:
-            if allele in score_dict_2:
-                merged_score_dict[allele] = score_dict_1[allele] + score_dict_2[allele]
-        return merged_score_dict
+class Score_Matrix():
+    """
+    the blast hits of all the fragment haps, parsed once
+    into query x allele arrays of the identity and the mapped length,
+    for an allele with several hits, the last hit is kept
+    """
+    def __init__(self, blast_file): # in outfmt 6
+        hits = {}
+        alleles = {}
+        for hit in stream_hits(blast_file):
+            if hit.qseqid not in hits:
+                hits[hit.qseqid] = {}
+            if hit.sseqid not in alleles:
+                alleles[hit.sseqid] = len(alleles)
+            hits[hit.qseqid][hit.sseqid] = [round(hit.pident,2), hit.length]
+        self.alleles = list(alleles.keys())
+        self.query_index = {query: q for q, query in enumerate(hits)}
+        self.score = np.zeros((len(hits), len(alleles)))
+        self.map_len = np.zeros((len(hits), len(alleles)), dtype = np.int64)
+        # the order of the alleles in the hits of each query, -1 if not hit
+        self.rank = np.full((len(hits), len(alleles)), -1, dtype = np.int64)
+        for query in hits:
+            q = self.query_index[query]
+            for r, allele in enumerate(hits[query]):
+                self.score[q][alleles[allele]] = hits[query][allele][0]
+                self.map_len[q][alleles[allele]] = hits[query][allele][1]
+                self.rank[q][alleles[allele]] = r
     
-    def main(self, blast_file_1, blast_file_2):
-        # blast_file_1 = "/mnt/d/HLAPro_backup/haplotype/sample20/frag1_1.out"
-        # blast_file_2 = "/mnt/d/HLAPro_backup/haplotype/sample20/frag1_1.out"
-        score_dict_1 = self.read_blast(blast_file_1)
-        score_dict_2 = self.read_blast(blast_file_2)
-        merged_score_dict = self.merge_score(score_dict_1, score_dict_2)
-        link = Linkage(merged_score_dict)
-        # print (link.high_score, link.support_allele)
-        return link
+        self.link_cache = {}
+
+    def link_all(self, q1):
+        """
+        the edge of query q1 with every query, vectorized over the queries and the alleles,
+        weight = frag_1_identity*frag_1_mapped_length + frag_2_identity*frag_2_mapped_length
+        of the alleles hit by both, the edge score is the weight of the first allele
+        in the hit order of q1, the support alleles are the ones with the same weight
+        """
+        common = (self.rank[q1] >= 0) & (self.rank >= 0)
+        weight = self.score[q1] * self.map_len[q1] + self.score * self.map_len
+        first = np.where(common, self.rank[q1], len(self.alleles)).argmin(axis = 1)
+        high_score = weight[np.arange(len(self.rank)), first]
+        support = common & (weight == high_score[:, None])
+        return common.any(axis = 1), high_score, support
+
+    def linkage(self, query_1, query_2):
+        if query_1 not in self.query_index or query_2 not in self.query_index:
+            return Linkage(0, [])
+        q1, q2 = self.query_index[query_1], self.query_index[query_2]
+        if q1 not in self.link_cache:
+            self.link_cache[q1] = self.link_all(q1)
+        linked, high_score, support = self.link_cache[q1]
+        if not linked[q2]:
+            return Linkage(0, [])
+        support_allele = []
+        for a in sorted(np.flatnonzero(support[q2]).tolist(), key = lambda x: self.rank[q1][x]):
+            support_allele.append([self.alleles[a], self.score[q1][a].item(), self.map_len[q1][a].item(),\
+                self.score[q2][a].item(), self.map_len[q2][a].item()])
+        return Linkage(high_score[q2].item(), support_allele)
 
 class Linkage():
-    # get the edge score, and the support allele
-    def __init__(self, merged_score_dict):
-        high_score = 0
-        support_allele = []
-        if len(merged_score_dict) > 0:
-            i = 0
-            for allele in merged_score_dict:
-                score_list = merged_score_dict[allele]
-                weight_score = score_list[0] * score_list[1] + score_list[2] * score_list[3]
-                # score is frag_1_mapped_length*frag_1_identity + frag_2_mapped_length*frag_2_identity
-                if i == 0:
-                    high_score = weight_score
-                    support_allele.append([allele] + score_list )
-                else:
-                    if weight_score == high_score:
-                        support_allele.append([allele] + score_list )
-                # if i < 5:
-                #     print (allele, merged_score_dict[allele], weight_score)
-
-                i += 1
+    # the edge score, and the support alleles [allele, frag_1_map_score, frag_1_map_len, frag_2_map_score, frag_2_map_len]
+    def __init__(self, high_score, support_allele):
         self.high_score = high_score
         self.support_allele = support_allele
-        # print (support_allele, high_score)
 
 
 # analyze = Analyze_map()
@@ -197,7 +216,8 @@ if __name__ == "__main__":
     db = sys.argv[3]
 
     hla_ref = '%s/ref/hla.ref.extend.fa'%(db)
-    gene_db = '%s/HLA/whole/%s.fasta'%(db, gene)
+    gene_db = '%s/HLA/whole/%s'%(db, gene) # the prebuilt blast database
+    threads = int(sys.argv[4]) if len(sys.argv) > 4 else 1
     vcf = "%s/%s.spechap.vcf.gz"%(outdir, gene)
 
     break_point_file = outdir + "/%s_break_points_spechap.txt"%(gene)
@@ -92,8 +92,8 @@ my $class = $gene;
 my $ref="$db/exon/$class.fasta";
 my (%hashs,%hash_max);
 my %idks;
-`ls $dir/$class.*.fasta >$dir/tfile.list`;
-open TE, "$dir/tfile.list" or die "$!\n";
+`ls $dir/$class.*.fasta >$dir/$class.tfile.list`;
+open TE, "$dir/$class.tfile.list" or die "$!\n";
 open OUT, ">$dir/$class.total.fasta";
 open SOUT, ">$dir/result.$class.fasta";
 while(my $file=<TE>){
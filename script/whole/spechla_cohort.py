@@ -0,0 +1,146 @@
+"""
+Type a cohort of pair-end samples with a pool of worker processes.
+
+The sample sheet has one sample per line: <sample> <fq1> <fq2> [population],
+lines starting with # are skipped.
+Each sample runs the stages of spechla_pipeline.py, so a rerun of the cohort
+resumes the unfinished samples. The G group table and the population
+frequencies are loaded once in each worker and reused for all its samples.
+With --annotation_worker 1, the G group annotation of all the samples is done
+by one long-lived process, which maps the samples finished at the same time
+to the exon database in one blastn run.
+
+wangshuai, wshuai294@gmail.com
+"""
+
+import os
+import sys
+import time
+import shlex
+import argparse
+from multiprocessing import Pool
+from spechla_pipeline import get_parser, build_pipeline
+from g_group_annotation import Annotation_DB, G_annotation, Annotation_Worker
+
+ann_db_dict = {} # population: the annotation tables, one copy per worker
+worker_args = None
+
+def read_sample_sheet(sample_sheet):
+    samples = []
+    for line in open(sample_sheet):
+        array = line.strip().split()
+        if len(array) == 0 or array[0][0] == '#':
+            continue
+        if len(array) < 3:
+            print ("Wrong line in the sample sheet: %s"%(line.strip()))
+            sys.exit(1)
+        pop = array[3] if len(array) > 3 else None
+        samples.append([array[0], array[1], array[2], pop])
+    return samples
+
+def init_worker(cohort_args):
+    global worker_args
+    worker_args = cohort_args
+
+def get_db(db):
+    return db if db else '%s/../../db'%(os.path.dirname(os.path.abspath(__file__)))
+
+def get_ann_db(db, pop, threads):
+    if pop not in ann_db_dict:
+        ann_db_dict[pop] = Annotation_DB(db, pop, threads)
+    return ann_db_dict[pop]
+
+def type_sample(sample, fq1, fq2, pop):
+    """
+    run the pipeline of one sample in this worker,
+    the output of the stages is saved in <outdir>/<sample>/<sample>.cohort.log,
+    also return whether the sample is left to the annotation worker
+    """
+    t0 = time.time()
+    pop = pop if pop is not None else worker_args.p
+    option_list = ['-n', sample, '-1', fq1, '-2', fq2, '-o', worker_args.o, '-j', str(worker_args.j), '-p', pop]
+    if worker_args.db is not None:
+        option_list += ['-i', worker_args.db]
+    args = get_parser().parse_args(option_list + shlex.split(worker_args.options))
+    pipe, outdir = build_pipeline(args, g_group = False)
+
+    annotate = False
+    log = open('%s/%s.cohort.log'%(outdir, sample), 'a')
+    stdout, stderr = os.dup(1), os.dup(2)
+    sys.stdout.flush()
+    os.dup2(log.fileno(), 1)
+    os.dup2(log.fileno(), 2)
+    try:
+        flag = pipe.run()
+        g_group_file = '%s/hla.result.g.group.txt'%(outdir)
+        result_file = '%s/hla.result.txt'%(outdir)
+        if flag and (not os.path.isfile(g_group_file) or os.path.getmtime(g_group_file) < os.path.getmtime(result_file)):
+            if worker_args.annotation_worker == 1:
+                annotate = True
+            else:
+                G_annotation(sample, outdir, get_ann_db(get_db(args.i), pop, args.j)).main()
+        if flag and args.l == 1:
+            os.system('bash %s/../clear_output.sh %s/'%(os.path.dirname(os.path.abspath(__file__)), outdir))
+    except Exception as error:
+        print ('%s failed: %s'%(sample, error))
+        flag = False
+    finally:
+        sys.stdout.flush()
+        os.dup2(stdout, 1)
+        os.dup2(stderr, 2)
+        os.close(stdout)
+        os.close(stderr)
+        log.close()
+    input_size = (os.path.getsize(fq1) + os.path.getsize(fq2)) / 1024 / 1024
+    return sample, flag, time.time() - t0, input_size, outdir, pop, annotate
+
+def type_sample_entry(entry):
+    return type_sample(*entry)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Type a cohort of pair-end samples with SpecHLA.")
+    parser.add_argument('-s', '--sample_sheet', type=str, help='<sample> <fq1> <fq2> [population] per line.', required=True)
+    parser.add_argument('-o', type=str, help='The output folder, each sample has a sub folder.', default='./output')
+    parser.add_argument('-w', '--workers', type=int, help='Number of samples typed at the same time.', default=2)
+    parser.add_argument('-j', type=int, help='Number of threads for each sample.', default=5)
+    parser.add_argument('-p', type=str, help='The population of the samples without population in the sheet.', default='Unknown')
+    parser.add_argument('--db', type=str, help='Location of the IMGT/HLA database folder.', default=None)
+    parser.add_argument('--annotation_worker', type=int, help='Annotate the samples by one long-lived process\
+        in batches [0|1].', default=0)
+    parser.add_argument('--options', type=str, help='Other options of SpecHLA for all the samples, e.g. "-u 1 -v True".',\
+        default='')
+    args = parser.parse_args()
+
+    samples = read_sample_sheet(args.sample_sheet)
+    print ('%s samples, %s workers, %s threads for each sample.'%(len(samples), args.workers, args.j))
+    t0 = time.time()
+    done_num, total_size = 0, 0
+    if args.annotation_worker == 1:
+        ann_worker = Annotation_Worker(get_db(args.db), args.j, args.o)
+        ann_worker.start()
+    pool = Pool(args.workers, initializer = init_worker, initargs = (args,))
+    for sample, flag, cost, input_size, outdir, pop, annotate in pool.imap_unordered(type_sample_entry, samples):
+        total_size += input_size
+        if annotate:
+            ann_worker.submit(sample, outdir, pop)
+            print ('%s is typed, cost %.1f s, waiting for the G group annotation.'%(sample, cost))
+        elif flag:
+            done_num += 1
+            print ('%s is done, cost %.1f s, %.1f MB/min.'%(sample, cost, input_size / max(cost, 1e-6) * 60))
+        else:
+            print ('%s failed after %.1f s, see %s/%s/%s.cohort.log.'%(sample, cost, args.o, sample, sample))
+    pool.close()
+    pool.join()
+    if args.annotation_worker == 1:
+        ann_worker.close()
+        for sample, flag in ann_worker.collect():
+            if flag:
+                done_num += 1
+                print ('%s is done.'%(sample))
+            else:
+                print ('%s failed in the G group annotation.'%(sample))
+        ann_worker.join()
+    cost = time.time() - t0
+    print ('%s of %s samples are done in %.1f s, %.2f samples/hour, %.1f MB/min of input reads.'\
+        %(done_num, len(samples), cost, done_num / cost * 3600, total_size / cost * 60))
@@ -0,0 +1,437 @@
+"""
+Run the SpecHLA stages as a DAG,
+each stage declares its input and output files,
+a stage is skipped if its outputs are newer than its inputs and
+its command is unchanged since the last successful run,
+so an interrupted or parameter-tweaked run only redoes the affected stages.
+
+The stages and their commands follow SpecHLA.sh.
+
+wangshuai, wshuai294@gmail.com
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+gene_list = ['A', 'B', 'C', 'DPA1', 'DPB1', 'DQA1', 'DQB1', 'DRB1']
+state_file_name = '.spechla_state.json'
+
+class Stage():
+    """
+    a pipeline step,
+    the command is a shell template, {threads} is filled at run time,
+    so changing the thread num does not invalidate the stage,
+    it runs with bash -e -o pipefail, so any failed step fails the stage,
+    the outputs written by redirects go to temp names renamed at the end
+    """
+
+    def __init__(self, name, inputs, outputs, command, threads = 1):
+        self.name = name
+        self.inputs = inputs
+        self.outputs = outputs
+        self.command = command
+        self.threads = threads
+        self.command_hash = hashlib.sha1(command.encode()).hexdigest()
+
+    def is_up_to_date(self, state):
+        if state.get(self.name) != self.command_hash:
+            return False
+        for output in self.outputs:
+            if not os.path.exists(output):
+                return False
+        newest_input = max([os.path.getmtime(f) for f in self.inputs if os.path.exists(f)], default = 0)
+        oldest_output = min([os.path.getmtime(f) for f in self.outputs], default = 0)
+        return newest_input <= oldest_output
+
+    def discard_outputs(self):
+        # the outputs of a failed run may be partial, keep them aside for inspection but never trust them
+        for output in self.outputs:
+            if os.path.exists(output):
+                os.replace(output, output + '.failed')
+
+    def run(self):
+        t0 = time.time()
+        print ('[%s] start.'%(self.name), flush = True)
+        status = os.system('bash -e -o pipefail -c %s'%(quote(self.command.replace('{threads}', str(self.threads)))))
+        missing = [output for output in self.outputs if not os.path.exists(output)]
+        if status != 0 or len(missing) > 0:
+            print ('[%s] failed, exit status %s, missing outputs: %s'%(self.name, status, ' '.join(missing)), flush = True)
+            self.discard_outputs()
+            return False
+        print ('[%s] done, cost %s s.'%(self.name, round(time.time() - t0, 1)), flush = True)
+        return True
+
+def quote(command):
+    return "'" + command.replace("'", "'\\''") + "'"
+
+class Pipeline():
+    """
+    the stages form a DAG through their files,
+    a stage waits for the stages producing its inputs,
+    the ready stages run concurrently while their threads fit in the thread budget
+    """
+
+    def __init__(self, outdir, threads = 1, force = False, dry_run = False):
+        self.stages = []
+        self.outdir = outdir
+        self.threads = threads
+        self.force = force
+        self.dry_run = dry_run
+        self.state_file = outdir + '/' + state_file_name
+
+    def add(self, stage):
+        self.stages.append(stage)
+
+    def get_dependency(self):
+        producer = {}
+        for stage in self.stages:
+            for output in stage.outputs:
+                producer[output] = stage.name
+        dependency = {}
+        for stage in self.stages:
+            dependency[stage.name] = set([producer[f] for f in stage.inputs if f in producer and producer[f] != stage.name])
+        return dependency
+
+    def load_state(self):
+        if self.force or not os.path.isfile(self.state_file):
+            return {}
+        with open(self.state_file) as f:
+            return json.load(f)
+
+    def save_state(self, state):
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(state, f, indent = 1)
+        os.replace(tmp_file, self.state_file)
+
+    def run(self):
+        dependency = self.get_dependency()
+        stage_dict = {stage.name: stage for stage in self.stages}
+        state = self.load_state()
+        done, rerun = set(), set()
+        pending = [stage.name for stage in self.stages]
+        running = {}
+        pool = ThreadPoolExecutor(max_workers = len(self.stages))
+        while len(pending) > 0 or len(running) > 0:
+            for name in pending[:]:
+                if not dependency[name] <= done:
+                    continue
+                stage = stage_dict[name]
+                used_threads = sum([stage_dict[running_name].threads for running_name in running.values()])
+                if len(running) > 0 and used_threads + stage.threads > self.threads:
+                    continue
+                pending.remove(name)
+                # a rerun upstream stage makes its outputs newer, the mtime check catches it,
+                # in dry run nothing is written, so the rerun is passed down here
+                if len(dependency[name] & rerun) == 0 and stage.is_up_to_date(state):
+                    print ('[%s] is up to date, skip.'%(name))
+                    done.add(name)
+                elif self.dry_run:
+                    print ('[%s] would run.'%(name))
+                    rerun.add(name)
+                    done.add(name)
+                else:
+                    # forget the stage on disk before it starts writing,
+                    # so a stage killed halfway is not taken as up to date on resume
+                    state.pop(name, None)
+                    self.save_state(state)
+                    running[pool.submit(stage.run)] = name
+            if len(running) == 0:
+                if len(pending) > 0: # the remaining stages wait for a failed stage
+                    break
+                continue
+            finished, _ = wait(running, return_when = FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                if future.result():
+                    done.add(name)
+                    rerun.add(name)
+                    state[name] = stage_dict[name].command_hash
+                    self.save_state(state)
+                else:
+                    pending = [] # stop submitting, let the running stages finish
+        pool.shutdown()
+        if len(done) < len(self.stages):
+            print ('Pipeline stopped, %s of %s stages are done. Rerun the same command to resume.'\
+                %(len(done), len(self.stages)))
+            return False
+        return True
+
+def build_pipeline(args, g_group = True):
+    """
+    the stages of SpecHLA.sh for a pair-end sample,
+    the cohort mode runs the G group annotation in its worker without the stage
+    """
+    dir = os.path.dirname(os.path.abspath(__file__))
+    script = dir + '/..'
+    python_bin = '%s/../../spechla_env/bin/python3'%(dir)
+    bin = '%s/../../bin'%(dir)
+    db = args.i if args.i else '%s/../../db'%(dir)
+    hlaref = '%s/ref/hla.ref.extend.fa'%(db)
+    sample = args.n
+    outdir = '%s/%s'%(os.path.abspath(args.o), sample)
+    os.makedirs(outdir, exist_ok = True)
+    focus_exon_flag = args.u
+    threads = args.j
+    # with -P 1, the stages of the eight genes share the threads
+    if args.P == 1 and args.x == 'NA':
+        gene_jobs = min(threads, 8)
+    else:
+        gene_jobs = 1
+    gene_threads = max(1, threads // gene_jobs)
+    group = "'@RG\\tID:%s\\tSM:%s'"%(sample, sample)
+    env = 'export LD_LIBRARY_PATH=%s/../../spechla_env/lib\n'%(dir)
+
+    pipe = Pipeline(outdir, threads, args.force, args.dry_run)
+    fq1 = '%s/%s.uniq.name.R1.gz'%(outdir, sample)
+    fq2 = '%s/%s.uniq.name.R2.gz'%(outdir, sample)
+    names1 = '%s/%s.uniq.name.R1.names.gz'%(outdir, sample)
+    names2 = '%s/%s.uniq.name.R2.names.gz'%(outdir, sample)
+    pipe.add(Stage('uniq_names', [os.path.abspath(args.r1), os.path.abspath(args.r2)], [fq1, fq2, names1, names2],
+        env + '%s %s/uniq_read_name.py %s %s %s %s'%(python_bin, script, os.path.abspath(args.r1), fq1,\
+        os.path.abspath(args.r2), fq2)))
+
+    map_bam = '%s/%s.map_database.bam'%(outdir, sample)
+    if focus_exon_flag == 1:
+        database_prefix = 'hla_gen.format.filter.extend.DRB.no26789'
+    else:
+        database_prefix = 'hla_gen.format.filter.extend.DRB.no26789.v2'
+    pipe.add(Stage('map_database', [fq1, fq2], [map_bam], env + """
+        if [ -f "{bin}/novoalign.lic" ];then
+            {bin}/novoalign -d {db}/ref/{prefix}.ndx -f {fq1} {fq2} -F STDFQ -o SAM \\
+            -o FullNW -r All 100000 --mCPU {{threads}} -c 10  -g 20 -x 3  | samtools view -Sb - > {bam}.tmp
+        else
+            bowtie2 --very-sensitive -p {{threads}} -k 30 -x {db}/ref/{prefix}.fasta -1 {fq1} -2 {fq2}|\\
+            samtools view -bS - >{bam}.tmp
+        fi
+        mv {bam}.tmp {bam}
+        """.format(bin = bin, db = db, prefix = database_prefix, fq1 = fq1, fq2 = fq2, bam = map_bam), threads))
+
+    gene_fq = {}
+    for gene in gene_list:
+        gene_fq[gene] = ['%s/%s.R1.fq.gz'%(outdir, gene), '%s/%s.R2.fq.gz'%(outdir, gene)]
+    pipe.add(Stage('binning', [map_bam, fq1, fq2, names1, names2], sum(gene_fq.values(), []),
+        env + '%s %s/assign_reads_to_genes.py -1 %s -2 %s -n %s -o %s -d %s -b %s -nm %s -j {threads} --names1 %s --names2 %s'\
+        %(python_bin, script, fq1, fq2, bin, outdir, args.y, map_bam, args.m, names1, names2), threads))
+
+    gene_bams = []
+    for gene in gene_list:
+        gene_bam = '%s/%s.bam'%(outdir, gene)
+        gene_bams.append(gene_bam)
+        pipe.add(Stage('bwa_%s'%(gene), gene_fq[gene], [gene_bam, gene_bam + '.bai'], """
+            bwa mem -t {{threads}} -U 10000 -L 10000,10000 -R {group} {db}/HLA/HLA_{gene}/HLA_{gene}.fa {fq1} {fq2}\\
+             | samtools view -bS -F 0x800 -| samtools sort -T {outdir}/{gene}.sort.tmp - >{bam}.tmp
+            mv {bam}.tmp {bam}
+            samtools index {bam}
+            """.format(group = group, db = db, gene = gene, fq1 = gene_fq[gene][0], fq2 = gene_fq[gene][1],\
+            outdir = outdir, bam = gene_bam), gene_threads))
+
+    merge_bam = '%s/%s.merge.bam'%(outdir, sample)
+    pipe.add(Stage('merge', gene_bams + [fq1, fq2], [merge_bam], """
+        # samtools view -H exits after the header, so bwa may die of SIGPIPE
+        rm -f {outdir}/header.sam
+        bwa mem -U 10000 -L 10000,10000 -R {group} {hlaref} {fq1} {fq2} | samtools view -H  >{outdir}/header.sam \\
+            || [ -s {outdir}/header.sam ]
+        samtools merge -f -h {outdir}/header.sam {merge}.tmp.bam {bams}
+        mv {merge}.tmp.bam {merge}
+        samtools index {merge}
+        """.format(group = group, hlaref = hlaref, fq1 = fq1, fq2 = fq2, outdir = outdir, merge = merge_bam,\
+        bams = ' '.join(gene_bams))))
+
+    if focus_exon_flag == 1:
+        assemble_region = dir + '/select.region.exon.txt'
+    else:
+        assemble_region = dir + '/select.region.txt'
+    bam = '%s/%s.realign.sort.bam'%(outdir, sample)
+    pipe.add(Stage('local_assembly', [merge_bam], [bam], 'sh %s/run.assembly.realign.sh %s %s %s 70 %s {threads}'\
+        %(script, sample, merge_bam, outdir, assemble_region), threads))
+
+    vcf = '%s/%s.realign.filter.vcf'%(outdir, sample)
+    if focus_exon_flag == 1:
+        region_filter = '-R %s/exon_extent.bed'%(dir)
+    else:
+        region_filter = '-t HLA_A:1000-4503,HLA_B:1000-5081,HLA_C:1000-5304,HLA_DPA1:1000-10775,HLA_DPB1:1000-12468,'\
+            + 'HLA_DQA1:1000-7492,HLA_DQB1:1000-8480,HLA_DRB1:1000-12229'
+    pipe.add(Stage('freebayes', [bam], [vcf], """
+        freebayes -a -f {hlaref} -p 3 {outdir}/{sample}.realign.sort.bam > {outdir}/{sample}.realign.vcf
+        rm -rf {outdir}/{sample}.realign.vcf.gz
+        bgzip -f {outdir}/{sample}.realign.vcf
+        tabix -f {outdir}/{sample}.realign.vcf.gz
+        zless {outdir}/{sample}.realign.vcf.gz |grep "#" > {vcf}.tmp
+        {bin}/bcftools filter {region} {outdir}/{sample}.realign.vcf.gz | {{ grep -v "#" || [ $? -eq 1 ]; }} >> {vcf}.tmp
+        mv {vcf}.tmp {vcf}
+        """.format(hlaref = hlaref, outdir = outdir, sample = sample, vcf = vcf, bin = bin, region = region_filter)))
+
+    long_read_fq = []
+    for data, platform in [(args.t, 'pacbio'), (args.e, 'nanopore')]:
+        if data == 'NA':
+            continue
+        outputs = ['%s/%s/%s.%s.fq.gz'%(outdir, sample, gene, platform) for gene in gene_list]
+        long_read_fq += outputs
+        pipe.add(Stage('long_read_binning_%s'%(platform), [os.path.abspath(data)], outputs,
+            env + '%s %s/long_read_typing.py -r %s -n %s -m 0 -o %s -j {threads} -a %s --db %s'\
+            %(python_bin, script, os.path.abspath(data), sample, outdir, platform, db), threads))
+
+    mask_bed = '%s/low_depth.bed'%(outdir)
+    if focus_exon_flag == 1:
+        mask_exon = 'True'
+    else:
+        mask_exon = args.z
+    pipe.add(Stage('mask', [bam], [bam + '.depth', mask_bed], env + """
+        samtools depth -aa {bam}>{bam}.depth.tmp
+        mv {bam}.depth.tmp {bam}.depth
+        {python} {script}/mask_low_depth_region.py -c {bam}.depth -o {outdir} -w 20 -d {depth} -f {mask_exon}
+        """.format(bam = bam, python = python_bin, script = script, outdir = outdir, depth = args.k, mask_exon = mask_exon)))
+
+    if args.a != 'NA':
+        bfile = os.path.abspath(args.a)
+    elif args.v == 'True' and focus_exon_flag != 1:
+        bfile = '%s/%s.long.InDel.breakpoint.txt'%(outdir, sample)
+        if args.t != 'NA': # detect long Indel with pacbio
+            command = env + """
+            pbmm2 align -j {{threads}} {hlaref} {tgs} {outdir}/{sample}.movie1.bam --sort --sample {sample} --rg '@RG\\tID:movie1'
+            samtools view -H {outdir}/{sample}.movie1.bam >{outdir}/header.sam
+            for hla in {genes}; do
+                pbmm2 align -j {{threads}} {db}/HLA/HLA_$hla/HLA_$hla.fa {outdir}/{sample}/$hla.pacbio.fq.gz {outdir}/$hla.gene.bam --sort --sample {sample} --rg '@RG\\tID:movie1'
+                samtools index {outdir}/$hla.gene.bam
+            done
+            samtools merge -f -h {outdir}/header.sam {outdir}/{sample}.pacbio.bam {gene_bams}
+            samtools index {outdir}/{sample}.pacbio.bam
+            pbsv discover -l 100 {outdir}/{sample}.pacbio.bam {outdir}/{sample}.svsig.gz
+            pbsv call -t DEL,INS -m 150 -j {{threads}} {hlaref} {outdir}/{sample}.svsig.gz {outdir}/{sample}.var.vcf
+            {python} {dir}/vcf2bp.py {outdir}/{sample}.var.vcf {outdir}/{sample}.tgs.breakpoint.txt
+            cat {outdir}/{sample}.tgs.breakpoint.txt >{bfile}.tmp
+            mv {bfile}.tmp {bfile}
+            """.format(hlaref = hlaref, tgs = os.path.abspath(args.t), outdir = outdir, sample = sample,\
+            genes = ' '.join(gene_list), db = db, python = python_bin, dir = dir, bfile = bfile,\
+            gene_bams = ' '.join(['%s/%s.gene.bam'%(outdir, gene) for gene in gene_list]))
+            inputs = [bam] + long_read_fq
+        else: # detect long Indel with pair end data.
+            command = """
+            port=$(date +%N|cut -c5-9)
+            bash {script}/ScanIndel/run_scanindel_sample.sh {sample} {bam} {outdir} $port
+            cat {outdir}/Scanindel/{sample}.breakpoint.txt >{bfile}.tmp
+            mv {bfile}.tmp {bfile}
+            """.format(script = script, sample = sample, bam = bam, outdir = outdir, bfile = bfile)
+            inputs = [bam]
+        pipe.add(Stage('long_indel', inputs, [bfile], command, threads))
+    else:
+        bfile = 'nothing'
+
+    if args.r is None:
+        if focus_exon_flag != 1:
+            my_maf = 0.05
+        else:
+            my_maf = 0.1
+    else:
+        my_maf = args.r
+    hap_fastas = []
+    for gene in gene_list:
+        outputs = ['%s/hla.allele.%s.HLA_%s.fasta'%(outdir, i, gene) for i in [1, 2]]
+        hap_fastas += outputs
+        inputs = [bam, vcf, mask_bed] + gene_fq[gene] + long_read_fq
+        if bfile != 'nothing':
+            inputs.append(bfile)
+        if gene_jobs > 1:
+            workdir = '%s/work/HLA_%s'%(outdir, gene)
+        else:
+            workdir = outdir
+        pipe.add(Stage('phase_%s'%(gene), inputs, outputs, env + """
+            mkdir -p {workdir}
+            {python} {script}/phase_variants.py \\
+              -o {outdir} \\
+              -b {bam} \\
+              -s {bfile} \\
+              -v {vcf} \\
+              --fq1 {fq1} \\
+              --fq2 {fq2} \\
+              --gene HLA_{gene} \\
+              --freq_bias {maf} \\
+              --snp_qual {snp_qual} \\
+              --snp_dp {snp_dp} \\
+              --ref {db}/ref/HLA_{gene}.fa \\
+              --tgs {tgs} \\
+              --nanopore {nanopore} \\
+              --hic_fwd {hic_fwd} \\
+              --hic_rev {hic_rev} \\
+              --tenx {tenx} \\
+              --sa {sample} \\
+              --weight_imb {weight_imb} \\
+              --exon {exon} \\
+              --thread_num {{threads}} \\
+              --use_database {use_database} \\
+              --trio {trio} \\
+              --workdir {workdir} \\
+              --db {db}
+            """.format(workdir = workdir, python = python_bin, script = script, outdir = outdir, bam = bam,\
+            bfile = bfile, vcf = vcf, fq1 = gene_fq[gene][0], fq2 = gene_fq[gene][1], gene = gene, maf = my_maf,\
+            snp_qual = args.q, snp_dp = args.s, db = db, tgs = args.t, nanopore = args.e, hic_fwd = args.c,\
+            hic_rev = args.d, tenx = args.x, sample = sample, weight_imb = args.w, exon = focus_exon_flag,\
+            use_database = args.b, trio = args.f), gene_threads))
+
+    if focus_exon_flag == 1:
+        region = 'exon'
+    else:
+        region = 'whole'
+    result = '%s/hla.result.txt'%(outdir)
+    pipe.add(Stage('annoHLA', hap_fastas, [result], 'perl %s/annoHLA.pl -s %s -i %s -p %s -d %s/HLA -r %s'\
+        %(dir, sample, outdir, args.p, db, region)))
+    if g_group:
+        pipe.add(Stage('g_group_annotation', hap_fastas + [result], ['%s/hla.result.g.group.txt'%(outdir)],
+            env + '%s %s/g_group_annotation.py -s %s -i %s -p %s -j {threads} --db %s'%(python_bin, dir, sample, outdir, args.p, db),\
+            threads))
+    return pipe, outdir
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="SpecHLA pipeline with resumable stages.\
+        The options are the same as SpecHLA.sh.")
+    parser.add_argument('-n', type=str, help='Sample ID.', required=True)
+    parser.add_argument('-1', dest='r1', type=str, help='The first fastq file of paired-end data.', required=True)
+    parser.add_argument('-2', dest='r2', type=str, help='The second fastq file of paired-end data.', required=True)
+    parser.add_argument('-o', type=str, help='The output folder.', default='./output')
+    parser.add_argument('-u', type=int, help='Choose full-length or exon typing [0|1].', default=0)
+    parser.add_argument('-p', type=str, help='The population of the sample.', default='Unknown')
+    parser.add_argument('-j', type=int, help='Number of threads.', default=5)
+    parser.add_argument('-t', type=str, help='Pacbio fastq file.', default='NA')
+    parser.add_argument('-e', type=str, help='Nanopore fastq file.', default='NA')
+    parser.add_argument('-c', type=str, help='fwd hi-c fastq file.', default='NA')
+    parser.add_argument('-d', type=str, help='rev hi-c fastq file.', default='NA')
+    parser.add_argument('-x', type=str, help='Path of folder created by 10x demultiplexing.', default='NA')
+    parser.add_argument('-w', type=float, help='The weight to use allele imbalance info for phasing.', default=0)
+    parser.add_argument('-m', type=int, help='The maximum mismatch number in assigning gene-specific reads.', default=2)
+    parser.add_argument('-y', type=float, help='The minimum different mapping score between the best and\
+        second-best aligned genes.', default=0.1)
+    parser.add_argument('-v', type=str, help='Consider long InDels if True.', default='False')
+    parser.add_argument('-q', type=float, help='Minimum variant quality.', default=0.01)
+    parser.add_argument('-s', type=int, help='Minimum variant depth.', default=5)
+    parser.add_argument('-a', type=str, help='Use this long InDel file if provided.', default='NA')
+    parser.add_argument('-r', type=float, help='The minimum Minor Allele Frequency (MAF).', default=None)
+    parser.add_argument('-k', type=float, help='The mean depth in a window lower than this value will be masked.', default=5)
+    parser.add_argument('-z', type=str, help='Whether only mask exon region, True or False.', default='False')
+    parser.add_argument('-f', type=str, help='The trio infromation; child:parent_1:parent_2.', default='None')
+    parser.add_argument('-b', type=int, help='Whether use database for unlinked block phasing [0|1].', default=1)
+    parser.add_argument('-i', type=str, help='Location of the IMGT/HLA database folder.', default=None)
+    parser.add_argument('-P', type=int, help='Whether run the stages of the eight genes in parallel [0|1].', default=0)
+    parser.add_argument('-l', type=int, help='Whether remove all tmp files after the run [0|1]. The later reruns\
+        recompute the removed intermediate files.', default=0)
+    parser.add_argument('--force', action='store_true', help='Rerun all the stages.')
+    parser.add_argument('--dry_run', action='store_true', help='Only print the stages to run.')
+    return parser
+
+if __name__ == "__main__":
+
+    args = get_parser().parse_args()
+
+    pipe, outdir = build_pipeline(args)
+    if not pipe.run():
+        sys.exit(1)
+    if args.l == 1 and not args.dry_run:
+        os.system('bash %s/../clear_output.sh %s/'%(os.path.dirname(os.path.abspath(__file__)), outdir))
+    if not args.dry_run:
+        os.system('cat %s/hla.result.txt'%(outdir))
+    print ('%s is done.'%(args.n))